@@ -1,38 +1,103 @@
 # gevent を使う場合のモンキーパッチ（WSGIサーバを gevent にするため）
 from gevent import monkey
 monkey.patch_all()
+import gevent
+from gevent.lock import Semaphore
+from gevent.queue import Queue as GeventQueue
+from gevent.threadpool import ThreadPool
 
 import os
 import json
 import bcrypt
 import hashlib
+import hmac
 import re
 import base64
 import time
 import sqlite3
-import joblib
-from flask import Flask, render_template, request, jsonify
-from werkzeug.utils import secure_filename
-from flask_socketio import SocketIO, emit
+import queue
+import itertools
+from contextlib import contextmanager
+from functools import wraps
+from flask import Flask, render_template, request, jsonify, has_request_context, send_file, url_for, abort
+from flask_socketio import SocketIO, emit, join_room
 from google import genai
 from google.genai import types 
 from google.genai.types import Tool, GenerateContentConfig, GoogleSearch, ToolCodeExecution
 from dotenv import load_dotenv
 from pathlib import Path
-from filelock import FileLock
+
+# 以下のモジュールは読み込み時に環境変数を参照するので、先に .env を読み込んでおく
+load_dotenv()
+from shared_state import create_shared_state
+from uploads import (
+    UPLOAD_BACKEND, UPLOAD_CHUNK_SIZE, UPLOAD_SESSION_TTL, UploadError, UploadManager,
+    GeminiUploadBackend, LocalUploadBackend, local_file_path,
+)
+from file_registry import FileRegistry
+from model_catalog import ModelCatalog
+from history_index import upgrade_index, apply_changes, changes_since, history_page
+from search_index import SearchIndex, SEARCH_RESULT_LIMIT
+from token_counter import token_count_cache, estimate_tokens, estimate_text_tokens
+from context_window import (
+    resolve_policy, build_window, describe_window, new_turn_counts, summary_cutoff, summary_request,
+    estimate_content_tokens,
+)
+from turn_index import next_offsets, build_turn_index, is_consistent
+from context_cache import CONTEXT_CACHE, CONTEXT_CACHE_TTL, ContextCacheRegistry, config_key, cached_config, layout_length
+from chat_store import (
+    ChatLog, FileDocument, cached_read, cached_read_page, cached_append, cached_truncate, cached_replace_tail,
+    cached_save, cached_delete, cached_document_read, cached_document_update, list_chat_logs,
+)
+from consolidated_store import ConsolidatedStore
+from file_sweeper import referenced_file_ids, select_files, delete_files as delete_remote_files, sweep_local_files
+from scheduler import upstream_scheduler
+from resilience import FirstChunkTimeout, run_with_failover, circuit_breaker, is_retryable
+from static_assets import ASSET_PIPELINE, ASSET_URL_PREFIX, ASSET_MAX_AGE, AssetPipeline
+from metrics import (
+    REGISTRY, RATE_BUCKETS, TimedConnection, counter, histogram, callback, span, annotate, traced,
+)
 
 # -----------------------------------------------------------
 # 1) Flask + SocketIO の初期化
 # -----------------------------------------------------------
+# 複数ワーカーで動かす場合は Redis 互換サーバーの URL を指定する (README の「複数ワーカー構成」を参照)
+SOCKETIO_MESSAGE_QUEUE = os.environ.get("SOCKETIO_MESSAGE_QUEUE")
+# ロングポーリングは1つの接続のリクエストが別々のワーカーに届きうるので、複数ワーカーでは WebSocket に限定する
+SOCKETIO_TRANSPORTS = os.environ.get(
+    "SOCKETIO_TRANSPORTS", "websocket" if SOCKETIO_MESSAGE_QUEUE else "polling,websocket"
+).split(",")
+
 app = Flask(__name__)
-socketio = SocketIO(app, async_mode="gevent", cors_allowed_origins="*", max_http_buffer_size=20 * 1024 * 1024,)
+socketio = SocketIO(
+    app, async_mode="gevent", cors_allowed_origins="*", max_http_buffer_size=20 * 1024 * 1024,
+    message_queue=SOCKETIO_MESSAGE_QUEUE, transports=SOCKETIO_TRANSPORTS,
+)
+# キャンセル要求やトークンの無効化を他のワーカーに伝える
+shared_state = create_shared_state()
+
+socketio_event_seconds = histogram(
+    "socketio_event_seconds", "Socket.IO イベントの処理時間 (send_message などは応答の完了まで)", ("event",)
+)
+
+def socket_event(name):
+    """socketio.on の代わりに使い、イベントごとの処理時間を記録する (TRACING 指定時は span にする)"""
+    def decorator(handler):
+        @wraps(handler)
+        def timed(*args):
+            with socketio_event_seconds.time(event=name), span("socketio." + name):
+                return handler(*args)
+        socketio.on(name)(timed)
+        return handler
+    return decorator
 
 # 環境変数の読み込み
-load_dotenv()
 GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY")
 if not GOOGLE_API_KEY:
     raise ValueError("GOOGLE_API_KEY environment variable not set")
-client = genai.Client(api_key=GOOGLE_API_KEY)
+# GEMINI_BASE_URL: API の前段にプロキシなどを置く場合の接続先
+GEMINI_BASE_URL = os.environ.get("GEMINI_BASE_URL")
+client = genai.Client(api_key=GOOGLE_API_KEY, http_options={"base_url": GEMINI_BASE_URL} if GEMINI_BASE_URL else None)
 
 code_execution_tool = Tool(
     code_execution=ToolCodeExecution()
@@ -43,6 +108,7 @@ google_search_tool = Tool(
 )
 
 MODELS = os.environ.get("MODELS", "").split(",")
+model_catalog = ModelCatalog(client, MODELS)
 SYSTEM_INSTRUCTION = os.environ.get("SYSTEM_INSTRUCTION")
 VERSION = os.environ.get("VERSION")
 
@@ -52,28 +118,96 @@ VERSION = os.environ.get("VERSION")
 DB_FILE = "data/database.db"
 os.makedirs("data/", exist_ok=True)  # data/ フォルダがなければ作成
 
+# File API にアップロード済みのファイルを内容のハッシュで引くためのレジストリ
+file_registry = FileRegistry(DB_FILE)
+# チャットごとの Gemini コンテキストキャッシュの記録
+context_caches = ContextCacheRegistry(DB_FILE)
+
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 4))
+TOKEN_CACHE_TTL = float(os.environ.get("TOKEN_CACHE_TTL", 300))
+
+# 接続を使い回すためのプール (monkey.patch_all 済みなので gevent 対応の Queue になる)
+db_pool = queue.Queue()
+
+def connect_db():
+    conn = sqlite3.connect(DB_FILE, timeout=30, check_same_thread=False, factory=TimedConnection)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+@contextmanager
+def get_db():
+    """プールから接続を借りる。ブロックを抜けるときに commit してプールに戻す"""
+    try:
+        conn = db_pool.get_nowait()
+    except queue.Empty:
+        conn = connect_db()
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        if db_pool.qsize() < DB_POOL_SIZE:
+            db_pool.put(conn)
+        else:
+            conn.close()
+
 def init_db():
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS accounts (
-        username TEXT PRIMARY KEY,
-        password TEXT,
-        auto_login_token TEXT
-    )
-    """)
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS accounts (
+            username TEXT PRIMARY KEY,
+            password TEXT,
+            auto_login_token TEXT
+        )
+        """)
+        # ソケットイベントごとのトークン検索が全件走査にならないようにする
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_accounts_auto_login_token ON accounts (auto_login_token)")
+    file_registry.init_db()
+    context_caches.init_db()
+    context_caches.prune()
+    if chat_db:
+        chat_db.init_db()
 
 def generate_auto_login_token(username: str, version_salt: str):
     raw = (username + version_salt).encode("utf-8")
     return hashlib.sha256(raw).hexdigest()
 
+# bcrypt は GIL を手放す CPU 処理なので、gevent のハブを止めないようネイティブスレッドで実行する
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", 12))
+BCRYPT_WORKERS = int(os.environ.get("BCRYPT_WORKERS", 2))
+BCRYPT_QUEUE_SIZE = int(os.environ.get("BCRYPT_QUEUE_SIZE", 32))
+
+bcrypt_pool = ThreadPool(BCRYPT_WORKERS)
+auth_stats = {"pending": 0, "completed": 0, "rejected": 0, "total_seconds": 0.0, "max_seconds": 0.0}
+
+class AuthBusyError(Exception):
+    """bcrypt の待ち行列が上限に達している"""
+
+def run_bcrypt(label, func, *args):
+    if auth_stats["pending"] >= BCRYPT_WORKERS + BCRYPT_QUEUE_SIZE:
+        auth_stats["rejected"] += 1
+        raise AuthBusyError()
+    auth_stats["pending"] += 1
+    start = time.perf_counter()
+    try:
+        return bcrypt_pool.apply(func, args)
+    finally:
+        elapsed = time.perf_counter() - start
+        auth_stats["pending"] -= 1
+        auth_stats["completed"] += 1
+        auth_stats["total_seconds"] += elapsed
+        auth_stats["max_seconds"] = max(auth_stats["max_seconds"], elapsed)
+        print(f"[auth] {label}: {elapsed * 1000:.0f}ms (queue={auth_stats['pending']})")
+
 def hash_password(password):
-    return bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
+    salt = bcrypt.gensalt(rounds=BCRYPT_ROUNDS)
+    return run_bcrypt("hash", bcrypt.hashpw, password.encode(), salt).decode()
 
 def verify_password(password, hashed):
-    return bcrypt.checkpw(password.encode(), hashed.encode())
+    return run_bcrypt("verify", bcrypt.checkpw, password.encode(), hashed.encode())
 
 def register_user(username, password):
     """新規ユーザー登録"""
@@ -84,28 +218,28 @@ def register_user(username, password):
         return {"status": "error", "message": "英数字以外の文字が含まれています。"}
 
     # すでに同名ユーザーが存在するかチェック
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT username FROM accounts WHERE username=?", (username,))
-    existing = c.fetchone()
+    with get_db() as conn:
+        existing = conn.execute("SELECT username FROM accounts WHERE username=?", (username,)).fetchone()
     if existing:
-        conn.close()
         return {"status": "error", "message": "既存のユーザー名です。"}
 
     # 挿入
-    hashed_pw = hash_password(password)
-    c.execute("INSERT INTO accounts (username, password) VALUES (?, ?)", (username, hashed_pw))
-    conn.commit()
-    conn.close()
+    try:
+        hashed_pw = hash_password(password)
+    except AuthBusyError:
+        return {"status": "error", "message": "混雑しています。しばらくしてから再度お試しください。"}
+    try:
+        with get_db() as conn:
+            conn.execute("INSERT INTO accounts (username, password) VALUES (?, ?)", (username, hashed_pw))
+    except sqlite3.IntegrityError:
+        # ハッシュ計算中に同名ユーザーが登録された場合
+        return {"status": "error", "message": "既存のユーザー名です。"}
     return {"status": "success", "message": "登録完了"}
 
 def authenticate(username, password):
     """ユーザー認証"""
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT password FROM accounts WHERE username=?", (username,))
-    row = c.fetchone()
-    conn.close()
+    with get_db() as conn:
+        row = conn.execute("SELECT password FROM accounts WHERE username=?", (username,)).fetchone()
     if row:
         hashed_pw = row[0]
         return verify_password(password, hashed_pw)
@@ -114,28 +248,33 @@ def authenticate(username, password):
 # ------------------------
 # 認証 (SQLite)
 # ------------------------
-@socketio.on("register")
+@socket_event("register")
 def handle_register(data):
     username = data.get("username")
     password = data.get("password")
     result = register_user(username, password)
     emit("register_response", result)
 
-@socketio.on("login")
+@socket_event("login")
 def handle_login(data):
     username = data.get("username")
     password = data.get("password")
-    if authenticate(username, password):
+    try:
+        authenticated = authenticate(username, password)
+    except AuthBusyError:
+        emit("login_response", {"status": "error", "message": "混雑しています。しばらくしてから再度お試しください。"})
+        return
+    if authenticated:
         # 認証成功
         # ここでauto_login_tokenを生成してDBに保存し、クライアントに返す
         version_salt = VERSION  # 適宜、環境変数 or DBで管理してもOK
         auto_login_token = generate_auto_login_token(username, version_salt)
         # DBに保存
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute("UPDATE accounts SET auto_login_token=? WHERE username=?", (auto_login_token, username))
-        conn.commit()
-        conn.close()
+        with get_db() as conn:
+            conn.execute("UPDATE accounts SET auto_login_token=? WHERE username=?", (auto_login_token, username))
+        # 古いトークンのキャッシュを捨ててから、このソケットを新しいトークンに紐付ける
+        invalidate_user_tokens(username)
+        bind_session(auto_login_token, username)
 
         # クライアントには username ではなく auto_login_token を返す
         emit("login_response", {
@@ -146,16 +285,15 @@ def handle_login(data):
     else:
         emit("login_response", {"status": "error", "message": "ログイン失敗"})
 
-@socketio.on("auto_login")
+@socket_event("auto_login")
 def handle_auto_login(data):
     token = data.get("token", "")
 
     # 1) まず、DBから「auto_login_token == token」なユーザを探す
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT username, auto_login_token FROM accounts WHERE auto_login_token = ?", (token,))
-    row = c.fetchone()
-    conn.close()
+    with get_db() as conn:
+        row = conn.execute(
+            "SELECT username, auto_login_token FROM accounts WHERE auto_login_token = ?", (token,)
+        ).fetchone()
 
     if row:
         username, stored_token = row
@@ -165,6 +303,7 @@ def handle_auto_login(data):
         # 3) DBに保存されているトークンと合うか確認
         if new_hash == stored_token:
             # 一致 => 自動ログイン成功
+            bind_session(stored_token, username)
             emit("auto_login_response", {
                 "status": "success",
                 "username": username,
@@ -186,7 +325,206 @@ def handle_auto_login(data):
 # -----------------------------------------------------------
 # 3) チャット用の定数や共通変数
 # -----------------------------------------------------------
-cancellation_flags = {}
+class StreamHandle:
+    """1回の応答生成。(sid, chat_id, request_id) ごとに作り、個別にキャンセルできる
+
+    Gemini からのチャンクは別の greenlet で読み、キューで受け渡す。cancel() はその greenlet を
+    止めてストリームを閉じるので、次のチャンクを待たずに上流の接続とワーカーが解放される。
+    """
+
+    def __init__(self, sid, username, chat_id, request_id):
+        self.sid = sid
+        self.username = username
+        self.chat_id = chat_id
+        self.request_id = request_id
+        self.cancelled = False
+        self.reader = None
+        self.queue = GeventQueue()
+
+    @property
+    def key(self):
+        return (self.sid, self.chat_id, self.request_id)
+
+    def iterate(self, response, first_chunk_timeout=None):
+        """response を読み出し用の greenlet で読み、届いたチャンクを順に返す
+
+        first_chunk_timeout 秒以内に最初のチャンクが届かなければ、ストリームを閉じて FirstChunkTimeout を投げる。
+        """
+        def read():
+            try:
+                for chunk in response:
+                    self.queue.put(("chunk", chunk))
+                self.queue.put(("end", None))
+            except Exception as e:
+                self.queue.put(("error", e))
+            finally:
+                # キャンセル時は GreenletExit でここに来る。ジェネレータを閉じると
+                # SDK が持っている HTTP レスポンスが解放され、上流の接続が切れる
+                response.close()
+
+        if self.cancelled:
+            response.close()
+            return
+        # 送り直したときに前のストリームの残りを読まないよう、試行ごとにキューを作り直す
+        self.queue = GeventQueue()
+        self.reader = gevent.spawn(read)
+        timeout = first_chunk_timeout
+        while True:
+            try:
+                kind, value = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                self.reader.kill(block=False)
+                raise FirstChunkTimeout(f"{first_chunk_timeout:g} 秒以内に応答が始まりませんでした")
+            timeout = None
+            if kind == "chunk":
+                yield value
+            elif kind == "error":
+                raise value
+            else:
+                return
+
+    def sleep(self, seconds):
+        """送り直す前に待つ。待っている間にキャンセルされたら True"""
+        try:
+            self.queue.get(timeout=seconds)
+        except queue.Empty:
+            pass
+        return self.cancelled
+
+    def cancel(self):
+        self.cancelled = True
+        if self.reader is not None:
+            self.reader.kill(block=False)
+        self.queue.put(("end", None))
+
+# 生成中のストリーム: (sid, chat_id, request_id) → StreamHandle
+active_streams = {}
+
+callback("active_streams", "このプロセスで生成中のストリームの数", lambda: len(active_streams))
+stream_cancellations = counter("stream_cancellations_total", "キャンセルしたストリームの数")
+gemini_first_chunk_seconds = histogram(
+    "gemini_first_chunk_seconds", "送信してから最初のチャンクが届くまでの時間", ("model",)
+)
+gemini_tokens_per_second = histogram(
+    "gemini_output_tokens_per_second", "最初のチャンクから完了までの出力トークンの速度", ("model",), RATE_BUCKETS
+)
+gemini_streams = counter("gemini_streams_total", "応答ストリームの結果 (completed / cancelled / error)", ("model", "outcome"))
+
+def open_stream(sid, username, chat_id, request_id):
+    stream = StreamHandle(sid, username, chat_id, request_id)
+    active_streams[stream.key] = stream
+    return stream
+
+def close_stream(stream):
+    # 途中で例外になった場合も読み出し用の greenlet を残さない
+    if stream.reader is not None:
+        stream.reader.kill(block=False)
+    if active_streams.get(stream.key) is stream:
+        del active_streams[stream.key]
+
+def cancel_streams(username, chat_id=None, request_id=None):
+    """このプロセスで条件に合うストリームをキャンセルする。request_id を省くとそのチャットの生成をすべて止める
+
+    同じユーザーなら別のタブ・再接続後のソケットからでも止められるよう、sid ではなくユーザー名で絞る。
+    """
+    cancelled = 0
+    for stream in list(active_streams.values()):
+        if stream.username != username:
+            continue
+        if chat_id is not None and stream.chat_id != chat_id:
+            continue
+        if request_id is not None and stream.request_id != request_id:
+            continue
+        stream.cancel()
+        cancelled += 1
+    stream_cancellations.inc(cancelled)
+    return cancelled
+
+# 他のワーカーで受け付けたキャンセル要求
+shared_state.on("cancel_stream", cancel_streams)
+
+# gemini_response_chunk をまとめて送るための設定 (最大待ち時間[秒] / バイト数)
+CHUNK_FLUSH_INTERVAL = float(os.environ.get("CHUNK_FLUSH_INTERVAL", 0.04))
+CHUNK_FLUSH_BYTES = int(os.environ.get("CHUNK_FLUSH_BYTES", 8192))
+emit_stats = {"chunks": 0, "frames": 0}
+
+# 生成途中の応答をチャット履歴に書き込む間隔 (秒 / 未保存の文字数)
+CHECKPOINT_INTERVAL = float(os.environ.get("CHECKPOINT_INTERVAL", 2.0))
+CHECKPOINT_BYTES = int(os.environ.get("CHECKPOINT_BYTES", 16384))
+# load_chat_page で1回に返すメッセージ数 (既定値 / 上限)
+CHAT_PAGE_SIZE = int(os.environ.get("CHAT_PAGE_SIZE", 30))
+CHAT_PAGE_MAX = int(os.environ.get("CHAT_PAGE_MAX", 200))
+# チャット一覧 (get_history_list) の1ページの件数
+HISTORY_PAGE_SIZE = int(os.environ.get("HISTORY_PAGE_SIZE", 50))
+HISTORY_PAGE_MAX = 500
+# search_chats で返す件数の上限 (既定値は search_index.SEARCH_RESULT_LIMIT)
+SEARCH_RESULT_MAX = 100
+# 途中で止まった応答の続きを頼むときのプロンプト
+CONTINUE_PROMPT = os.environ.get("CONTINUE_PROMPT", "途中で中断された直前の回答の続きを、重複させずにそのまま出力してください。")
+# 履歴以外に毎回送る分 (システム指示) のトークン数の概算。prompt_token_count からユーザー発言の分を求めるときに引く
+CONTEXT_OVERHEAD = estimate_text_tokens(SYSTEM_INSTRUCTION.encode("utf-8")) if SYSTEM_INSTRUCTION else 0
+# 要約・コンテキストキャッシュを作成中のチャット (同じチャットで同時に作らない)
+summarizing = set()
+
+class ChunkEmitter:
+    """1回の応答ストリーム分のチャンクをまとめて gemini_response_chunk として送る
+
+    バッファが CHUNK_FLUSH_BYTES を超えたとき、最初のチャンクから CHUNK_FLUSH_INTERVAL 経ったとき、
+    close() されたときに送信する。送信はこのインスタンス内で直列化し、seq を振って順序を保証する。
+    """
+
+    def __init__(self, sid, chat_id, request_id=None):
+        self.sid = sid
+        self.chat_id = chat_id
+        self.request_id = request_id
+        self.buffer = []
+        self.buffered_bytes = 0
+        self.seq = 0
+        self.chunks = 0
+        self.frames = 0
+        self.timer = None
+        self.lock = Semaphore()
+
+    def add(self, text):
+        if not text:
+            return
+        with self.lock:
+            self.buffer.append(text)
+            self.buffered_bytes += len(text.encode("utf-8"))
+            self.chunks += 1
+            emit_stats["chunks"] += 1
+            if self.buffered_bytes >= CHUNK_FLUSH_BYTES:
+                self._flush_locked()
+            elif self.timer is None:
+                self.timer = gevent.spawn_later(CHUNK_FLUSH_INTERVAL, self.flush)
+
+    def flush(self):
+        with self.lock:
+            self._flush_locked()
+
+    def close(self):
+        """ストリーム終了時に残りを送る"""
+        self.flush()
+
+    def _flush_locked(self):
+        if self.timer is not None:
+            if self.timer is not gevent.getcurrent():
+                self.timer.kill(block=False)
+            self.timer = None
+        if not self.buffer:
+            return
+        text = "".join(self.buffer)
+        self.buffer = []
+        self.buffered_bytes = 0
+        # タイマーから呼ばれたときはリクエストコンテキストがないので宛先を明示する
+        socketio.emit(
+            "gemini_response_chunk",
+            {"chunk": text, "chat_id": self.chat_id, "request_id": self.request_id, "seq": self.seq},
+            to=self.sid,
+        )
+        self.seq += 1
+        self.frames += 1
+        emit_stats["frames"] += 1
 
 EXTENSION_TO_MIME = {
     "pdf": "application/pdf", "js": "application/x-javascript",
@@ -204,117 +542,371 @@ EXTENSION_TO_MIME = {
 
 USER_DIR = "data/"  # ユーザーデータ保存ディレクトリ
 
+# 複数ワーカーではチャンクごとに別のワーカーに届きうるので、セッションを共有ストアにも置く
+upload_store = shared_state if shared_state.shared else None
+if UPLOAD_BACKEND == "local":
+    upload_manager = UploadManager(LocalUploadBackend(USER_DIR), store=upload_store)
+else:
+    upload_manager = UploadManager(GeminiUploadBackend(client, GOOGLE_API_KEY, GEMINI_BASE_URL), registry=file_registry, store=upload_store)
+
 def get_user_dir(username):
     user_dir = os.path.join(USER_DIR, username)
     os.makedirs(user_dir, exist_ok=True)
     return user_dir
 
+# ソケットごとの認証済みユーザー (sid -> (token, username))
+sid_sessions = {}
+# トークン -> (username, 有効期限)
+token_cache = {}
+
+def current_sid():
+    return getattr(request, "sid", None) if has_request_context() else None
+
+def user_room(username):
+    """そのユーザーのすべてのソケットが入るルーム (ワーカーをまたいで送信できる)"""
+    return f"user:{username}"
+
+def bind_session(token, username):
+    """このソケットをユーザーに紐付け、以降のイベントでは DB を引かずに済むようにする"""
+    sid = current_sid()
+    if sid:
+        sid_sessions[sid] = (token, username)
+        join_room(user_room(username))
+    token_cache[token] = (username, time.time() + TOKEN_CACHE_TTL)
+
+def invalidate_user_tokens(username):
+    """トークンを再発行したユーザーのキャッシュと紐付けを破棄する (他のワーカーにも伝える)"""
+    drop_user_tokens(username)
+    shared_state.publish("invalidate_user_tokens", username=username)
+
+def drop_user_tokens(username):
+    for token, (cached_username, _) in list(token_cache.items()):
+        if cached_username == username:
+            token_cache.pop(token, None)
+    for sid, (_, bound_username) in list(sid_sessions.items()):
+        if bound_username == username:
+            sid_sessions.pop(sid, None)
+
+shared_state.on("invalidate_user_tokens", drop_user_tokens)
+
 def get_username_from_token(token):
     """トークンからユーザー名を取得する"""
     if not token:
         return None
-    
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT username FROM accounts WHERE auto_login_token = ?", (token,))
-    row = c.fetchone()
-    conn.close()
-    
+
+    # 1) このソケットに紐付いたセッション
+    session = sid_sessions.get(current_sid())
+    if session and session[0] == token:
+        return session[1]
+
+    # 2) TTL 付きのトークンキャッシュ
+    now = time.time()
+    cached = token_cache.get(token)
+    if cached and cached[1] > now:
+        return cached[0]
+
+    # 3) DB (auto_login_token のインデックスを使う)
+    with get_db() as conn:
+        row = conn.execute("SELECT username FROM accounts WHERE auto_login_token = ?", (token,)).fetchone()
+
     if row:
+        token_cache[token] = (row[0], now + TOKEN_CACHE_TTL)
         return row[0]
+    token_cache.pop(token, None)
     return None
 
 # -----------------------------------------------------------
-# 4) チャット履歴管理 (従来どおりファイルに保存)
+# 4) チャット履歴管理
 # -----------------------------------------------------------
-def load_past_chats(user_dir):
-    past_chats_file = os.path.join(user_dir, "past_chats_list")
-    lock_file = past_chats_file + ".lock"  # ロック用ファイル(.lock)
-    # withブロックを抜けるまでロックが保持される
-    with FileLock(lock_file):
-        try:
-            past_chats = joblib.load(past_chats_file)
-        except Exception:
-            past_chats = {}
-    return past_chats
+# CHAT_STORE=files (既定) は従来どおりユーザーごとのファイルに、
+# CHAT_STORE=db は集約ストア (consolidated_store.py) に保存する。db でも未移行のチャットは従来のファイルから読む。
+CHAT_STORE = os.environ.get("CHAT_STORE", "files")
+chat_db = ConsolidatedStore() if CHAT_STORE == "db" else None
+
+def open_chat_log(path):
+    return chat_db.open_log(path) if chat_db else ChatLog(path)
 
-def save_past_chats(user_dir, past_chats):
-    past_chats_file = os.path.join(user_dir, "past_chats_list")
-    lock_file = past_chats_file + ".lock"
-    with FileLock(lock_file):
-        joblib.dump(past_chats, past_chats_file)
+# past_chats / メッセージ / Gemini履歴はメモリ上の LRU キャッシュを経由して読み書きする
+# past_chats はリビジョン付きの一覧 (history_index.py) として保存し、変更は差分で配信する
+def history_document(user_dir):
+    path = os.path.join(user_dir, "past_chats_list")
+    return chat_db.open_document(path, upgrade_index) if chat_db else FileDocument(path, upgrade_index)
 
+def load_history_index(user_dir):
+    """リビジョン付きのチャット一覧を返す (キャッシュの値そのものなので書き換えないこと)"""
+    return cached_document_read(history_document(user_dir))
+
+def load_past_chats(user_dir):
+    return copy_past_chats(load_history_index(user_dir)["chats"])
+
+def update_past_chats(user_dir, mutate):
+    """ロックを取ったまま一覧を読み、mutate(past_chats) で書き換えて保存する
+
+    変わったチャットがあればリビジョンを進め、その差分 (history_delta) を返す。変化がなければ None。
+    """
+    result = {}
+    def apply(index):
+        past_chats = copy_past_chats(index["chats"])
+        mutate(past_chats)
+        index, result["delta"] = apply_changes(index, past_chats)
+        return index if result["delta"] else None
+    cached_document_update(history_document(user_dir), apply)
+    return result.get("delta")
+
+def emit_history_delta(username, delta):
+    """一覧の差分をそのユーザーのすべてのタブに送る"""
+    if delta:
+        socketio.emit("history_delta", delta, to=user_room(username))
+
+def copy_past_chats(past_chats):
+    # 呼び出し側が書き換えてもキャッシュが壊れないようにコピーを渡す
+    return {chat_id: dict(info) if isinstance(info, dict) else info for chat_id, info in past_chats.items()}
+
+def chat_messages_log(user_dir, chat_id):
+    return open_chat_log(os.path.join(user_dir, f"{chat_id}-st_messages"))
+
+def gemini_history_log(user_dir, chat_id):
+    return open_chat_log(os.path.join(user_dir, f"{chat_id}-gemini_messages"))
+
+def gemini_tokens_log(user_dir, chat_id):
+    # Gemini 履歴と同じ並びで、各 Content のトークン数 (不明なら None) を持つ (context_window.py)
+    return open_chat_log(os.path.join(user_dir, f"{chat_id}-gemini_tokens"))
+
+def turn_index_log(user_dir, chat_id):
+    # st_messages の各メッセージが Gemini 履歴のどこから始まるか (turn_index.py)
+    return open_chat_log(os.path.join(user_dir, f"{chat_id}-turn_index"))
+
+def context_summary_log(user_dir, chat_id):
+    # summary ポリシーで作った要約 {"covers", "text", "tokens", "model", "created"} を 1 レコードだけ持つ
+    return open_chat_log(os.path.join(user_dir, f"{chat_id}-context_summary"))
+
+def list_chat_ids(user_dir):
+    """st_messages があるチャットの chat_id 一覧 (ストアと従来のファイルの両方)"""
+    chat_ids = set(list_chat_logs(user_dir, "-st_messages"))
+    if chat_db:
+        chat_ids.update(chat_db.list_logs(os.path.basename(user_dir), "-st_messages"))
+    return sorted(chat_ids)
+
+# 1ターンごとの書き込み量をチャット全体ではなく追加分だけにするため、追記型ログに保存する
 def load_chat_messages(user_dir, chat_id):
-    messages_file = os.path.join(user_dir, f"{chat_id}-st_messages")
-    lock_file = messages_file + ".lock"
-    with FileLock(lock_file):
-        try:
-            messages = joblib.load(messages_file)
-        except Exception:
-            messages = []
+    try:
+        messages = cached_read(chat_messages_log(user_dir, chat_id))
+    except Exception:
+        messages = []
     return messages
 
-def save_chat_messages(user_dir, chat_id, messages):
-    messages_file = os.path.join(user_dir, f"{chat_id}-st_messages")
-    lock_file = messages_file + ".lock"
-    with FileLock(lock_file):
-        joblib.dump(messages, messages_file)
+def load_chat_messages_page(user_dir, chat_id, limit, before=None):
+    """(メッセージ, 先頭のメッセージ番号, 全件数) を返す"""
+    return cached_read_page(chat_messages_log(user_dir, chat_id), limit, before)
 
-def load_gemini_history(user_dir, chat_id):
-    history_file = os.path.join(user_dir, f"{chat_id}-gemini_messages")
-    lock_file = history_file + ".lock"
-    with FileLock(lock_file):
+# st_messages を書き換えたら、同じ範囲だけ全文検索インデックスとターンインデックスにも反映する
+def append_chat_messages(user_dir, chat_id, new_messages):
+    start = cached_append(chat_messages_log(user_dir, chat_id), new_messages)
+    update_search_index(user_dir, lambda index: index.replace_tail(chat_id, start, new_messages))
+    update_turn_index(user_dir, chat_id, start, new_messages)
+
+def truncate_chat_messages(user_dir, chat_id, length):
+    cached_truncate(chat_messages_log(user_dir, chat_id), length)
+    update_search_index(user_dir, lambda index: index.truncate(chat_id, length))
+    cached_truncate(turn_index_log(user_dir, chat_id), length)
+
+def replace_chat_messages_tail(user_dir, chat_id, keep, new_messages):
+    cached_replace_tail(chat_messages_log(user_dir, chat_id), keep, new_messages)
+    update_search_index(user_dir, lambda index: index.replace_tail(chat_id, keep, new_messages))
+    update_turn_index(user_dir, chat_id, keep, new_messages)
+
+def load_turn_index(user_dir, chat_id):
+    try:
+        return cached_read(turn_index_log(user_dir, chat_id))
+    except Exception:
+        return []
+
+def update_turn_index(user_dir, chat_id, keep, new_messages):
+    """st_messages の keep 件目以降を new_messages にしたときの offset を書く (変わらなければ書かない)"""
+    offsets = load_turn_index(user_dir, chat_id)
+    if len(offsets) < keep:
+        # この機能より前のチャットなどで記録が足りない
+        rebuild_turn_index(user_dir, chat_id)
+        return
+    previous = (load_chat_messages(user_dir, chat_id)[keep - 1]["role"], offsets[keep - 1]) if keep else None
+    new_offsets = next_offsets(previous, new_messages, len(load_gemini_history(user_dir, chat_id)))
+    if offsets[keep:] != new_offsets:
+        cached_replace_tail(turn_index_log(user_dir, chat_id), keep, new_offsets)
+
+def rebuild_turn_index(user_dir, chat_id):
+    offsets = build_turn_index(load_chat_messages(user_dir, chat_id), load_gemini_history(user_dir, chat_id))
+    # save は末尾の差分しか書かないので、途中の offset を直した場合も反映されるよう全体を書き直す
+    cached_replace_tail(turn_index_log(user_dir, chat_id), 0, offsets)
+    return offsets
+
+def gemini_offset(user_dir, chat_id, message_index):
+    """st_messages の message_index 番目のメッセージが始まる Gemini 履歴の位置
+
+    保存済みのインデックスを引くだけで、件数と参照先の role が合わないときだけ両方のリストから作り直す。
+    """
+    messages = load_chat_messages(user_dir, chat_id)
+    history = load_gemini_history(user_dir, chat_id)
+    offsets = load_turn_index(user_dir, chat_id)
+    if not is_consistent(offsets, messages, history, message_index):
+        print(f"[turn_index] rebuilt chat_id={chat_id} (recorded={len(offsets)} messages={len(messages)})")
+        offsets = rebuild_turn_index(user_dir, chat_id)
+    return min(offsets[message_index], len(history))
+
+def update_search_index(user_dir, apply):
+    """検索インデックスへの反映に失敗してもチャットの保存は止めない (次の検索で取り込み直す)"""
+    index = SearchIndex(user_dir)
+    try:
+        apply(index)
+    except Exception as e:
+        print(f"[search] インデックスの更新に失敗しました: {e}")
         try:
-            history = joblib.load(history_file)
+            index.invalidate()
         except Exception:
-            history = []
+            pass
+
+def load_gemini_history(user_dir, chat_id):
+    try:
+        history = cached_read(gemini_history_log(user_dir, chat_id))
+    except Exception:
+        history = []
     return history
 
-def save_gemini_history(user_dir, chat_id, history):
-    history_file = os.path.join(user_dir, f"{chat_id}-gemini_messages")
-    lock_file = history_file + ".lock"
-    with FileLock(lock_file):
-        joblib.dump(history, history_file)
+# Gemini 履歴を書き換えたら、トークン数も同じ位置を書き換え、範囲が消えた要約を捨てる
+# counts を省くとトークン数は不明 (None) として記録する
+def append_gemini_history(user_dir, chat_id, new_contents, counts=None):
+    start = cached_append(gemini_history_log(user_dir, chat_id), new_contents)
+    write_token_counts(user_dir, chat_id, start, counts or [None] * len(new_contents))
 
-def delete_chat(user_dir, chat_id):
+def truncate_gemini_history(user_dir, chat_id, length):
+    cached_truncate(gemini_history_log(user_dir, chat_id), length)
+    cached_truncate(gemini_tokens_log(user_dir, chat_id), length)
+    gemini_history_changed(user_dir, chat_id, length)
+
+def replace_gemini_history_tail(user_dir, chat_id, keep, new_contents, counts=None):
+    cached_replace_tail(gemini_history_log(user_dir, chat_id), keep, new_contents)
+    write_token_counts(user_dir, chat_id, keep, counts or [None] * len(new_contents))
+    gemini_history_changed(user_dir, chat_id, keep)
+
+def load_token_counts(user_dir, chat_id, length):
+    """Gemini 履歴 length 件分のトークン数 (記録の無い位置は None)"""
     try:
-        os.remove(os.path.join(user_dir, f"{chat_id}-st_messages"))
-        os.remove(os.path.join(user_dir, f"{chat_id}-gemini_messages"))
-    except FileNotFoundError:
-        pass
-    past_chats = load_past_chats(user_dir)
-    if chat_id in past_chats:
-        del past_chats[chat_id]
-        save_past_chats(user_dir, past_chats)
-
-def find_gemini_index(messages, target_user_messages, include_model_responses=True):
-    user_count = 0
-    for idx, content in enumerate(messages):
-        if content.role == "user":
-            user_count += 1
-            if user_count == target_user_messages:
-                if include_model_responses:
-                    # ユーザー発言に続くすべてのモデルの応答を含める
-                    while idx + 1 < len(messages) and messages[idx + 1].role == "model":
-                        idx += 1
-                    return idx + 1
-                else:
-                    # ユーザー発言直後までとする
-                    return idx + 1
-    return len(messages)
+        counts = cached_read(gemini_tokens_log(user_dir, chat_id))[:length]
+    except Exception:
+        counts = []
+    return counts + [None] * (length - len(counts))
+
+def write_token_counts(user_dir, chat_id, keep, counts):
+    # この機能より前のチャットは記録が短いので、None で埋めて位置を揃えてから書く
+    log = gemini_tokens_log(user_dir, chat_id)
+    current = len(cached_read(log))
+    if current < keep:
+        cached_replace_tail(log, current, [None] * (keep - current) + list(counts))
+    else:
+        cached_replace_tail(log, keep, counts)
+
+def load_context_summary(user_dir, chat_id):
+    try:
+        records = cached_read(context_summary_log(user_dir, chat_id))
+    except Exception:
+        records = []
+    return records[-1] if records else None
+
+def gemini_history_changed(user_dir, chat_id, length):
+    """Gemini 履歴の先頭 length 件より後ろを書き換えたとき、その範囲を含む要約とコンテキストキャッシュを捨てる"""
+    summary = load_context_summary(user_dir, chat_id)
+    if summary and summary["covers"] > length:
+        cached_delete(context_summary_log(user_dir, chat_id))
+    name = context_caches.invalidate(os.path.basename(user_dir), chat_id, length)
+    if name:
+        gevent.spawn(delete_context_cache, name)
+
+def delete_chat(user_dir, chat_id):
+    """チャットを削除し、一覧の差分を返す"""
+    cached_delete(chat_messages_log(user_dir, chat_id))
+    cached_delete(gemini_history_log(user_dir, chat_id))
+    cached_delete(gemini_tokens_log(user_dir, chat_id))
+    cached_delete(context_summary_log(user_dir, chat_id))
+    cached_delete(turn_index_log(user_dir, chat_id))
+    gemini_history_changed(user_dir, chat_id, 0)
+    update_search_index(user_dir, lambda index: index.delete_chat(chat_id))
+    return update_past_chats(user_dir, lambda past_chats: past_chats.pop(chat_id, None))
+
+def touch_chat(user_dir, chat_id, title):
+    """チャットの最終更新時刻を進める。新規チャットなら title で一覧に登録する"""
+    def touch(past_chats):
+        info = past_chats.setdefault(chat_id, {"title": title, "bookmarked": False})
+        info["updated"] = time.time()
+    return update_past_chats(user_dir, touch)
 
 # -----------------------------------------------------------
 # 5) Flask ルートと SocketIO イベント
 # -----------------------------------------------------------
+# 静的ファイルはハッシュ付きの名前と圧縮版を用意して /assets/ から配信する (static_assets.py)
+assets = AssetPipeline(app.static_folder)
+if ASSET_PIPELINE:
+    try:
+        assets.build()
+    except Exception as e:
+        # ビルドできなくても従来の /static/ で配信できる
+        print(f"[assets] 静的ファイルのビルドに失敗しました: {e}")
+
+@app.template_global()
+def asset_url(filename):
+    """ハッシュ付きの URL (ビルドしていないファイルは従来の /static/ の URL)"""
+    return (ASSET_PIPELINE and assets.url(filename)) or url_for("static", filename=filename)
+
+@app.route(ASSET_URL_PREFIX + "<path:filename>")
+def serve_asset(filename):
+    found = assets.lookup(filename, request.accept_encodings)
+    if found is None:
+        abort(404)
+    path, encoding, info = found
+    response = send_file(
+        path, mimetype=info["mimetype"], etag=f"{info['etag']}-{encoding or 'identity'}",
+        max_age=ASSET_MAX_AGE, conditional=True,
+    )
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    response.vary.add("Accept-Encoding")
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    return response
+
 @app.route("/")
 def index():
-    return render_template("index.html")
-
-@socketio.on("set_username")
+    if ASSET_PIPELINE and app.debug:
+        assets.refresh()  # 開発中に編集した script.js などを反映する
+    return render_template("index.html", socketio_transports=SOCKETIO_TRANSPORTS)
+
+# /metrics に Bearer トークンを要求する場合に指定する
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+
+# 既存の統計は取得のたびに読む
+callback("auth_pending", "bcrypt の実行待ち・実行中の数", lambda: auth_stats["pending"])
+callback("auth_completed_total", "bcrypt の実行回数", lambda: auth_stats["completed"], kind="counter")
+callback("auth_rejected_total", "混雑で断った認証の数", lambda: auth_stats["rejected"], kind="counter")
+callback("auth_seconds_total", "bcrypt の待ち時間を含む所要時間の合計", lambda: auth_stats["total_seconds"], kind="counter")
+callback("emitted_chunks_total", "ChunkEmitter に渡したチャンクの数", lambda: emit_stats["chunks"], kind="counter")
+callback("emitted_frames_total", "gemini_response_chunk を送った回数", lambda: emit_stats["frames"], kind="counter")
+callback("token_count_cache_hits_total", "count_token のキャッシュヒット数", lambda: token_count_cache.hits, kind="counter")
+callback("token_count_cache_misses_total", "count_token のキャッシュミス数", lambda: token_count_cache.misses, kind="counter")
+callback("model_list_refreshes_total", "モデル一覧を取得し直した回数", lambda: model_catalog.refresh_count, kind="counter")
+
+@app.route("/metrics")
+def export_metrics():
+    """Prometheus のテキスト形式でこのワーカーのメトリクスを返す"""
+    if METRICS_TOKEN and not hmac.compare_digest(
+        request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}"
+    ):
+        return "unauthorized\n", 401, {"WWW-Authenticate": "Bearer"}
+    return REGISTRY.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+@socket_event("set_username")
 def handle_set_username(data):
     token = data.get("token")
     username = get_username_from_token(token)
     if username:
+        bind_session(token, username)
         print(f"Token authenticated as user: {username}")
         emit("set_username_response", {"status": "success", "username": username})
     else:
@@ -324,35 +916,139 @@ def handle_set_username(data):
 # ------------------------
 # チャット関連イベント
 # ------------------------
-@socketio.on("count_token")
+@socket_event("count_token")
 def handle_count_token(data):
+    """添付ファイルのトークン数を返す
+
+    キャッシュにあればその値を、なければ概算値 (provisional) を返す。
+    exact が指定されたとき (クライアントで表示をクリックしたとき) だけ count_tokens を呼んで正確な値を返す。
+    クライアントは file_name で古い添付への応答を読み捨てる。
+    """
     model_name = data.get("model_name")
     file_data_base64 = data.get("file_data")
     file_mime_type = data.get("file_mime_type")
+    file_id = data.get("file_id")
+    file_name = data.get("file_name")
 
-    if file_mime_type in EXTENSION_TO_MIME.values():
+    if file_mime_type not in EXTENSION_TO_MIME.values() or not (file_data_base64 or file_id):
+        return
+    if file_id:
+        # アップロード済みのファイルは file_id が内容を指しているのでそのままキーにする
+        file_data = None
+        key = (model_name, file_id, file_mime_type)
+    else:
         file_data = base64.b64decode(file_data_base64)
-        file_part = types.Part.from_bytes(data=file_data, mime_type=file_mime_type)
-        content = [file_part]
-        
-        response = client.models.count_tokens(model=model_name, contents=content,)
-        token = f"{response.total_tokens:,}"
-        emit("total_tokens", {"total_tokens": token})
-
-@socketio.on("get_model_list")
+        key = (model_name, hashlib.sha256(file_data).hexdigest(), file_mime_type)
+
+    total_tokens = token_count_cache.get(key)
+    if total_tokens is not None:
+        emit("total_tokens", {"total_tokens": f"{total_tokens:,}", "file_name": file_name, "provisional": False})
+        return
+    estimate = estimate_tokens(file_data, file_mime_type, size=data.get("file_size"))
+    estimate_text = f"~{estimate:,}" if estimate is not None else "?"
+    if not data.get("exact"):
+        emit("total_tokens", {"total_tokens": estimate_text, "file_name": file_name, "provisional": True})
+        return
+
+    try:
+        if file_id:
+            file_part = resolve_file_part(file_id, file_mime_type)
+        else:
+            file_part = types.Part.from_bytes(data=file_data, mime_type=file_mime_type)
+        response = client.models.count_tokens(model=model_name, contents=[file_part])
+    except Exception as e:
+        print(f"count_tokens エラー: {e}")
+        emit("total_tokens", {"total_tokens": estimate_text, "file_name": file_name, "provisional": True, "failed": True})
+        return
+    token_count_cache.put(key, response.total_tokens)
+    emit("total_tokens", {"total_tokens": f"{response.total_tokens:,}", "file_name": file_name, "provisional": False})
+
+@socket_event("get_model_list")
 def handle_get_model_list():
-    api_models = client.models.list()
-    api_model_names = [m.name for m in api_models]
-    combined_models = sorted(set(api_model_names + [m.strip() for m in MODELS if m.strip()]))
-    emit("model_list", {"models": combined_models})
+    # 一覧はバックグラウンドで更新されるキャッシュから返す
+    emit("model_list", model_catalog.get())
 
-@socketio.on("cancel_stream")
+@socket_event("cancel_stream")
 def handle_cancel_stream(data):
-    sid = request.sid
-    cancellation_flags[sid] = True
+    username = get_username_from_token(data.get("token"))
+    if not username:
+        emit("error", {"message": "認証エラー"})
+        return
+    cancelled = cancel_streams(username, data.get("chat_id"), data.get("request_id"))
+    # 生成中のワーカーがこのワーカーとは限らないので他のワーカーにも伝える
+    shared_state.publish("cancel_stream", username=username, chat_id=data.get("chat_id"), request_id=data.get("request_id"))
+    print(f"[stream] cancel chat_id={data.get('chat_id')} request_id={data.get('request_id')} streams={cancelled}")
+
+def resolve_upload_mime_type(file_name, mime_type):
+    """ブラウザが MIME タイプを付けなかった場合は拡張子から補う"""
+    if mime_type and mime_type != "application/octet-stream":
+        return mime_type
+    extension = os.path.splitext(file_name or "")[1].lstrip(".").lower()
+    return EXTENSION_TO_MIME.get(extension, mime_type or "application/octet-stream")
+
+def upload_error_response(e):
+    print(f"アップロード処理エラー: {str(e)}")
+    status = e.status if isinstance(e, UploadError) else 500
+    return jsonify({"status": "error", "message": str(e)}), status
+
+@app.route("/upload_session", methods=["POST"])
+def create_upload_session():
+    """分割アップロードを開始する"""
+    payload = request.get_json(silent=True) or {}
+    username = get_username_from_token(payload.get("token"))
+    if not username:
+        return jsonify({"status": "error", "message": "認証エラー"}), 401
+    file_name = payload.get("file_name") or "upload"
+    try:
+        session = upload_manager.create(
+            username, file_name,
+            resolve_upload_mime_type(file_name, payload.get("mime_type")),
+            int(payload.get("file_size") or 0),
+            sha256=payload.get("sha256"),
+        )
+    except Exception as e:
+        return upload_error_response(e)
+    return jsonify(session.status())
+
+@app.route("/upload_session/<upload_id>", methods=["GET"])
+def get_upload_session(upload_id):
+    """受信済みの位置を返す (接続が切れたあとの再開用)"""
+    username = get_username_from_token(request.headers.get("X-Auth-Token"))
+    if not username:
+        return jsonify({"status": "error", "message": "認証エラー"}), 401
+    try:
+        session = upload_manager.get(username, upload_id)
+    except UploadError as e:
+        return upload_error_response(e)
+    return jsonify(session.status())
+
+@app.route("/upload_session/<upload_id>", methods=["PUT"])
+def put_upload_chunk(upload_id):
+    """X-Upload-Offset の位置から始まるチャンクを受け取り、そのまま保存先へ流す"""
+    username = get_username_from_token(request.headers.get("X-Auth-Token"))
+    if not username:
+        return jsonify({"status": "error", "message": "認証エラー"}), 401
+    try:
+        session = upload_manager.get(username, upload_id)
+    except UploadError as e:
+        return upload_error_response(e)
+    try:
+        offset = int(request.headers.get("X-Upload-Offset", -1))
+        upload_manager.write(session, request.stream, offset, request.content_length or 0)
+    except UploadError as e:
+        if e.status == 409:
+            # 位置がずれている場合は正しい再開位置を返す
+            return jsonify(dict(session.status(), status="error", message=str(e))), 409
+        return upload_error_response(e)
+    except Exception as e:
+        return upload_error_response(e)
+    if session.result:
+        print(f"アップロード完了: file_id={session.result['file_id']}, サイズ: {session.size}")
+    return jsonify(dict(session.status(), file_name=session.file_name))
 
 @app.route("/upload_large_file", methods=["POST"])
 def upload_large_file():
+    """旧クライアント向け。multipart で受け取ったファイルを分割アップロードと同じ経路で転送する"""
     if "file" not in request.files:
         return jsonify({"status": "error", "message": "ファイルがありません"}), 400
     
@@ -362,146 +1058,173 @@ def upload_large_file():
         return jsonify({"status": "error", "message": "認証エラー"}), 401
     
     file = request.files["file"]
-    
-    # ユーザーディレクトリに一時ファイルとして保存
-    user_dir = get_user_dir(username)
-    timestamp = int(time.time())
-    safe_filename = f"tmp_{timestamp}_{secure_filename(file.filename)}"
-    tmp_path = os.path.join(user_dir, safe_filename)
-    
     try:
-        # ファイルを一時的に保存
-        file.save(tmp_path)
-        
-        # デバッグ情報をログに出力
-        print(f"一時ファイル保存完了: {tmp_path}, サイズ: {os.path.getsize(tmp_path)}")
-        
-        try:
-            # Gemini File APIを使ってアップロード - より詳細なエラーハンドリング
-            uploaded_file = client.files.upload(
-                file=tmp_path,
-            )
-            print(f"Gemini File APIアップロード成功: file_id={uploaded_file.name}")
-            
-            # 一時ファイルを削除
-            os.remove(tmp_path)
-            
-            # ファイルIDと情報を返す
-            return jsonify({
-                "status": "success",
-                "file_id": uploaded_file.name,
-                "file_name": file.filename,
-                "file_mime_type": file.content_type
-            })
-        except Exception as api_error:
-            # API固有のエラーをより詳細にログ出力
-            print(f"Gemini File APIエラー: {str(api_error)}")
-            print(f"エラータイプ: {type(api_error).__name__}")
-            
-            # クライアントへのわかりやすいエラーメッセージ
-            return jsonify({
-                "status": "error", 
-                "message": f"ファイルAPIエラー: {str(api_error)}"
-            }), 500
-            
+        stream = file.stream
+        stream.seek(0, os.SEEK_END)
+        size = stream.tell()
+        # 受信済みのファイルなのでハッシュを先に計算し、登録済みなら転送を省く
+        sha256 = hashlib.sha256()
+        stream.seek(0)
+        for block in iter(lambda: stream.read(1024 * 1024), b""):
+            sha256.update(block)
+        stream.seek(0)
+        session = upload_manager.create(
+            username, file.filename, resolve_upload_mime_type(file.filename, file.content_type), size,
+            sha256=sha256.hexdigest(),
+        )
+        while session.offset < size:
+            upload_manager.write(session, stream, session.offset, min(UPLOAD_CHUNK_SIZE, size - session.offset))
     except Exception as e:
-        # 一般的なエラー
-        print(f"アップロード処理エラー: {str(e)}")
-        # エラー時も一時ファイルを削除
-        if os.path.exists(tmp_path):
-            os.remove(tmp_path)
-        return jsonify({"status": "error", "message": str(e)}), 500
-
-@socketio.on("send_message")
-def handle_message(data):
-    # キャンセルフラグをリセット
-    sid = request.sid
-    cancellation_flags[sid] = False
-
-    token = data.get("token")
-    username = get_username_from_token(token)
-    if not username:
-        emit("error", {"message": "認証エラー"})
-        return
-    chat_id = data.get("chat_id")
-    model_name = data.get("model_name")
-    message = data.get("message")
-    grounding_enabled = data.get("grounding_enabled", False)
-    code_execution_enabled = data.get("code_execution_enabled", False)
-    
-    # 既存のファイルデータ形式
-    file_data_base64 = data.get("file_data")
-    file_name = data.get("file_name")
-    file_mime_type = data.get("file_mime_type")
-    # 新しいファイルID形式
-    file_id = data.get("file_id")
-
-    user_dir = get_user_dir(username)
-    messages = load_chat_messages(user_dir, chat_id)
-    gemini_history = load_gemini_history(user_dir, chat_id)
-    chat = client.chats.create(model=model_name, history=gemini_history)
+        return upload_error_response(e)
+    print(f"Gemini File APIアップロード成功: file_id={session.result['file_id']}")
+    return jsonify({
+        "status": "success",
+        "file_id": session.result["file_id"],
+        "file_name": file.filename,
+        "file_mime_type": session.result["file_mime_type"],
+    })
 
-    # 新規チャットの場合、past_chats にタイトルを登録
-    past_chats = load_past_chats(user_dir)
-    if chat_id not in past_chats:
-        chat_title = message[:30]
-        past_chats[chat_id] = {"title": chat_title, "bookmarked": False}
-        save_past_chats(user_dir, past_chats)
-        emit("history_list", {"history": past_chats})
+def build_generate_config(grounding_enabled, code_execution_enabled):
+    if grounding_enabled:
+        return GenerateContentConfig(
+            system_instruction=SYSTEM_INSTRUCTION,
+            tools=[google_search_tool],
+        )
+    elif code_execution_enabled:
+        return GenerateContentConfig(
+            system_instruction=SYSTEM_INSTRUCTION,
+            tools=[code_execution_tool],
+        )
+    return GenerateContentConfig(
+        system_instruction=SYSTEM_INSTRUCTION,
+    )
 
-    # ユーザーのプロンプトを履歴に追加
-    messages.append({
-        "role": "user",
-        "content": message + (f"\n\n[添付ファイル: {file_name}]" if file_name else "")
-    })
-    save_chat_messages(user_dir, chat_id, messages)
-    
-    
+class ResponseCheckpointer:
+    """生成中の応答を溜めつつ、一定間隔で partial としてチャット履歴に書き込む
+
+    キャンセルやプロセスの異常終了が起きても、それまでの出力が load_chat で見え、続きから生成できる。
+    """
+
+    def __init__(self, user_dir, chat_id, message_index, prefix=""):
+        self.user_dir = user_dir
+        self.chat_id = chat_id
+        self.message_index = message_index  # モデル応答を置く st_messages 上の位置
+        self.parts = [prefix] if prefix else []
+        self.unsaved_bytes = 0
+        self.last_saved = time.monotonic()
+
+    def add(self, text):
+        self.parts.append(text)
+        self.unsaved_bytes += len(text)
+        if (self.unsaved_bytes >= CHECKPOINT_BYTES
+                or time.monotonic() - self.last_saved >= CHECKPOINT_INTERVAL):
+            self.save({"partial": True})
+
+    def text(self):
+        return "".join(self.parts)
+
+    def save(self, extra=None):
+        message = {"role": "model", "content": self.text()}
+        if extra:
+            message.update(extra)
+        replace_chat_messages_tail(self.user_dir, self.chat_id, self.message_index, [message])
+        self.unsaved_bytes = 0
+        self.last_saved = time.monotonic()
+
+def generate_response(stream, user_dir, model_name, history, message_content, configs,
+                      message_index, history_keep, turn_contents, prefix_text=""):
+    """ストリーミングで応答を生成し、チャンク送信・途中保存・最終保存まで行う
+
+    stream は open_stream() で登録したもの。終了時に登録を外す。
+
+    history_keep / turn_contents は保存時の Gemini 履歴の形を決める。
+    通常の送信では history をすべて残して [ユーザー発言] の後ろに応答を追加し、
+    続きの生成では末尾の途中までの応答を差し替えて1つの応答にまとめる。
+    """
+    chat_id = stream.chat_id
+    done = {"chat_id": chat_id, "request_id": stream.request_id}
+    emitter = None
+    checkpointer = ResponseCheckpointer(user_dir, chat_id, message_index, prefix_text)
+    model_text = None  # ストリームを最後まで読んだら確定する
+    cache_entry = None
+    ticket = None
+    usage_metadata = None
+    served_model = None  # 実際に応答したモデル (切り替えた場合は model_name と異なる)
     try:
-        # コンテンツの作成方法を分岐
-        if file_id:
-            # File APIを使った大容量ファイル参照
-            file_ref = client.files.get(name=file_id)
-            contents = [file_ref, message]
-        elif file_data_base64:
-            # 既存の小さいファイル処理（base64データ）
-            file_data = base64.b64decode(file_data_base64)
-            file_part = types.Part.from_bytes(data=file_data, mime_type=file_mime_type)
-            contents = [file_part, message]
-        else:
-            # ファイルなしの場合
-            contents = message
-
-        # 以下既存のコード（グラウンディング設定など）
-        if grounding_enabled:
-            configs = GenerateContentConfig(
-                system_instruction=SYSTEM_INSTRUCTION,
-                tools=[google_search_tool],
-            )
-        elif code_execution_enabled:
-            configs = GenerateContentConfig(
-                system_instruction=SYSTEM_INSTRUCTION,
-                tools=[code_execution_tool],
-            )
-        else:
-            configs = GenerateContentConfig(
-                system_instruction=SYSTEM_INSTRUCTION,
-            )
+        # 保存済みのトークン数だけを使って、ポリシーに沿って送る履歴を絞る
+        counts = load_token_counts(user_dir, chat_id, len(history))
+        capabilities = model_catalog.get_capabilities(model_name) or {}
+        policy = resolve_policy(model_name, capabilities.get("input_token_limit"))
+        reserve = estimate_content_tokens(message_content) + CONTEXT_OVERHEAD
+        window, context, layout = build_window(
+            history, counts, policy, reserve=reserve,
+            summary=load_context_summary(user_dir, chat_id) if policy["mode"] == "summary" else None,
+        )
+        done["context"] = context
+
+        # 同時に流すストリームの数とユーザーごとのトークン数の枠が空くまで待つ
+        def notify_position(position, waiting):
+            socketio.emit("queue_position", {
+                "chat_id": chat_id, "request_id": stream.request_id, "position": position, "waiting": waiting,
+            }, to=stream.sid)
+        ticket = upstream_scheduler.acquire(
+            stream.username, model_name, context["tokens_sent"] + reserve,
+            notify=notify_position, cancelled=lambda: stream.cancelled,
+        )
+        if ticket is None:
+            print(f"[stream] canceled while queued chat_id={chat_id} request_id={stream.request_id}")
+            gemini_streams.inc(model=model_name, outcome="cancelled")
+            return
+        # 送る履歴の先頭がキャッシュ済みなら、その後ろだけを送ってキャッシュを参照させる
+        base_configs = configs
+        full_window = window
+        cache_key = config_key(model_name, configs)
+        if CONTEXT_CACHE:
+            cache_entry = context_caches.find(stream.username, chat_id, model_name, cache_key, layout)
+        if cache_entry:
+            window = window[layout_length(cache_entry["layout"]):]
+            configs = cached_config(configs, cache_entry["name"])
+            extend_context_cache(cache_entry)
+
+        def start(attempt_model, first_chunk_timeout):
+            # 切り替え先のモデルの同時実行数で数え直す (枠が空くまで待つ)
+            if not upstream_scheduler.switch(ticket, attempt_model, notify=notify_position,
+                                             cancelled=lambda: stream.cancelled):
+                return None
+            # キャッシュはモデルごとなので、別のモデルに切り替えたときは履歴をすべて送る
+            attempt_window, attempt_configs = (window, configs) if attempt_model == model_name else (full_window, base_configs)
+            chat = client.chats.create(model=attempt_model, history=attempt_window)
+            started = time.perf_counter()
+            response = chat.send_message_stream(message=message_content, config=attempt_configs)
+            chunks = stream.iterate(response, first_chunk_timeout)
+            # 最初のチャンクを受け取るまでに失敗したときだけ送り直す (まだ何もクライアントに送っていない)
+            first = next(chunks, None)
+            if first is not None:
+                gemini_first_chunk_seconds.observe(time.perf_counter() - started, model=attempt_model)
+            return chat, len(attempt_window), chunks, first
 
         # ストリーミング応答開始
-        response = chat.send_message_stream(message=contents, config=configs)
-        full_response = ""
-        usage_metadata = None
+        emitter = ChunkEmitter(stream.sid, chat_id, stream.request_id)
+        served_model, attempt = run_with_failover(model_name, start, stream.sleep)
+        if attempt is None:
+            print(f"[stream] canceled while retrying chat_id={chat_id} request_id={stream.request_id}")
+            gemini_streams.inc(model=model_name, outcome="cancelled")
+            return
+        chat, history_length, chunks, first_chunk = attempt
+        done["model"] = served_model
+        if served_model != model_name:
+            # 切り替え先で応答が始まってから知らせる (失敗した試行のモデルは表示しない)
+            socketio.emit("response_model", {
+                "chat_id": chat_id, "request_id": stream.request_id, "model": served_model, "requested": model_name,
+            }, to=stream.sid)
+        first_chunk_at = time.perf_counter()
+        annotate(model=served_model, chat_id=chat_id, contents=history_length,
+                 cached=bool(cache_entry) and served_model == model_name)
         formatted_metadata = ""
         all_grounding_links = ""
         all_grounding_queries = ""
 
-        for chunk in response:
-            # クライアントがキャンセルをリクエストしたら中断
-            if cancellation_flags.get(sid):
-                print("Streaming canceled by client")
-                break
-
+        for chunk in itertools.chain([first_chunk] if first_chunk is not None else [], chunks):
             if hasattr(chunk, "usage_metadata") and chunk.usage_metadata:
                 usage_metadata = chunk.usage_metadata
 
@@ -532,16 +1255,35 @@ def handle_message(data):
                             all_grounding_queries += f"{query} / "
 
             if chunk_text:
-                full_response += chunk_text
-                emit("gemini_response_chunk", {"chunk": chunk_text, "chat_id": chat_id})
+                checkpointer.add(chunk_text)
+                emitter.add(chunk_text)
+
+        # ここまでがモデル自身の出力 (以降はトークン数などの表示用)
+        model_text = checkpointer.text()
+
+        # キャンセルされた場合は途中までの応答を partial として保存する
+        if stream.cancelled:
+            print(f"[stream] canceled by client chat_id={chat_id} request_id={stream.request_id}")
+            gemini_streams.inc(model=served_model, outcome="cancelled")
+            save_partial_response(user_dir, chat_id, checkpointer, history_keep, turn_contents, model_text,
+                                  new_turn_counts(turn_contents, usage_metadata, context["tokens_sent"], CONTEXT_OVERHEAD))
+            return
+
+        gemini_streams.inc(model=served_model, outcome="completed")
+        output_tokens = usage_metadata.candidates_token_count if usage_metadata else None
+        elapsed = time.perf_counter() - first_chunk_at
+        if output_tokens and elapsed > 0:
+            gemini_tokens_per_second.observe(output_tokens / elapsed, model=served_model)
+        annotate(output_tokens=output_tokens)
 
         # トークン数情報を整形
-        if not cancellation_flags.get(sid):
-            if usage_metadata:
-                formatted_metadata = "\n\n---\n**" + model_name + "**    Token: " + f"{usage_metadata.total_token_count:,}" + "\n\n"
-                full_response += formatted_metadata
-                emit("gemini_response_chunk", {"chunk": formatted_metadata, "chat_id": chat_id})
-                formatted_metadata = ""
+        if usage_metadata:
+            context["cached_tokens"] = usage_metadata.cached_content_token_count or 0
+            formatted_metadata = ("\n\n---\n**" + served_model + "**    Token: " + f"{usage_metadata.total_token_count:,}"
+                                  + "    " + describe_window(context) + "\n\n")
+            checkpointer.parts.append(formatted_metadata)
+            emitter.add(formatted_metadata)
+            formatted_metadata = ""
 
         # グラウンディング情報を整形して送信
         if all_grounding_queries:
@@ -553,33 +1295,306 @@ def handle_message(data):
         if all_grounding_queries:
             formatted_metadata += "\nQuery: " + all_grounding_queries + "\n"
 
-        full_response += formatted_metadata
-        emit("gemini_response_chunk", {"chunk": formatted_metadata, "chat_id": chat_id})
+        checkpointer.parts.append(formatted_metadata)
+        emitter.add(formatted_metadata)
+        emitter.close()
+
+        # 最終的な応答で partial を置き換える
+        checkpointer.save()
+        new_contents = chat._curated_history[history_length:]
+        prefix_tokens = 0
+        if prefix_text and new_contents:
+            # 続きの生成: 途中までの応答と続きを1つのモデル応答にまとめ、「続けて」の指示は残さない
+            model_parts = [types.Part(text=prefix_text)]
+            for content in new_contents[1:]:
+                model_parts.extend(content.parts or [])
+            new_contents = turn_contents + [types.Content(role="model", parts=model_parts)]
+            prefix_tokens = counts[history_keep] if history_keep < len(counts) else None
+        new_counts = new_turn_counts(
+            new_contents, usage_metadata, context["tokens_sent"], CONTEXT_OVERHEAD, prefix_tokens,
+        )
+        replace_gemini_history_tail(user_dir, chat_id, history_keep, new_contents, new_counts)
+        emit("gemini_response_complete", done)
+        if context["needs_summary"] and policy["budget"]:
+            start_summary(user_dir, chat_id, policy)
+        if CONTEXT_CACHE and served_model == model_name:
+            start_context_cache(stream.username, user_dir, chat_id, model_name, base_configs, cache_key, policy, cache_entry)
 
-        # キャンセルされていない場合は最終的な応答を保存
-        if cancellation_flags.get(sid):
+    except Exception as e:
+        gemini_streams.inc(model=served_model or model_name, outcome="error")
+        if served_model and is_retryable(e):
+            # 応答の途中で切れた (送り直しはしない)
+            circuit_breaker.failure(served_model)
+        if emitter is not None:
+            emitter.close()  # 送信待ちのチャンクをエラーより先に届ける
+        if cache_entry:
+            # 期限切れなどでキャッシュが使えなかった可能性があるので、次の送信ではキャッシュなしで送る
+            context_caches.forget(cache_entry["name"])
+        # ストリームの途中で失敗した場合も、それまでの出力は partial として残す
+        if model_text is None and checkpointer.text() != prefix_text:
+            save_partial_response(user_dir, chat_id, checkpointer, history_keep, turn_contents, checkpointer.text())
+        emit("gemini_response_error", dict(done, error=str(e)))
+    finally:
+        if ticket is not None:
+            upstream_scheduler.release(ticket, usage_metadata.total_token_count if usage_metadata else None)
+        if emitter is not None:
+            emitter.close()
+            print(f"[stream] chat_id={chat_id} chunks={emitter.chunks} frames={emitter.frames}")
+        close_stream(stream)
+
+def save_partial_response(user_dir, chat_id, checkpointer, history_keep, turn_contents, model_text, counts=None):
+    """途中までの応答を st_messages と Gemini 履歴の両方に残す
+
+    counts はユーザー発言のトークン数 (わかっていれば)。途中までの応答のトークン数は記録しない。
+    """
+    if not model_text:
+        return
+    replace_gemini_history_tail(
+        user_dir, chat_id, history_keep,
+        turn_contents + [types.Content(role="model", parts=[types.Part(text=model_text)])],
+        (counts or [None] * len(turn_contents))[:len(turn_contents)] + [None],
+    )
+    # history_saved: Gemini 履歴にもこのターンが入っている (続きの生成でそのまま使える)
+    checkpointer.save({"partial": True, "history_saved": True})
+
+def start_summary(user_dir, chat_id, policy):
+    """summary ポリシーで外したターンを含むように、バックグラウンドで要約を作り直す"""
+    key = (user_dir, chat_id)
+    if key in summarizing:
+        return
+    summarizing.add(key)
+    gevent.spawn(update_context_summary, user_dir, chat_id, policy, key)
+
+@traced("context.summary")
+def update_context_summary(user_dir, chat_id, policy, key):
+    try:
+        history = load_gemini_history(user_dir, chat_id)
+        counts = load_token_counts(user_dir, chat_id, len(history))
+        summary = load_context_summary(user_dir, chat_id)
+        cutoff = summary_cutoff(history, counts, policy["budget"])
+        if cutoff <= (summary["covers"] if summary else 0):
+            return
+        model_name = policy["summary_model"] or policy["model"]
+        response = client.models.generate_content(model=model_name, contents=summary_request(history, summary, cutoff))
+        text = response.text
+        if not text:
             return
+        usage = response.usage_metadata
+        # 要約している間に履歴が切り詰められていたら捨てる
+        if len(load_gemini_history(user_dir, chat_id)) < cutoff:
+            return
+        cached_save(context_summary_log(user_dir, chat_id), [{
+            "covers": cutoff,
+            "text": text,
+            "tokens": usage.candidates_token_count if usage else None,
+            "model": model_name,
+            "created": time.time(),
+        }])
+        print(f"[context] summarized chat_id={chat_id} covers={cutoff}/{len(history)}")
+    except Exception as e:
+        print(f"[context] 要約の作成に失敗しました chat_id={chat_id}: {e}")
+    finally:
+        summarizing.discard(key)
 
-        messages.append({"role": "model", "content": full_response})
-        save_chat_messages(user_dir, chat_id, messages)
-        save_gemini_history(user_dir, chat_id, chat._curated_history)
-        emit("gemini_response_complete", {"chat_id": chat_id})
+def start_context_cache(username, user_dir, chat_id, model_name, configs, key, policy, entry):
+    """応答後の履歴でコンテキストキャッシュを作る (キャッシュの後ろに送る分が十分に増えたときだけ)"""
+    job = ("cache", user_dir, chat_id)
+    if job in summarizing or not context_caches.can_create(model_name):
+        return
+    summarizing.add(job)
+    gevent.spawn(update_context_cache, username, user_dir, chat_id, model_name, configs, key, policy, entry, job)
 
+@traced("context.cache")
+def update_context_cache(username, user_dir, chat_id, model_name, configs, key, policy, entry, job):
+    try:
+        history = load_gemini_history(user_dir, chat_id)
+        window, _, layout = build_window(
+            history, load_token_counts(user_dir, chat_id, len(history)), policy,
+            summary=load_context_summary(user_dir, chat_id) if policy["mode"] == "summary" else None,
+        )
+        if not context_caches.needs_rebuild(entry, layout):
+            return
+        cache = context_caches.create(client, model_name, configs, window)
+        if cache is None:
+            return
+        tokens = cache.usage_metadata.total_token_count if cache.usage_metadata else None
+        previous = context_caches.register(username, chat_id, cache, model_name, key, layout, tokens)
+        # 作っている間に履歴が切り詰められていたら、登録したばかりの記録も捨てる
+        name = context_caches.invalidate(username, chat_id, len(load_gemini_history(user_dir, chat_id)))
+        if name:
+            delete_context_cache(name)
+        if previous:
+            delete_context_cache(previous)
+        print(f"[cache] created {cache.name} chat_id={chat_id} contents={len(window)} tokens={tokens}")
     except Exception as e:
-        emit("gemini_response_error", {"error": str(e), "chat_id": chat_id})
+        print(f"[cache] キャッシュの更新に失敗しました chat_id={chat_id}: {e}")
     finally:
-        # 応答処理終了後にキャンセルフラグを削除
-        cancellation_flags.pop(sid, None)
+        summarizing.discard(job)
+
+def extend_context_cache(entry):
+    """残り時間が TTL の半分を切ったキャッシュの期限を延ばす"""
+    if entry["expire_time"] - time.time() >= CONTEXT_CACHE_TTL / 2:
+        return
+    def extend():
+        try:
+            cache = client.caches.update(
+                name=entry["name"], config=types.UpdateCachedContentConfig(ttl=f"{CONTEXT_CACHE_TTL}s"),
+            )
+            context_caches.extend(entry["name"], cache.expire_time.timestamp() if cache.expire_time
+                                  else time.time() + CONTEXT_CACHE_TTL)
+        except Exception as e:
+            print(f"[cache] 期限の延長に失敗しました {entry['name']}: {e}")
+            context_caches.forget(entry["name"])
+    gevent.spawn(extend)
+
+def delete_context_cache(name):
+    try:
+        client.caches.delete(name=name)
+    except Exception as e:
+        print(f"[cache] キャッシュの削除に失敗しました {name}: {e}")
+
+def resolve_file_part(file_id, file_mime_type):
+    """File API のファイルを Part にする
+
+    レジストリに記録があり最近存在を確認したファイルは files.get を省く。
+    確認できなかったファイルはレジストリから外し、再アップロードを促す。
+    """
+    entry = file_registry.get(file_id)
+    if entry and not file_registry.needs_recheck(entry):
+        return types.Part.from_uri(file_uri=entry["file_uri"], mime_type=entry["mime_type"] or file_mime_type)
+    try:
+        file_ref = client.files.get(name=file_id)
+        if file_ref.state == types.FileState.FAILED:
+            raise ValueError(f"ファイルの処理に失敗しています: {file_id}")
+    except Exception:
+        if entry:
+            file_registry.forget(file_id)
+            raise ValueError("添付ファイルの有効期限が切れています。もう一度添付してください。")
+        raise
+    if entry:
+        file_registry.mark_checked(file_ref)
+    return types.Part.from_uri(file_uri=file_ref.uri, mime_type=file_ref.mime_type)
+
+@socket_event("send_message")
+def handle_message(data):
+    token = data.get("token")
+    username = get_username_from_token(token)
+    if not username:
+        emit("error", {"message": "認証エラー"})
+        return
+    chat_id = data.get("chat_id")
+    model_name = data.get("model_name")
+    message = data.get("message")
+    grounding_enabled = data.get("grounding_enabled", False)
+    code_execution_enabled = data.get("code_execution_enabled", False)
+    
+    # 既存のファイルデータ形式
+    file_data_base64 = data.get("file_data")
+    file_name = data.get("file_name")
+    file_mime_type = data.get("file_mime_type")
+    # 新しいファイルID形式
+    file_id = data.get("file_id")
 
-@socketio.on("disconnect")
+    user_dir = get_user_dir(username)
+    gemini_history = load_gemini_history(user_dir, chat_id)
+
+    # 新規チャットの場合は past_chats にタイトルを登録し、既存なら最終更新時刻を進める
+    emit_history_delta(username, touch_chat(user_dir, chat_id, message[:30]))
+
+    # ユーザーのプロンプトを履歴に追加
+    append_chat_messages(user_dir, chat_id, [{
+        "role": "user",
+        "content": message + (f"\n\n[添付ファイル: {file_name}]" if file_name else "")
+    }])
+    message_index = len(load_chat_messages(user_dir, chat_id))
+
+    try:
+        # コンテンツの作成方法を分岐
+        if file_id and file_id.startswith("local/"):
+            # ローカル保存の代替バックエンドでアップロードされたファイル
+            with open(local_file_path(USER_DIR, username, file_id[len("local/"):]), "rb") as f:
+                parts = [types.Part.from_bytes(data=f.read(), mime_type=file_mime_type)]
+        elif file_id:
+            # File APIを使った大容量ファイル参照
+            parts = [resolve_file_part(file_id, file_mime_type)]
+        elif file_data_base64:
+            # 既存の小さいファイル処理（base64データ）
+            file_data = base64.b64decode(file_data_base64)
+            parts = [types.Part.from_bytes(data=file_data, mime_type=file_mime_type)]
+        else:
+            # ファイルなしの場合
+            parts = []
+        if message:
+            parts.append(types.Part(text=message))
+        # 途中で止まったときにも Gemini 履歴へ残せるよう、ユーザー発言は Content にしてから送る
+        user_content = types.Content(role="user", parts=parts)
+        configs = build_generate_config(grounding_enabled, code_execution_enabled)
+    except Exception as e:
+        emit("gemini_response_error", {"error": str(e), "chat_id": chat_id, "request_id": data.get("request_id")})
+        return
+
+    generate_response(
+        open_stream(request.sid, username, chat_id, data.get("request_id")),
+        user_dir, model_name, gemini_history, user_content, configs,
+        message_index=message_index, history_keep=len(gemini_history), turn_contents=[user_content],
+    )
+
+@socket_event("continue_message")
+def handle_continue_message(data):
+    """partial のまま終わった応答の続きを生成する"""
+    token = data.get("token")
+    username = get_username_from_token(token)
+    if not username:
+        emit("error", {"message": "認証エラー"})
+        return
+    chat_id = data.get("chat_id")
+    model_name = data.get("model_name")
+    grounding_enabled = data.get("grounding_enabled", False)
+    code_execution_enabled = data.get("code_execution_enabled", False)
+
+    user_dir = get_user_dir(username)
+    messages = load_chat_messages(user_dir, chat_id)
+    if not messages or messages[-1]["role"] != "model" or not messages[-1].get("partial"):
+        emit("gemini_response_error", {
+            "error": "続きを生成できる応答がありません", "chat_id": chat_id, "request_id": data.get("request_id"),
+        })
+        return
+    partial = messages[-1]
+    gemini_history = load_gemini_history(user_dir, chat_id)
+    if not partial.get("history_saved"):
+        # 生成中にプロセスが落ちた場合は Gemini 履歴にこのターンが無いので、表示用テキストから復元する
+        user_text = messages[-2]["content"] if len(messages) >= 2 else ""
+        restored = [
+            types.Content(role="user", parts=[types.Part(text=user_text or CONTINUE_PROMPT)]),
+            types.Content(role="model", parts=[types.Part(text=partial["content"])]),
+        ]
+        append_gemini_history(user_dir, chat_id, restored)
+        gemini_history = gemini_history + restored
+        history_keep = len(gemini_history) - 1
+    else:
+        # 途中までの応答より後ろに Content が残っていても、その応答までを履歴として続きを頼む
+        history_keep = gemini_offset(user_dir, chat_id, len(messages) - 1)
+        gemini_history = gemini_history[:history_keep + 1]
+    emit_history_delta(username, touch_chat(user_dir, chat_id, partial["content"][:30]))
+
+    generate_response(
+        open_stream(request.sid, username, chat_id, data.get("request_id")),
+        user_dir, model_name, gemini_history,
+        types.Content(role="user", parts=[types.Part(text=CONTINUE_PROMPT)]),
+        build_generate_config(grounding_enabled, code_execution_enabled),
+        message_index=len(messages) - 1, history_keep=history_keep, turn_contents=[],
+        prefix_text=partial["content"],
+    )
+
+@socket_event("disconnect")
 def handle_disconnect():
     """クライアント切断時のクリーンアップ"""
     sid = request.sid
-    # もしキャンセルフラグが残っていれば削除
-    cancellation_flags.pop(sid, None)
+    # 生成中の応答はそのまま最後まで生成して保存する (再接続後に読み込める)
+    sid_sessions.pop(sid, None)
     print(f"[disconnect] sid={sid} cleaned up.")
 
-@socketio.on("delete_message")
+@socket_event("delete_message")
 def handle_delete_message(data):
     token = data.get("token")
     username = get_username_from_token(token)
@@ -590,26 +1605,18 @@ def handle_delete_message(data):
     message_index = data.get("message_index")
 
     user_dir = get_user_dir(username)
-    messages = load_chat_messages(user_dir, chat_id)
-    gemini_history = load_gemini_history(user_dir, chat_id)
 
     if message_index == 0:
-        delete_chat(user_dir, chat_id)
+        emit_history_delta(username, delete_chat(user_dir, chat_id))
     else:
-        deleted_message_role = messages[message_index]["role"]
-        messages = messages[:message_index]
-        target_user_messages = sum(1 for msg in messages if msg["role"] == "user")
-        if deleted_message_role == "model":
-            gemini_index = find_gemini_index(gemini_history, target_user_messages, include_model_responses=False)
-        else:
-            gemini_index = find_gemini_index(gemini_history, target_user_messages, include_model_responses=True)
-        gemini_history = gemini_history[:gemini_index]
-        save_chat_messages(user_dir, chat_id, messages)
-        save_gemini_history(user_dir, chat_id, gemini_history)
+        # 消すメッセージが始まる位置で Gemini 履歴も切り詰める
+        gemini_index = gemini_offset(user_dir, chat_id, message_index)
+        truncate_chat_messages(user_dir, chat_id, message_index)
+        truncate_gemini_history(user_dir, chat_id, gemini_index)
 
     emit("message_deleted", {"index": message_index})
 
-@socketio.on("get_history_list")
+@socket_event("get_history_list")
 def handle_get_history_list(data):
     token = data.get("token")
     username = get_username_from_token(token)
@@ -617,10 +1624,55 @@ def handle_get_history_list(data):
         emit("error", {"message": "認証エラー"})
         return
     user_dir = get_user_dir(username)
-    past_chats = load_past_chats(user_dir)
-    emit("history_list", {"history": past_chats})
+    index = load_history_index(user_dir)
+    # 前回受け取ったリビジョンを if_newer_than に渡されたら、その後の差分だけを返す
+    if_newer_than = data.get("if_newer_than")
+    if isinstance(if_newer_than, int):
+        delta = changes_since(index, if_newer_than)
+        if delta is not None:
+            emit("history_delta", delta)
+            return
+    offset = max(0, int(data.get("offset") or 0))
+    limit = max(1, min(int(data.get("limit") or HISTORY_PAGE_SIZE), HISTORY_PAGE_MAX))
+    emit("history_list", {
+        "revision": index["revision"],
+        "items": history_page(index, offset, limit),
+        "offset": offset,
+        "limit": limit,
+        "total": len(index["chats"]),
+    })
+
+@socket_event("search_chats")
+def handle_search_chats(data):
+    """チャット履歴を全文検索し、関連度順のスニペットを返す"""
+    token = data.get("token")
+    username = get_username_from_token(token)
+    if not username:
+        emit("error", {"message": "認証エラー"})
+        return
+    query = (data.get("query") or "").strip()
+    limit = max(1, min(int(data.get("limit") or SEARCH_RESULT_LIMIT), SEARCH_RESULT_MAX))
+    user_dir = get_user_dir(username)
+    started = time.perf_counter()
+    index = SearchIndex(user_dir)
+    try:
+        if not index.is_built():
+            # インデックス導入前からあるチャットは最初の検索時に取り込む (キャッシュは経由しない)
+            index.build(list_chat_ids(user_dir), lambda chat_id: chat_messages_log(user_dir, chat_id).read_all())
+        results = index.search(query, limit, data.get("chat_id"))
+    except Exception as e:
+        emit("search_results", {"query": query, "results": [], "error": str(e)})
+        return
+    chats = load_history_index(user_dir)["chats"]
+    for result in results:
+        result["title"] = chats.get(result["chat_id"], {}).get("title", "")
+    emit("search_results", {
+        "query": query,
+        "results": results,
+        "took_ms": round((time.perf_counter() - started) * 1000, 1),
+    })
 
-@socketio.on("load_chat")
+@socket_event("load_chat")
 def handle_load_chat(data):
     token = data.get("token")
     username = get_username_from_token(token)
@@ -632,7 +1684,29 @@ def handle_load_chat(data):
     messages = load_chat_messages(user_dir, chat_id)
     emit("chat_loaded", {"messages": messages, "chat_id": chat_id})
 
-@socketio.on("new_chat")
+@socket_event("load_chat_page")
+def handle_load_chat_page(data):
+    """チャットの末尾から1ページ分だけ返す。before に前回の cursor を渡すとそれより前のページを返す"""
+    token = data.get("token")
+    username = get_username_from_token(token)
+    if not username:
+        emit("error", {"message": "認証エラー"})
+        return
+    chat_id = data.get("chat_id")
+    before = data.get("before")
+    limit = max(1, min(int(data.get("limit") or CHAT_PAGE_SIZE), CHAT_PAGE_MAX))
+    user_dir = get_user_dir(username)
+    messages, start, total = load_chat_messages_page(user_dir, chat_id, limit, before)
+    emit("chat_page", {
+        "chat_id": chat_id,
+        "messages": messages,
+        "start": start,  # messages[0] のメッセージ番号 (delete_message などで使う)
+        "total": total,
+        "before": before,
+        "cursor": start if start > 0 else None,  # より前のページを読むときに before に渡す値
+    })
+
+@socket_event("new_chat")
 def handle_new_chat(data):
     token = data.get("token")
     username = get_username_from_token(token)
@@ -642,7 +1716,7 @@ def handle_new_chat(data):
     new_chat_id = f"{time.time()}"
     emit("chat_created", {"chat_id": new_chat_id})
 
-@socketio.on("delete_chat")
+@socket_event("delete_chat")
 def handle_delete_chat(data):
     token = data.get("token")
     username = get_username_from_token(token)
@@ -651,10 +1725,11 @@ def handle_delete_chat(data):
         return
     chat_id = data.get("chat_id")
     user_dir = get_user_dir(username)
-    delete_chat(user_dir, chat_id)
+    delta = delete_chat(user_dir, chat_id)
     emit("chat_deleted", {"chat_id": chat_id})
+    emit_history_delta(username, delta)
 
-@socketio.on("rename_chat")
+@socket_event("rename_chat")
 def handle_rename_chat(data):
     token = data.get("token")
     username = get_username_from_token(token)
@@ -665,16 +1740,18 @@ def handle_rename_chat(data):
     new_title = data.get("new_title")
     
     user_dir = get_user_dir(username)
-    past_chats = load_past_chats(user_dir)
-    
-    if chat_id in past_chats:
-        past_chats[chat_id]["title"] = new_title
-        save_past_chats(user_dir, past_chats)
+    def rename(past_chats):
+        if chat_id in past_chats:
+            past_chats[chat_id]["title"] = new_title
+    delta = update_past_chats(user_dir, rename)
+
+    if delta:
         emit("chat_renamed", {"chat_id": chat_id, "new_title": new_title})
-        emit("history_list", {"history": past_chats})
+        # 他のタブ (別のワーカーに接続していても) の一覧も更新する
+        emit_history_delta(username, delta)
 
 # ブックマーク切り替え用のSocketIOイベント
-@socketio.on("toggle_bookmark")
+@socket_event("toggle_bookmark")
 def handle_toggle_bookmark(data):
     token = data.get("token")
     username = get_username_from_token(token)
@@ -684,22 +1761,74 @@ def handle_toggle_bookmark(data):
     chat_id = data.get("chat_id")
     
     user_dir = get_user_dir(username)
-    past_chats = load_past_chats(user_dir)
-    
-    if chat_id in past_chats:
-        past_chats[chat_id]["bookmarked"] = not past_chats[chat_id].get("bookmarked", False)
-        save_past_chats(user_dir, past_chats)
+    def toggle(past_chats):
+        if chat_id in past_chats:
+            past_chats[chat_id]["bookmarked"] = not past_chats[chat_id].get("bookmarked", False)
+    delta = update_past_chats(user_dir, toggle)
+
+    if delta:
         emit("bookmark_toggled", {
             "chat_id": chat_id, 
-            "bookmarked": past_chats[chat_id]["bookmarked"]
+            "bookmarked": delta["upserts"][0]["bookmarked"]
         })
-        emit("history_list", {"history": past_chats})
+        emit_history_delta(username, delta)
+
+# ------------------------
+# 定期的な掃除 (file_sweeper.py)
+# ------------------------
+# FILE_SWEEP_INTERVAL 秒ごとに行う (0 なら行わない)。複数ワーカー構成では 1 つのワーカーだけで有効にする
+FILE_SWEEP_INTERVAL = float(os.environ.get("FILE_SWEEP_INTERVAL", 0))
+# 作成からこの秒数が経っていない File API のファイルは消さない (添付してまだ送っていないファイルを残すため)
+FILE_SWEEP_MIN_AGE = float(os.environ.get("FILE_SWEEP_MIN_AGE", 6 * 60 * 60))
+FILE_SWEEP_WORKERS = int(os.environ.get("FILE_SWEEP_WORKERS", 4))
+FILE_SWEEP_RATE = float(os.environ.get("FILE_SWEEP_RATE", 5))  # 1 秒あたりの削除リクエスト数
+# data/<user>/tmp_* と書きかけのアップロードを消すまでの時間
+LOCAL_TMP_MAX_AGE = float(os.environ.get("LOCAL_TMP_MAX_AGE", UPLOAD_SESSION_TTL))
+
+swept_files = counter("file_sweeper_removed_total", "定期的な掃除で消したファイルや記録の数", ("kind",))
+
+@traced("file_sweeper")
+def sweep_files():
+    """チャット履歴から参照されていない古い File API のファイル、ローカルの一時ファイル、期限切れの記録を消す"""
+    removed = sweep_local_files(USER_DIR, LOCAL_TMP_MAX_AGE)
+    pruned = file_registry.prune() + context_caches.prune()
+    deleted = failed = 0
+    if UPLOAD_BACKEND != "local":
+        # 読めない履歴があれば例外になり、参照を見落としたまま消すことはない
+        keep = referenced_file_ids(USER_DIR, chat_db)
+        files = select_files(client.files.list(), older_than=FILE_SWEEP_MIN_AGE, keep=keep)
+        deleted, failed = delete_remote_files(
+            client, files, workers=FILE_SWEEP_WORKERS, rate=FILE_SWEEP_RATE, registry=file_registry,
+        )
+    swept_files.inc(removed, kind="local")
+    swept_files.inc(pruned, kind="record")
+    swept_files.inc(deleted, kind="remote")
+    print(f"[sweeper] remote={deleted} (failed={failed}) local={removed} records={pruned}")
+
+def run_file_sweeper():
+    while True:
+        gevent.sleep(FILE_SWEEP_INTERVAL)
+        try:
+            sweep_files()
+        except Exception as e:
+            print(f"[sweeper] 掃除に失敗しました: {e}")
+
 # -----------------------------------------------------------
 # 6) メイン実行
 # -----------------------------------------------------------
 if __name__ == "__main__":
     # SQLite初期化
     init_db()
+    model_catalog.start()
+    shared_state.start()
+    if FILE_SWEEP_INTERVAL > 0:
+        gevent.spawn(run_file_sweeper)
 
     # geventベースでサーバ起動（geventインストール済みの場合に自動で使用）
-    socketio.run(app, debug=True, host="0.0.0.0", port=5000)
+    # 複数ワーカーを起動する場合は PORT をずらし、DEBUG=0 でリローダーを止める
+    socketio.run(
+        app,
+        debug=os.environ.get("DEBUG", "1") == "1",
+        host=os.environ.get("HOST", "0.0.0.0"),
+        port=int(os.environ.get("PORT", 5000)),
+    )
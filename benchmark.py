@@ -0,0 +1,567 @@
+"""負荷試験とストレージのマイクロベンチマーク
+
+Gemini API の代わりに決まった時間でチャンクを返す疑似クライアント (FakeClient) を使うので、
+API キーも通信も不要で、同じ設定なら同じ負荷を再現できる。
+
+    pip install "python-socketio[client]"
+    python benchmark.py load --clients 50 --rounds 5      # 50 接続で送信・読み込み・削除を繰り返す
+    python benchmark.py load --chunks 200 --chunk-delay 0.005 --error-every 10
+    python benchmark.py cache --rounds 8                  # コンテキストキャッシュあり/なしで最初のチャンクまでの時間を比べる
+    python benchmark.py storage --sizes 10 100 1000 5000  # チャット履歴の読み書きをチャットの大きさごとに測る
+
+load / cache は app.py を疑似クライアントに差し替えた別プロセスとして起動し、Socket.IO クライアントを
+N 個つないで auto_login → (send_message → load_chat → ときどき delete_message) を繰り返す。
+最初のチャンクまでの時間・チャンク/秒・イベントごとの応答時間 (p50/p99)・1 接続あたりのメモリを表示する。
+メモリはサーバープロセスの RSS (/proc/<pid>/status) の増分なので Linux でだけ表示する。
+"""
+import os
+import sys
+import json
+import time
+import socket
+import tempfile
+import argparse
+import threading
+import subprocess
+import statistics
+import unicodedata
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+FAKE_MODEL = "models/fake"
+# 疑似クライアントが返すチャンクの目印 (受け取ったテキストからチャンク数を数える)
+CHUNK_MARK = "\u2060"  # 幅のない文字 (WORD JOINER)
+
+
+# -----------------------------------------------------------
+# 疑似 genai.Client (サーバープロセス側で使う)
+# -----------------------------------------------------------
+class FakeSettings:
+    """疑似クライアントの動作。BENCH_FAKE (JSON) で渡す"""
+
+    def __init__(self, chunks=20, chunk_delay=0.01, first_delay=0.05, prefill_us=0.0,
+                 tokens_per_chunk=8, error_every=0):
+        self.chunks = chunks  # 1 回の応答のチャンク数
+        self.chunk_delay = chunk_delay  # チャンクの間隔 (秒)
+        self.first_delay = first_delay  # 最初のチャンクまでの固定の待ち時間 (秒)
+        self.prefill_us = prefill_us  # キャッシュされていないプロンプト 1 トークンあたりの追加の待ち時間 (マイクロ秒)
+        self.tokens_per_chunk = tokens_per_chunk
+        self.error_every = error_every  # n 回に 1 回、最初のチャンクの前にエラーにする (0 なら常に成功)
+
+
+def install_fake_client(settings):
+    """google.genai.Client を疑似クライアントに置き換える (app.py を読み込む前に呼ぶ)"""
+    from google import genai
+    from google.genai import types, chats
+    from token_counter import estimate_text_tokens
+
+    def count_tokens(contents):
+        total = 0
+        for content in contents:
+            for part in content.parts or []:
+                if part.text:
+                    total += estimate_text_tokens(part.text.encode("utf-8"))
+                elif part.inline_data is not None:
+                    total += len(part.inline_data.data or b"") // 4
+                else:
+                    total += 258
+        return total
+
+    class FakeCaches:
+        def __init__(self):
+            self.tokens = {}
+            self.lock = threading.Lock()
+
+        def create(self, model, config):
+            with self.lock:
+                name = f"cachedContents/fake-{len(self.tokens)}"
+                tokens = count_tokens(config.contents or [])
+                self.tokens[name] = tokens
+            return types.CachedContent(
+                name=name, model=model, expire_time=expire_after(config.ttl),
+                usage_metadata=types.CachedContentUsageMetadata(total_token_count=tokens),
+            )
+
+        def update(self, name, config):
+            return types.CachedContent(name=name, expire_time=expire_after(config.ttl))
+
+        def delete(self, name):
+            self.tokens.pop(name, None)
+
+    class FakeModels:
+        _api_client = None
+
+        def __init__(self, caches):
+            self.caches = caches
+            self.calls = 0
+            self.lock = threading.Lock()
+
+        def generate_content_stream(self, model, contents, config=None):
+            with self.lock:
+                self.calls += 1
+                call = self.calls
+            prompt = count_tokens(contents)
+            cached = self.caches.tokens.get(config.cached_content, 0) if config and config.cached_content else 0
+            time.sleep(settings.first_delay + (prompt - cached) * settings.prefill_us / 1e6)
+            if settings.error_every and call % settings.error_every == 0:
+                raise RuntimeError(f"fake upstream error (call {call})")
+            for i in range(settings.chunks):
+                if i:
+                    time.sleep(settings.chunk_delay)
+                last = i == settings.chunks - 1
+                yield types.GenerateContentResponse(
+                    candidates=[types.Candidate(
+                        content=types.Content(role="model", parts=[types.Part(text=f"{CHUNK_MARK}c{i} ")]),
+                        finish_reason="STOP" if last else None,
+                    )],
+                    usage_metadata=types.GenerateContentResponseUsageMetadata(
+                        prompt_token_count=prompt + cached,
+                        cached_content_token_count=cached or None,
+                        candidates_token_count=settings.tokens_per_chunk * (i + 1),
+                        total_token_count=prompt + cached + settings.tokens_per_chunk * (i + 1),
+                    ),
+                )
+
+        def generate_content(self, model, contents, config=None):
+            time.sleep(settings.first_delay)
+            return types.GenerateContentResponse(
+                candidates=[types.Candidate(content=types.Content(role="model", parts=[types.Part(text="summary")]))],
+                usage_metadata=types.GenerateContentResponseUsageMetadata(candidates_token_count=4),
+            )
+
+        def count_tokens(self, model, contents):
+            return types.CountTokensResponse(total_tokens=count_tokens(contents))
+
+        def list(self):
+            return [types.Model(
+                name=FAKE_MODEL, display_name="Fake", input_token_limit=1_000_000, output_token_limit=8192,
+                supported_actions=["generateContent", "countTokens"],
+            )]
+
+    class FakeFiles:
+        def get(self, name):
+            return types.File(name=name, uri=f"https://example.invalid/{name}", mime_type="application/pdf",
+                              state=types.FileState.ACTIVE)
+
+    class FakeClient:
+        def __init__(self, *args, **kwargs):
+            self.caches = FakeCaches()
+            self.models = FakeModels(self.caches)
+            self.chats = chats.Chats(self.models)
+            self.files = FakeFiles()
+
+    genai.Client = FakeClient
+
+
+def expire_after(ttl):
+    import datetime
+    seconds = float(str(ttl or "600s").rstrip("s"))
+    return datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=seconds)
+
+
+def serve():
+    """疑似クライアントに差し替えて app.py を起動する (load / cache から子プロセスとして呼ぶ)"""
+    from gevent import monkey
+    monkey.patch_all()
+    import runpy
+    sys.path.insert(0, os.path.dirname(APP_PATH))
+    install_fake_client(FakeSettings(**json.loads(os.environ.get("BENCH_FAKE", "{}"))))
+    runpy.run_path(APP_PATH, run_name="__main__")
+
+
+# -----------------------------------------------------------
+# 負荷試験 (クライアント側)
+# -----------------------------------------------------------
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def server_rss(pid):
+    """サーバープロセスの RSS (バイト)。読めなければ None"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def start_server(data_dir, fake, extra_env=None):
+    import requests
+    port = free_port()
+    env = dict(
+        os.environ, GOOGLE_API_KEY="dummy", VERSION="bench", PORT=str(port), HOST="127.0.0.1", DEBUG="0",
+        BCRYPT_ROUNDS="4", MODELS=FAKE_MODEL, BENCH_FAKE=json.dumps(vars(fake)), **(extra_env or {}),
+    )
+    process = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "serve"], cwd=data_dir, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(150):
+        if process.poll() is not None:
+            raise RuntimeError("サーバーが起動できませんでした")
+        try:
+            requests.get(url, timeout=1)
+            return process, url
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("サーバーが応答しません")
+
+
+class SimClient:
+    """Socket.IO で接続する 1 つの疑似ブラウザ。受け取ったイベントを時刻付きで記録する"""
+
+    def __init__(self, url):
+        import socketio
+        self.events = []
+        self.cond = threading.Condition()
+        self.client = socketio.Client(reconnection=False)
+        self.client.on("*", self._record)
+        self.client.connect(url, transports=["websocket"])
+
+    def _record(self, event, data=None):
+        with self.cond:
+            self.events.append((event, data, time.perf_counter()))
+            self.cond.notify_all()
+
+    def wait(self, events, start, match=lambda data: True, timeout=60):
+        """start 番目以降に届いた events のいずれかを (イベント名, データ, 受信時刻) で返す"""
+        deadline = time.perf_counter() + timeout
+        with self.cond:
+            while True:
+                for event, data, at in self.events[start:]:
+                    if event in events and match(data):
+                        return event, data, at
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    raise TimeoutError(f"{events} が届きません")
+                self.cond.wait(remaining)
+
+    def call(self, event, data, reply):
+        """(応答時間 [秒], 応答のデータ)"""
+        start = len(self.events)
+        sent = time.perf_counter()
+        self.client.emit(event, data)
+        _, received, at = self.wait((reply,), start)
+        return at - sent, received
+
+    def send_message(self, data):
+        """(最初のチャンクまでの時間, 完了までの時間, 受け取ったチャンク数, エラーかどうか)"""
+        start = len(self.events)
+        sent = time.perf_counter()
+        self.client.emit("send_message", data)
+        is_ours = lambda d: d.get("request_id") == data["request_id"]
+        event, _, first_at = self.wait(("gemini_response_chunk", "gemini_response_error"), start, is_ours)
+        event, _, done_at = self.wait(("gemini_response_complete", "gemini_response_error"), start, is_ours)
+        with self.cond:
+            chunks = sum(
+                d["chunk"].count(CHUNK_MARK) for name, d, _ in self.events[start:]
+                if name == "gemini_response_chunk" and is_ours(d)
+            )
+        ttfc = first_at - sent if chunks else None
+        return ttfc, done_at - sent, chunks, event == "gemini_response_error"
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values) + 0.5)) - 1))]
+
+
+def run_load(url, pid, args):
+    """クライアントを args.clients 個つないでシナリオを流し、計測結果を dict で返す"""
+    setup = SimClient(url)
+    tokens = []
+    for i in range(args.clients):
+        username = f"bench{i}"
+        setup.call("register", {"username": username, "password": "pw"}, "register_response")
+        _, reply = setup.call("login", {"username": username, "password": "pw"}, "login_response")
+        tokens.append(reply["auto_login_token"])
+    setup.client.disconnect()
+
+    time.sleep(0.5)
+    rss_before = server_rss(pid)
+    clients = [SimClient(url) for _ in range(args.clients)]
+    latencies = {"auto_login": [], "load_chat": [], "delete_message": [], "send_message": []}
+    ttfc = {}  # ラウンド → 最初のチャンクまでの時間
+    stream_chunks = 0
+    stream_seconds = 0.0
+    errors = 0
+    lock = threading.Lock()
+    for client, token in zip(clients, tokens):
+        latency, _ = client.call("auto_login", {"token": token}, "auto_login_response")
+        latencies["auto_login"].append(latency)
+    time.sleep(0.5)
+    rss_after = server_rss(pid)
+    message = ("ベンチマーク用のメッセージです。" * (args.message_chars // 16 + 1))[:args.message_chars]
+
+    def scenario(index, client, token):
+        nonlocal stream_chunks, stream_seconds, errors
+        chat_id = f"{time.time():.6f}-{index}"
+        for round_ in range(args.rounds):
+            first, total, chunks, failed = client.send_message({
+                "token": token, "chat_id": chat_id, "model_name": FAKE_MODEL,
+                "message": f"{round_}: {message}", "request_id": f"{index}-{round_}",
+            })
+            latency, loaded = client.call("load_chat", {"token": token, "chat_id": chat_id}, "chat_loaded")
+            deleted = None
+            if args.delete_every and (round_ + 1) % args.delete_every == 0 and len(loaded["messages"]) > 1:
+                # 最後のモデルの応答を消す (次の送信で Gemini 履歴の切り詰めと書き直しが起きる)
+                deleted, _ = client.call("delete_message", {
+                    "token": token, "chat_id": chat_id, "message_index": len(loaded["messages"]) - 1,
+                }, "message_deleted")
+            with lock:
+                latencies["send_message"].append(total)
+                latencies["load_chat"].append(latency)
+                if deleted is not None:
+                    latencies["delete_message"].append(deleted)
+                if failed:
+                    errors += 1
+                if first is not None:
+                    ttfc.setdefault(round_, []).append(first)
+                    stream_chunks += chunks
+                    stream_seconds += total - first
+
+    started = time.perf_counter()
+    threads = [
+        threading.Thread(target=scenario, args=(i, client, token))
+        for i, (client, token) in enumerate(zip(clients, tokens))
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    for client in clients:
+        client.client.disconnect()
+    return {
+        "elapsed": elapsed,
+        "latencies": latencies,
+        "ttfc": ttfc,
+        "chunks_per_second": stream_chunks / stream_seconds if stream_seconds else None,
+        "errors": errors,
+        "rss_before": rss_before,
+        "rss_after": rss_after,
+    }
+
+
+def pad(text, width):
+    """全角文字を 2 桁として width 桁になるよう右を空白で埋める"""
+    used = sum(2 if unicodedata.east_asian_width(ch) in "WF" else 1 for ch in text)
+    return text + " " * max(1, width - used)
+
+
+def ms(value):
+    return f"{value * 1000:8.1f}" if value is not None else "       -"
+
+
+def print_load_report(result, args):
+    print(f"\n=== {args.clients} クライアント × {args.rounds} ラウンド ({result['elapsed']:.1f} 秒) ===")
+    print(pad("イベント", 16) + "  件数   p50[ms]   p99[ms]  平均[ms]")
+    rows = dict(result["latencies"])
+    rows["最初のチャンク"] = [value for values in result["ttfc"].values() for value in values]
+    for event, values in rows.items():
+        mean = statistics.fmean(values) if values else None
+        print(f"{pad(event, 16)}{len(values):>6}  {ms(percentile(values, 50))}  {ms(percentile(values, 99))}  {ms(mean)}")
+    if result["chunks_per_second"]:
+        print(f"チャンク/秒 (1 ストリームあたり): {result['chunks_per_second']:.1f}")
+    print(f"エラー: {result['errors']}")
+    if result["rss_before"] and result["rss_after"]:
+        per_connection = (result["rss_after"] - result["rss_before"]) / args.clients
+        print(f"サーバーの RSS: {result['rss_after'] / 2**20:.1f} MiB "
+              f"(1 接続あたり {per_connection / 1024:.1f} KiB)")
+
+
+def fake_settings(args):
+    return FakeSettings(
+        chunks=args.chunks, chunk_delay=args.chunk_delay, first_delay=args.first_delay,
+        prefill_us=args.prefill_us, tokens_per_chunk=args.tokens_per_chunk, error_every=args.error_every,
+    )
+
+
+def command_load(args):
+    with tempfile.TemporaryDirectory() as data_dir:
+        process, url = start_server(data_dir, fake_settings(args), {"CONTEXT_CACHE": "1" if args.context_cache else "0"})
+        try:
+            result = run_load(url, process.pid, args)
+        finally:
+            process.terminate()
+            process.wait(timeout=10)
+    print_load_report(result, args)
+
+
+def command_cache(args):
+    """コンテキストキャッシュの有無で、ラウンドごとの最初のチャンクまでの時間を比べる"""
+    results = {}
+    for enabled in (False, True):
+        with tempfile.TemporaryDirectory() as data_dir:
+            process, url = start_server(data_dir, fake_settings(args), {
+                "CONTEXT_CACHE": "1" if enabled else "0",
+                "CONTEXT_CACHE_MIN_TOKENS": str(args.cache_min_tokens),
+                "CONTEXT_CACHE_REBUILD_TOKENS": str(args.cache_min_tokens),
+            })
+            try:
+                results[enabled] = run_load(url, process.pid, args)
+            finally:
+                process.terminate()
+                process.wait(timeout=10)
+    print(f"\n=== 最初のチャンクまでの時間 p50 [ms] (プロンプト 1 トークンあたり {args.prefill_us} µs) ===")
+    print(pad("ラウンド", 10) + "キャッシュなし  キャッシュあり")
+    for round_ in range(args.rounds):
+        off = percentile(results[False]["ttfc"].get(round_, []), 50)
+        on = percentile(results[True]["ttfc"].get(round_, []), 50)
+        print(f"{round_:<10}    {ms(off)}        {ms(on)}")
+
+
+# -----------------------------------------------------------
+# ストレージのマイクロベンチマーク
+# -----------------------------------------------------------
+def timed(func, repeat):
+    """repeat 回実行したうちの中央値 (秒)"""
+    values = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        values.append(time.perf_counter() - started)
+    return statistics.median(values)
+
+
+def storage_cases(open_log, open_document, user_dir, size, repeat):
+    """チャットの大きさ size のときの各操作の時間を [(名前, 秒)] で返す"""
+    from google.genai import types
+    from chat_store import (
+        chat_cache, cached_read, cached_read_page, cached_append, cached_truncate, cached_replace_tail,
+        cached_document_read, cached_document_update,
+    )
+    from history_index import upgrade_index, apply_changes
+    from search_index import SearchIndex
+
+    text = "ストレージのベンチマーク用の本文です。" * 20
+    messages = [{"role": "user" if i % 2 == 0 else "model", "content": f"{i} {text}"} for i in range(size)]
+    contents = [
+        types.Content(role=message["role"], parts=[types.Part(text=message["content"])]) for message in messages
+    ]
+    chat_id = f"bench{size}"
+    st_log = open_log(os.path.join(user_dir, f"{chat_id}-st_messages"))
+    gemini_log = open_log(os.path.join(user_dir, f"{chat_id}-gemini_messages"))
+    cached_append(st_log, messages)
+    cached_append(gemini_log, contents)
+    document = open_document(os.path.join(user_dir, "past_chats_list"), upgrade_index)
+
+    def cold(log, read):
+        def run():
+            chat_cache.invalidate(log.path)
+            read(log)
+        return run
+
+    def append_and_drop():
+        cached_append(st_log, [{"role": "user", "content": text}])
+        cached_truncate(st_log, size)
+
+    def gemini_append_and_drop():
+        cached_append(gemini_log, [contents[0]])
+        cached_truncate(gemini_log, size)
+
+    def rename_chat():
+        def mutate(index):
+            chats = {chat_id: dict(info) for chat_id, info in index["chats"].items()}
+            chats.setdefault("0", {"title": "", "bookmarked": False})["title"] = str(time.perf_counter())
+            return apply_changes(index, chats)[0]
+        cached_document_update(document, mutate)
+
+    cached_document_update(document, lambda index: apply_changes(index, {
+        str(i): {"title": f"chat {i}", "bookmarked": False} for i in range(size)
+    })[0])
+    index = SearchIndex(user_dir)
+    index.replace_tail(chat_id, 0, messages)
+    cached_read(st_log)
+    cached_read(gemini_log)
+    return [
+        ("st_messages 全件 (キャッシュ)", timed(lambda: cached_read(st_log), repeat)),
+        ("st_messages 全件 (ディスク)", timed(cold(st_log, cached_read), repeat)),
+        ("st_messages 最新30件 (ディスク)", timed(cold(st_log, lambda log: cached_read_page(log, 30)), repeat)),
+        ("gemini 全件 (ディスク)", timed(cold(gemini_log, cached_read), repeat)),
+        ("st_messages 1件追記+切り詰め", timed(append_and_drop, repeat)),
+        ("gemini 1件追記+切り詰め", timed(gemini_append_and_drop, repeat)),
+        ("st_messages 末尾1件の差し替え", timed(lambda: cached_replace_tail(st_log, size - 1, messages[-1:]), repeat)),
+        ("チャット一覧 (キャッシュ)", timed(lambda: cached_document_read(document), repeat)),
+        ("チャット一覧の名前変更", timed(rename_chat, repeat)),
+        ("検索インデックス 1件更新", timed(lambda: index.replace_tail(chat_id, size - 1, messages[-1:]), repeat)),
+        ("検索 (2 語)", timed(lambda: index.search("ベンチマーク 本文"), repeat)),
+    ]
+
+
+def command_storage(args):
+    from chat_store import ChatLog, FileDocument
+    from consolidated_store import ConsolidatedStore
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        store = ConsolidatedStore(os.path.join(data_dir, "chat_store.db"))
+        store.init_db()
+        backends = {
+            "files": (ChatLog, FileDocument),
+            "db": (store.open_log, store.open_document),
+        }
+        results = {}
+        names = {}
+        for backend in args.backends:
+            open_log, open_document = backends[backend]
+            for size in args.sizes:
+                user_dir = os.path.join(data_dir, f"{backend}{size}")
+                os.makedirs(user_dir)
+                for name, seconds in storage_cases(open_log, open_document, user_dir, size, args.repeat):
+                    results[(backend, name, size)] = seconds
+                    if name not in names.setdefault(backend, []):
+                        names[backend].append(name)
+
+    for backend in args.backends:
+        print(f"\n=== CHAT_STORE={backend} (中央値 [ms], {args.repeat} 回) ===")
+        print(pad("操作", 34) + "".join(f"{size:>10}" for size in args.sizes))
+        for name in names[backend]:
+            print(pad(name, 34) + "".join(f"{results[(backend, name, size)] * 1000:>10.2f}" for size in args.sizes))
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "serve":
+        serve()
+        return
+    parser = argparse.ArgumentParser(description="負荷試験とストレージのベンチマーク")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    def add_load_arguments(command, rounds, message_chars, prefill_us):
+        command.add_argument("--clients", type=int, default=20, help="同時に接続するクライアント数")
+        command.add_argument("--rounds", type=int, default=rounds, help="1 クライアントあたりの送信回数")
+        command.add_argument("--delete-every", type=int, default=3, help="n ラウンドごとに最後の応答を削除する (0 で削除しない)")
+        command.add_argument("--message-chars", type=int, default=message_chars, help="送信するメッセージの文字数")
+        command.add_argument("--chunks", type=int, default=20, help="1 回の応答のチャンク数")
+        command.add_argument("--chunk-delay", type=float, default=0.01, help="チャンクの間隔 (秒)")
+        command.add_argument("--first-delay", type=float, default=0.05, help="最初のチャンクまでの固定の待ち時間 (秒)")
+        command.add_argument("--prefill-us", type=float, default=prefill_us,
+                             help="キャッシュされていないプロンプト 1 トークンあたりの追加の待ち時間 (µs)")
+        command.add_argument("--tokens-per-chunk", type=int, default=8, help="1 チャンクあたりのトークン数")
+        command.add_argument("--error-every", type=int, default=0, help="n 回に 1 回の生成をエラーにする")
+
+    load = commands.add_parser("load", help="Socket.IO クライアントをつないで負荷をかける")
+    add_load_arguments(load, rounds=5, message_chars=200, prefill_us=20.0)
+    load.add_argument("--context-cache", action="store_true", help="コンテキストキャッシュを有効にする")
+    cache = commands.add_parser("cache", help="コンテキストキャッシュの有無で最初のチャンクまでの時間を比べる")
+    add_load_arguments(cache, rounds=8, message_chars=4000, prefill_us=50.0)
+    cache.add_argument("--cache-min-tokens", type=int, default=4096, help="キャッシュを作る最小のトークン数")
+    storage = commands.add_parser("storage", help="チャット履歴の読み書きの時間をチャットの大きさごとに測る")
+    storage.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000], help="チャットのメッセージ数")
+    storage.add_argument("--repeat", type=int, default=20, help="各操作の繰り返し回数")
+    storage.add_argument("--backends", nargs="+", choices=["files", "db"], default=["files", "db"])
+    args = parser.parse_args()
+    if args.command == "cache":
+        args.delete_every = 0  # 削除するとキャッシュを作り直すので比べられない
+    {"load": command_load, "cache": command_cache, "storage": command_storage}[args.command](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,506 @@
+# -----------------------------------------------------------
+# チャット履歴の追記型ストレージ
+# -----------------------------------------------------------
+# 1チャット1種別 (st_messages / gemini_messages) ごとに以下のファイルを持つ
+#   <name>.log  : レコード(pickle)を追記していくだけのデータ本体
+#   <name>.idx  : 生きているレコードの位置 (offset, length, crc32) を16バイトずつ並べた索引
+#   <name>.lock : 従来どおり FileLock 用
+# 切り詰めは索引を縮めるだけで、本体に残った不要領域は一定量を超えたら compaction で詰める。
+# 旧形式 (joblib で list 全体を dump した <name>) は初回アクセス時に変換する。
+import os
+import pickle
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+
+from filelock import FileLock
+
+from metrics import timed_lock, timed_joblib_load, timed_joblib_dump
+
+INDEX_ENTRY = struct.Struct("<QII")
+
+# 不要領域がこのバイト数と生存データ量の両方を超えたら compaction する
+COMPACT_MIN_BYTES = int(os.environ.get("CHAT_LOG_COMPACT_MIN_BYTES", 1024 * 1024))
+COMPACT_RATIO = float(os.environ.get("CHAT_LOG_COMPACT_RATIO", 1.0))
+
+# キャッシュ全体の上限 (pickle したときのバイト数で数える)
+CHAT_CACHE_MAX_BYTES = int(os.environ.get("CHAT_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+
+
+class ChatLog:
+    """レコードの list を追記型ログとして保存する"""
+
+    def __init__(self, path):
+        self.path = path  # 旧形式ファイルのパス (拡張子なし)
+        self.log_path = path + ".log"
+        self.idx_path = path + ".idx"
+        self.lock_path = path + ".lock"
+
+    # ------------------------
+    # 公開API (すべてロックを取る)
+    # 書き込み系は キャッシュ更新用に (書き込み前の signature, 書き込み後の signature, 生存バイト数) を返す
+    # ------------------------
+    def signature(self):
+        """ファイルが変わったかどうかを判定するための値 (ロック不要の stat のみ)
+
+        本体は追記しかされず compaction では索引の inode が変わるため、
+        (索引の inode, mtime, サイズ, 本体サイズ) が同じなら内容も同じとみなせる。
+        """
+        try:
+            idx_stat = os.stat(self.idx_path)
+        except FileNotFoundError:
+            return None
+        try:
+            log_size = os.stat(self.log_path).st_size
+        except FileNotFoundError:
+            log_size = 0
+        return (idx_stat.st_ino, idx_stat.st_mtime_ns, idx_stat.st_size, log_size)
+
+    def count(self):
+        with timed_lock(FileLock(self.lock_path)):
+            return len(self._prepare())
+
+    def read_all(self):
+        return self.read_all_state()[0]
+
+    def read_all_state(self):
+        """(レコード, signature, 生存バイト数) を返す"""
+        with timed_lock(FileLock(self.lock_path)):
+            entries = self._prepare()
+            return self._read_entries(entries), self.signature(), _live_bytes(entries)
+
+    def read_slice(self, start, stop=None):
+        """start 番目から stop 番目の手前までを読む (他のレコードはデシリアライズしない)"""
+        with timed_lock(FileLock(self.lock_path)):
+            entries = self._prepare()
+            return self._read_entries(entries[slice(start, stop)])
+
+    def read_unchanged(self):
+        """ファイルを一切書き換えずに全レコードを読む (移行ツール用)
+
+        旧形式は変換せずにそのまま読み、中断した compaction も後始末しない。
+        読めないファイルや壊れたレコードは .corrupt に移したり読み飛ばしたりせず、例外を投げる。
+        """
+        with timed_lock(FileLock(self.lock_path)):
+            idx_path = self.idx_path
+            if os.path.exists(idx_path + ".new") and not os.path.exists(self.log_path + ".new"):
+                idx_path += ".new"  # 本体の差し替えまで終わった compaction
+            elif not os.path.exists(idx_path) and os.path.exists(self.path):
+                return list(timed_joblib_load(self.path))
+            entries = self._read_index(idx_path)
+            records = self._read_entries(entries)
+            if len(records) != len(entries):
+                raise ValueError(f"{self.log_path} の {len(records)} 件目以降が索引と合いません")
+            return records
+
+    def read_page(self, limit, before=None):
+        """before 番目の手前までのうち末尾 limit 件を (レコード, 先頭の番号, 全件数) で返す
+
+        before を省くと最新の limit 件。索引だけで範囲を決めるので、範囲外はデシリアライズしない。
+        """
+        with timed_lock(FileLock(self.lock_path)):
+            entries = self._prepare()
+            stop, start = _page_range(len(entries), limit, before)
+            return self._read_entries(entries[start:stop]), start, len(entries)
+
+    def append(self, records):
+        """末尾にレコードを追記する。書き込み量は records の大きさだけに比例する
+
+        (変更前の signature, 変更後の signature, 生存バイト数, 追記した先頭レコードの番号) を返す。
+        """
+        with timed_lock(FileLock(self.lock_path)):
+            entries = self._prepare()
+            before = self.signature()
+            start = len(entries)
+            entries = self._append_unlocked(entries, records)
+            return before, self.signature(), _live_bytes(entries), start
+
+    def truncate(self, length):
+        """先頭 length 件だけを残す (索引を縮めるだけで本体は書き換えない)"""
+        with timed_lock(FileLock(self.lock_path)):
+            entries = self._prepare()
+            before = self.signature()
+            if length < len(entries):
+                entries = self._truncate_unlocked(entries, length)
+            return before, self.signature(), _live_bytes(entries)
+
+    def replace_tail(self, keep, records):
+        """先頭 keep 件を残し、その後ろを records に置き換える"""
+        with timed_lock(FileLock(self.lock_path)):
+            entries = self._prepare()
+            before = self.signature()
+            if keep < len(entries):
+                entries = self._truncate_unlocked(entries, keep)
+            entries = self._append_unlocked(entries, records)
+            return before, self.signature(), _live_bytes(entries)
+
+    def save(self, records):
+        """list 全体を受け取り、ディスク上との差分だけを書き込む
+
+        ディスク上の件数までは同じ内容である前提で、増えた分を追記・減った分を切り詰める。
+        念のため最後の共通レコードの crc を比べ、合わない場合は全体を書き直す。
+        """
+        with timed_lock(FileLock(self.lock_path)):
+            entries = self._prepare()
+            before = self.signature()
+            common = min(len(entries), len(records))
+            if common and zlib.crc32(_dumps(records[common - 1])) != entries[common - 1][2]:
+                entries = self._rewrite_unlocked(records)
+            elif len(records) < len(entries):
+                entries = self._truncate_unlocked(entries, len(records))
+            else:
+                entries = self._append_unlocked(entries, records[len(entries):])
+            return before, self.signature(), _live_bytes(entries)
+
+    def compact(self):
+        with timed_lock(FileLock(self.lock_path)):
+            entries = self._prepare()
+            self._compact_unlocked(entries)
+
+    def delete(self):
+        with timed_lock(FileLock(self.lock_path)):
+            for path in (self.path, self.log_path, self.idx_path,
+                         self.log_path + ".new", self.idx_path + ".new"):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    # ------------------------
+    # 内部処理 (呼び出し側でロック済み)
+    # ------------------------
+    def _prepare(self):
+        """中断した compaction の後始末・旧形式の変換を行い、索引を返す"""
+        self._recover_compaction()
+        if not os.path.exists(self.idx_path) and os.path.exists(self.path):
+            try:
+                legacy = timed_joblib_load(self.path)
+            except Exception as e:
+                # 読めないファイルは変換せず、元の内容を残したまま脇に移す (空のログで上書きしない)
+                corrupt_path = self.path + ".corrupt"
+                os.replace(self.path, corrupt_path)
+                print(f"[chat_store] {self.path} を読めなかったため {corrupt_path} に移しました: {e!r}")
+                return []
+            self._rewrite_unlocked(legacy)
+            os.remove(self.path)
+        return self._read_index()
+
+    def _recover_compaction(self):
+        log_new = self.log_path + ".new"
+        idx_new = self.idx_path + ".new"
+        if os.path.exists(idx_new) and not os.path.exists(log_new):
+            # 本体の差し替えまで終わっていたので索引の差し替えを完了させる
+            os.replace(idx_new, self.idx_path)
+        else:
+            # 差し替え前に中断していたら作りかけを捨てる
+            for path in (log_new, idx_new):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def _read_index(self, idx_path=None):
+        try:
+            with open(idx_path or self.idx_path, "rb") as f:
+                raw = f.read()
+        except FileNotFoundError:
+            return []
+        usable = len(raw) - len(raw) % INDEX_ENTRY.size  # 書きかけの末尾エントリは無視
+        return [INDEX_ENTRY.unpack_from(raw, pos) for pos in range(0, usable, INDEX_ENTRY.size)]
+
+    def _read_entries(self, entries):
+        if not entries:
+            return []
+        records = []
+        with open(self.log_path, "rb") as f:
+            for offset, length, crc in entries:
+                f.seek(offset)
+                data = f.read(length)
+                if len(data) != length or zlib.crc32(data) != crc:
+                    # 索引だけ残って本体が失われたレコード以降は読まない
+                    break
+                records.append(pickle.loads(data))
+        return records
+
+    def _append_unlocked(self, entries, records):
+        if not records:
+            return entries
+        new_entries = []
+        with open(self.log_path, "ab") as f:
+            offset = f.tell()
+            for record in records:
+                data = _dumps(record)
+                f.write(data)
+                new_entries.append((offset, len(data), zlib.crc32(data)))
+                offset += len(data)
+        index_bytes = b"".join(INDEX_ENTRY.pack(*entry) for entry in new_entries)
+        with open(self.idx_path, "ab") as f:
+            # 書きかけの末尾エントリがあれば先に切り落とす
+            usable = len(entries) * INDEX_ENTRY.size
+            if f.tell() != usable:
+                f.truncate(usable)
+                f.seek(usable)
+            f.write(index_bytes)
+        entries = entries + new_entries
+        return self._maybe_compact(entries)
+
+    def _truncate_unlocked(self, entries, length):
+        with open(self.idx_path, "r+b") as f:
+            f.truncate(length * INDEX_ENTRY.size)
+        return self._maybe_compact(entries[:length])
+
+    def _rewrite_unlocked(self, records):
+        log_new = self.log_path + ".new"
+        idx_new = self.idx_path + ".new"
+        entries = []
+        offset = 0
+        with open(log_new, "wb") as f:
+            for record in records:
+                data = _dumps(record)
+                f.write(data)
+                entries.append((offset, len(data), zlib.crc32(data)))
+                offset += len(data)
+        with open(idx_new, "wb") as f:
+            f.write(b"".join(INDEX_ENTRY.pack(*entry) for entry in entries))
+        self._commit_new_files()
+        return entries
+
+    def _maybe_compact(self, entries):
+        try:
+            log_size = os.path.getsize(self.log_path)
+        except FileNotFoundError:
+            return entries
+        live = _live_bytes(entries)
+        dead = log_size - live
+        if dead > COMPACT_MIN_BYTES and dead > live * COMPACT_RATIO:
+            return self._compact_unlocked(entries)
+        return entries
+
+    def _compact_unlocked(self, entries):
+        """生きているレコードだけを詰め直す (pickle は再生成せずバイト列をそのままコピー)"""
+        log_new = self.log_path + ".new"
+        idx_new = self.idx_path + ".new"
+        new_entries = []
+        offset = 0
+        with open(self.log_path, "rb") as src, open(log_new, "wb") as dst:
+            for old_offset, length, crc in entries:
+                src.seek(old_offset)
+                dst.write(src.read(length))
+                new_entries.append((offset, length, crc))
+                offset += length
+        with open(idx_new, "wb") as f:
+            f.write(b"".join(INDEX_ENTRY.pack(*entry) for entry in new_entries))
+        self._commit_new_files()
+        return new_entries
+
+    def _commit_new_files(self):
+        # 本体 → 索引の順で差し替える (途中で落ちても _recover_compaction で復旧できる)
+        os.replace(self.log_path + ".new", self.log_path)
+        os.replace(self.idx_path + ".new", self.idx_path)
+
+
+class FileDocument:
+    """past_chats_list のように値全体を joblib で読み書きするファイル
+
+    convert は読み込んだ値 (ファイルが無いか壊れていれば None) を使う形に直す関数。
+    """
+
+    def __init__(self, path, convert=lambda value: value):
+        self.path = path
+        self.lock_path = path + ".lock"
+        self.convert = convert
+
+    def signature(self):
+        return file_signature(self.path)
+
+    def read_state(self, strict=False):
+        """(値, signature, バイト数) を返す
+
+        strict なら読めないファイルを None 扱いにせず例外を投げる (移行ツールで元の内容を失わないため)。
+        """
+        with timed_lock(FileLock(self.lock_path)):
+            signature = self.signature()
+            return self._load(strict), signature, signature[2] if signature else 0
+
+    def update(self, mutate, cached=lambda signature: None):
+        """ロックを取ったまま現在の値を mutate に渡し、新しい値が返ったら置き換えて保存する
+
+        cached(signature) で最新の値がメモリにあればファイルを読まない。
+        保存したら (新しい値, signature, バイト数)、mutate が None を返したら None を返す。
+        """
+        with timed_lock(FileLock(self.lock_path)):
+            value = cached(self.signature())
+            if value is None:
+                value = self._load()
+            value = mutate(value)
+            if value is None:
+                return None
+            # 置き換えで書き込むことで、読み込み側が書きかけのファイルを見ないようにする
+            timed_joblib_dump(value, self.path + ".tmp")
+            os.replace(self.path + ".tmp", self.path)
+            signature = self.signature()
+            return value, signature, signature[2]
+
+    def _load(self, strict=False):
+        try:
+            value = timed_joblib_load(self.path)
+        except FileNotFoundError:
+            value = None
+        except Exception:
+            if strict:
+                raise
+            value = None
+        return self.convert(value)
+
+
+class ChatStateCache:
+    """チャットの状態をメモリに保持する LRU キャッシュ
+
+    値と一緒にファイルの signature を持ち、取り出すときに現在の signature と比べる。
+    別プロセスが書き込んでいれば signature が変わるので読み直しになる。
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.entries = OrderedDict()  # key -> (value, signature, nbytes)
+        self.lock = threading.Lock()
+
+    def get(self, key, signature):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] != signature:
+                self._remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, signature, nbytes):
+        with self.lock:
+            self._remove(key)
+            if nbytes > self.max_bytes:
+                return
+            self.entries[key] = (value, signature, nbytes)
+            self.total_bytes += nbytes
+            while self.total_bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+    def update(self, key, before, after, nbytes, mutate):
+        """書き込み前のファイルと同じ内容を持っているときだけ mutate を適用する (write-through)"""
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None or entry[1] != before:
+            self.invalidate(key)
+            return
+        self.put(key, mutate(entry[0]), after, nbytes)
+
+    def invalidate(self, key):
+        with self.lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry[2]
+
+
+chat_cache = ChatStateCache(CHAT_CACHE_MAX_BYTES)
+
+
+def cached_read(log):
+    """キャッシュが最新ならディスクを読まずに返す"""
+    records = chat_cache.get(log.path, log.signature())
+    if records is None:
+        records, signature, nbytes = log.read_all_state()
+        chat_cache.put(log.path, records, signature, nbytes)
+    return list(records)
+
+
+def cached_read_page(log, limit, before=None):
+    """キャッシュに全体があればそこから切り出し、なければ必要な範囲だけディスクから読む"""
+    records = chat_cache.get(log.path, log.signature())
+    if records is None:
+        return log.read_page(limit, before)
+    stop, start = _page_range(len(records), limit, before)
+    return list(records[start:stop]), start, len(records)
+
+
+def cached_append(log, records):
+    """追記した先頭レコードの番号を返す"""
+    records = list(records)
+    before, after, nbytes, start = log.append(records)
+    chat_cache.update(log.path, before, after, nbytes, lambda current: current + records)
+    return start
+
+
+def cached_truncate(log, length):
+    before, after, nbytes = log.truncate(length)
+    chat_cache.update(log.path, before, after, nbytes, lambda current: current[:length])
+
+
+def cached_replace_tail(log, keep, records):
+    records = list(records)
+    before, after, nbytes = log.replace_tail(keep, records)
+    chat_cache.update(log.path, before, after, nbytes, lambda current: current[:keep] + records)
+
+
+def cached_save(log, records):
+    records = list(records)
+    before, after, nbytes = log.save(records)
+    chat_cache.update(log.path, before, after, nbytes, lambda current: records)
+
+
+def cached_delete(log):
+    log.delete()
+    chat_cache.invalidate(log.path)
+
+
+def cached_document_read(document):
+    value = chat_cache.get(document.path, document.signature())
+    if value is None:
+        value, signature, nbytes = document.read_state()
+        chat_cache.put(document.path, value, signature, nbytes)
+    return value
+
+
+def cached_document_update(document, mutate):
+    """mutate(現在の値) が新しい値を返したら保存する。キャッシュの値を渡すので mutate は書き換えないこと"""
+    result = document.update(mutate, lambda signature: chat_cache.get(document.path, signature))
+    if result is not None:
+        chat_cache.put(document.path, *result)
+    return result is not None
+
+
+def list_chat_logs(user_dir, suffix):
+    """user_dir にある <chat_id><suffix> のログ (旧形式・追記型のどちらでも) の chat_id 一覧"""
+    chat_ids = set()
+    for name in os.listdir(user_dir):
+        base, ext = os.path.splitext(name)
+        if ext not in (".log", ".idx"):
+            base = name
+        if base.endswith(suffix):
+            chat_ids.add(base[:-len(suffix)])
+    return sorted(chat_ids)
+
+
+def file_signature(path):
+    """追記型でないファイル (past_chats_list など) 用の signature"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def _page_range(total, limit, before):
+    stop = total if before is None else max(0, min(before, total))
+    return stop, max(0, stop - limit)
+
+
+def _live_bytes(entries):
+    return sum(length for _, length, _ in entries)
+
+
+def _dumps(record):
+    return pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
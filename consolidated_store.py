@@ -0,0 +1,364 @@
+# -----------------------------------------------------------
+# チャット履歴の集約ストア (SQLite 1 ファイル)
+# -----------------------------------------------------------
+# data/<user>/ の下にチャットごとに並ぶ st_messages / gemini_messages / past_chats_list (と .lock) を
+# 1 つの SQLite ファイルにまとめる。レコードは pickle ではなく JSON で持ち、
+# Gemini 履歴の types.Content は {"$content": model_dump(mode="json")} の形で保存する。
+#
+# CHAT_STORE=db のとき app.py はここを使う。移行の途中でも動くように、
+#   - 読み込み: ストアに無いログ・一覧は従来のファイルから読む
+#   - 書き込み: ストアに無ければ、まず従来のファイルの内容を取り込んでからストアに書く
+# 移行ツール (migrate_store.py) も同じ取り込み処理を使うので、どちらが先に取り込んでも二重にはならない。
+# 取り込みは書き込みトランザクションの中で有無を確かめてから行う。
+#
+# ログは (username, name) で識別する。name は従来のファイル名 (<chat_id>-st_messages など) と同じ。
+import os
+import json
+import queue
+import sqlite3
+from contextlib import closing, contextmanager
+
+from google.genai import types
+
+from chat_store import ChatLog, FileDocument
+from metrics import TimedConnection
+
+CHAT_STORE_DB = os.environ.get("CHAT_STORE_DB", "data/chat_store.db")
+CHAT_STORE_POOL_SIZE = int(os.environ.get("CHAT_STORE_POOL_SIZE", 4))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS logs (
+    username TEXT,
+    name TEXT,
+    version INTEGER,
+    count INTEGER,
+    bytes INTEGER,
+    PRIMARY KEY (username, name)
+);
+CREATE TABLE IF NOT EXISTS records (
+    username TEXT,
+    name TEXT,
+    seq INTEGER,
+    data TEXT,
+    PRIMARY KEY (username, name, seq)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS documents (
+    username TEXT,
+    name TEXT,
+    version INTEGER,
+    data TEXT,
+    PRIMARY KEY (username, name)
+);
+CREATE TABLE IF NOT EXISTS migrated_users (
+    username TEXT PRIMARY KEY,
+    logs INTEGER,
+    records INTEGER,
+    finished REAL
+);
+"""
+
+
+def encode_record(record):
+    if isinstance(record, types.Content):
+        record = {"$content": record.model_dump(mode="json", exclude_none=True)}
+    return json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+
+
+def decode_record(data):
+    record = json.loads(data)
+    if isinstance(record, dict) and "$content" in record:
+        return types.Content.model_validate(record["$content"])
+    return record
+
+
+def split_path(path):
+    """data/<user>/<name> を (user, name) に分ける"""
+    user_dir, name = os.path.split(path)
+    return os.path.basename(user_dir), name
+
+
+class ConsolidatedStore:
+    def __init__(self, db_file=CHAT_STORE_DB, pool_size=CHAT_STORE_POOL_SIZE):
+        self.db_file = db_file
+        self.pool_size = pool_size
+        # 接続を使い回すためのプール (gevent 下では monkey.patch_all 済みの Queue になる)
+        self.pool = queue.Queue()
+
+    def connect(self):
+        # トランザクションは read() / write() で明示的に張る
+        conn = sqlite3.connect(self.db_file, timeout=60, isolation_level=None, check_same_thread=False,
+                               factory=TimedConnection)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def init_db(self):
+        with closing(self.connect()) as conn:
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def connection(self):
+        try:
+            conn = self.pool.get_nowait()
+        except queue.Empty:
+            conn = self.connect()
+        try:
+            yield conn
+        finally:
+            if self.pool.qsize() < self.pool_size:
+                self.pool.put(conn)
+            else:
+                conn.close()
+
+    @contextmanager
+    def read(self):
+        with self.connection() as conn:
+            conn.execute("BEGIN")
+            try:
+                yield conn
+            finally:
+                conn.execute("COMMIT")
+
+    @contextmanager
+    def write(self):
+        """書き込みトランザクション (BEGIN IMMEDIATE で書き込み側を直列にする)"""
+        with self.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def open_log(self, path):
+        return StoredChatLog(self, path)
+
+    def open_document(self, path, convert=lambda value: value):
+        return StoredDocument(self, path, convert)
+
+    # ------------------------
+    # 取り込み (アプリの書き込み時と移行ツールの両方で使う)
+    # ------------------------
+    def log_state(self, conn, username, name):
+        """(version, count, bytes)。ストアに無ければ None"""
+        return conn.execute(
+            "SELECT version, count, bytes FROM logs WHERE username = ? AND name = ?", (username, name)
+        ).fetchone()
+
+    def import_log(self, conn, username, name, records):
+        """まだストアに無いログなら records で作る。作ったら True (書き込みトランザクション内で呼ぶ)"""
+        if self.log_state(conn, username, name) is not None:
+            return False
+        encoded = [encode_record(record) for record in records]
+        conn.executemany(
+            "INSERT INTO records (username, name, seq, data) VALUES (?, ?, ?, ?)",
+            [(username, name, seq, data) for seq, data in enumerate(encoded)],
+        )
+        conn.execute(
+            "INSERT INTO logs (username, name, version, count, bytes) VALUES (?, ?, 1, ?, ?)",
+            (username, name, len(encoded), sum(len(data) for data in encoded)),
+        )
+        return True
+
+    def import_document(self, conn, username, name, value):
+        if self.document_state(conn, username, name) is not None:
+            return False
+        conn.execute(
+            "INSERT INTO documents (username, name, version, data) VALUES (?, ?, 1, ?)",
+            (username, name, json.dumps(value, ensure_ascii=False)),
+        )
+        return True
+
+    def document_state(self, conn, username, name):
+        return conn.execute(
+            "SELECT version, data FROM documents WHERE username = ? AND name = ?", (username, name)
+        ).fetchone()
+
+    def list_logs(self, username, suffix):
+        """ストアにある <chat_id><suffix> のログの chat_id 一覧 (削除して空になったものは除く)"""
+        with self.read() as conn:
+            rows = conn.execute(
+                "SELECT name FROM logs WHERE username = ? AND name LIKE ? AND count > 0", (username, "%" + suffix)
+            ).fetchall()
+        return [name[:-len(suffix)] for (name,) in rows]
+
+    def count_records(self, conn, username, name):
+        return conn.execute(
+            "SELECT COUNT(*) FROM records WHERE username = ? AND name = ?", (username, name)
+        ).fetchone()[0]
+
+
+class StoredChatLog:
+    """ChatLog と同じ公開 API をストア上で提供する (ストアに無いログは従来のファイルから読む)"""
+
+    def __init__(self, store, path):
+        self.store = store
+        self.path = path
+        self.username, self.name = split_path(path)
+        self.file_log = ChatLog(path)
+
+    def signature(self):
+        with self.store.read() as conn:
+            state = self.store.log_state(conn, self.username, self.name)
+        return ("db", state[0]) if state else self.file_log.signature()
+
+    def count(self):
+        with self.store.read() as conn:
+            state = self.store.log_state(conn, self.username, self.name)
+        return state[1] if state else self.file_log.count()
+
+    def read_all(self):
+        return self.read_all_state()[0]
+
+    def read_all_state(self):
+        with self.store.read() as conn:
+            state = self.store.log_state(conn, self.username, self.name)
+            if state is not None:
+                return self._read_range(conn, 0, state[1]), ("db", state[0]), state[2]
+        return self.file_log.read_all_state()
+
+    def read_slice(self, start, stop=None):
+        with self.store.read() as conn:
+            state = self.store.log_state(conn, self.username, self.name)
+            if state is not None:
+                start, stop, _ = slice(start, stop).indices(state[1])
+                return self._read_range(conn, start, stop)
+        return self.file_log.read_slice(start, stop)
+
+    def read_page(self, limit, before=None):
+        with self.store.read() as conn:
+            state = self.store.log_state(conn, self.username, self.name)
+            if state is not None:
+                stop = state[1] if before is None else max(0, min(before, state[1]))
+                start = max(0, stop - limit)
+                return self._read_range(conn, start, stop), start, state[1]
+        return self.file_log.read_page(limit, before)
+
+    def append(self, records):
+        with self._writing() as (conn, state):
+            before = ("db", state[0])
+            start = state[1]
+            nbytes = self._insert(conn, start, records)
+            after = self._bump(conn, state, start + len(records), state[2] + nbytes)
+            return before, after, state[2] + nbytes, start
+
+    def truncate(self, length):
+        with self._writing() as (conn, state):
+            before = ("db", state[0])
+            if length >= state[1]:
+                return before, before, state[2]
+            nbytes = state[2] - self._delete_from(conn, length)
+            return before, self._bump(conn, state, length, nbytes), nbytes
+
+    def replace_tail(self, keep, records):
+        with self._writing() as (conn, state):
+            before = ("db", state[0])
+            keep = min(keep, state[1])
+            nbytes = state[2] - self._delete_from(conn, keep)
+            nbytes += self._insert(conn, keep, records)
+            return before, self._bump(conn, state, keep + len(records), nbytes), nbytes
+
+    def save(self, records):
+        return self.replace_tail(0, records)
+
+    def compact(self):
+        pass
+
+    def delete(self):
+        with self.store.write() as conn:
+            state = self.store.log_state(conn, self.username, self.name)
+            if state is not None:
+                # logs の行は件数 0 で残して version を進める。行を消すと同じ名前で作り直したときに version が 1 から
+                # 数え直しになり、他のワーカーのキャッシュが同じ signature の古い内容を返してしまう
+                self._delete_from(conn, 0)
+                self._bump(conn, state, 0, 0)
+        # 取り込まれていない従来のファイルが残っていれば消す
+        self.file_log.delete()
+
+    @contextmanager
+    def _writing(self):
+        with self.store.write() as conn:
+            state = self.store.log_state(conn, self.username, self.name)
+            if state is None:
+                self.store.import_log(conn, self.username, self.name, self.file_log.read_all())
+                state = self.store.log_state(conn, self.username, self.name)
+            yield conn, state
+
+    def _read_range(self, conn, start, stop):
+        rows = conn.execute(
+            "SELECT data FROM records WHERE username = ? AND name = ? AND seq >= ? AND seq < ? ORDER BY seq",
+            (self.username, self.name, start, stop),
+        )
+        return [decode_record(data) for (data,) in rows]
+
+    def _insert(self, conn, start, records):
+        encoded = [encode_record(record) for record in records]
+        conn.executemany(
+            "INSERT INTO records (username, name, seq, data) VALUES (?, ?, ?, ?)",
+            [(self.username, self.name, start + i, data) for i, data in enumerate(encoded)],
+        )
+        return sum(len(data) for data in encoded)
+
+    def _delete_from(self, conn, seq):
+        """seq 番目以降を消し、消したバイト数を返す"""
+        removed = conn.execute(
+            "SELECT IFNULL(SUM(LENGTH(data)), 0) FROM records WHERE username = ? AND name = ? AND seq >= ?",
+            (self.username, self.name, seq),
+        ).fetchone()[0]
+        conn.execute(
+            "DELETE FROM records WHERE username = ? AND name = ? AND seq >= ?", (self.username, self.name, seq)
+        )
+        return removed
+
+    def _bump(self, conn, state, count, nbytes):
+        version = state[0] + 1
+        conn.execute(
+            "UPDATE logs SET version = ?, count = ?, bytes = ? WHERE username = ? AND name = ?",
+            (version, count, nbytes, self.username, self.name),
+        )
+        return ("db", version)
+
+
+class StoredDocument:
+    """FileDocument と同じ API をストア上で提供する (ストアに無ければ従来のファイルを読む)"""
+
+    def __init__(self, store, path, convert=lambda value: value):
+        self.store = store
+        self.path = path
+        self.username, self.name = split_path(path)
+        self.convert = convert
+        self.file_document = FileDocument(path, convert)
+
+    def signature(self):
+        with self.store.read() as conn:
+            state = self.store.document_state(conn, self.username, self.name)
+        return ("db", state[0]) if state else self.file_document.signature()
+
+    def read_state(self):
+        with self.store.read() as conn:
+            state = self.store.document_state(conn, self.username, self.name)
+        if state is None:
+            return self.file_document.read_state()
+        return self.convert(json.loads(state[1])), ("db", state[0]), len(state[1])
+
+    def update(self, mutate, cached=lambda signature: None):
+        with self.store.write() as conn:
+            state = self.store.document_state(conn, self.username, self.name)
+            if state is None:
+                value, _, _ = self.file_document.read_state()
+                version = 0
+            else:
+                version = state[0]
+                value = cached(("db", version))
+                if value is None:
+                    value = self.convert(json.loads(state[1]))
+            value = mutate(value)
+            if value is None:
+                return None
+            data = json.dumps(value, ensure_ascii=False)
+            conn.execute(
+                "INSERT OR REPLACE INTO documents (username, name, version, data) VALUES (?, ?, ?, ?)",
+                (self.username, self.name, version + 1, data),
+            )
+            return value, ("db", version + 1), len(data)
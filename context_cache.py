@@ -0,0 +1,172 @@
+# -----------------------------------------------------------
+# Gemini のコンテキストキャッシュ (client.caches) の管理
+# -----------------------------------------------------------
+# 大きな添付ファイルや長い履歴を含むチャットでは、送るたびに同じ先頭部分 (システム指示・ツール・古いターン)
+# の処理をやり直すことになる。応答が終わった後にその時点の履歴をキャッシュとして作っておき、
+# 次の送信では cached_content で参照して、キャッシュの後ろのターンだけを送る。
+#
+# キャッシュはチャットごとに 1 つで、DB_FILE の context_caches テーブルに記録する (ワーカー間で共有)。
+# 記録したターンの範囲 (context_window.build_window の構成) が次に送る履歴の先頭と一致し、
+# モデルと設定 (システム指示・ツール) が同じで、期限が残っているときだけ使う。
+# delete_message などで範囲内の履歴が書き換わったら記録を消し、キャッシュも削除する (次の応答の後に作り直す)。
+# 使ったときに残り時間が TTL の半分を切っていれば期限を延ばす。
+import os
+import json
+import time
+import hashlib
+import sqlite3
+from contextlib import closing
+
+from google.genai import types
+
+from metrics import TimedConnection
+
+# キャッシュの保存期間も課金されるので、CONTEXT_CACHE=1 を指定したときだけ使う
+CONTEXT_CACHE = os.environ.get("CONTEXT_CACHE", "0") == "1"
+CONTEXT_CACHE_TTL = int(os.environ.get("CONTEXT_CACHE_TTL", 600))
+# キャッシュを作る最小のトークン数 (API 側の下限より小さいと作成に失敗する)
+CONTEXT_CACHE_MIN_TOKENS = int(os.environ.get("CONTEXT_CACHE_MIN_TOKENS", 4096))
+# キャッシュより後ろに送るターンがこのトークン数を超えたら、次の応答の後に作り直す
+CONTEXT_CACHE_REBUILD_TOKENS = int(os.environ.get("CONTEXT_CACHE_REBUILD_TOKENS", 4096))
+# 残り時間がこれより短いキャッシュは使わない (送信中に期限が切れるのを避ける)
+CONTEXT_CACHE_MARGIN = float(os.environ.get("CONTEXT_CACHE_MARGIN", 30))
+# 作成に失敗したモデルは、この秒数だけ作成を試みない (キャッシュに対応していないモデルなど)
+CONTEXT_CACHE_RETRY = float(os.environ.get("CONTEXT_CACHE_RETRY", 10 * 60))
+
+
+def config_key(model_name, config):
+    """キャッシュに含めるモデル・システム指示・ツールの組を表すキー"""
+    data = {
+        "model": model_name,
+        "system_instruction": config.system_instruction if config else None,
+        "tools": [tool.model_dump(mode="json", exclude_none=True) for tool in (config.tools or [])] if config else [],
+    }
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def cached_config(config, name):
+    """キャッシュを参照する生成設定 (システム指示とツールはキャッシュ側にあるので外す)"""
+    return config.model_copy(update={"system_instruction": None, "tools": None, "cached_content": name})
+
+
+def layout_length(layout):
+    """構成が表す履歴の Content 数 (要約があれば要約の 2 件を含む)"""
+    return (2 if layout["summary"] else 0) + sum(end - start for start, end in layout["turns"])
+
+
+class ContextCacheRegistry:
+    def __init__(self, db_file):
+        self.db_file = db_file
+        # モデル → 作成に失敗した時刻 (プロセス内だけ)
+        self.failed = {}
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_file, timeout=30, factory=TimedConnection)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def init_db(self):
+        with closing(self.connect()) as conn, conn:
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS context_caches (
+                username TEXT,
+                chat_id TEXT,
+                name TEXT,
+                model TEXT,
+                config_key TEXT,
+                layout TEXT,
+                history_end INTEGER,
+                tokens INTEGER,
+                expire_time REAL,
+                created REAL,
+                PRIMARY KEY (username, chat_id)
+            )
+            """)
+
+    def get(self, username, chat_id):
+        with closing(self.connect()) as conn:
+            row = conn.execute(
+                "SELECT * FROM context_caches WHERE username = ? AND chat_id = ?", (username, chat_id)
+            ).fetchone()
+        if row is None:
+            return None
+        entry = dict(row)
+        entry["layout"] = json.loads(entry["layout"])
+        return entry
+
+    def find(self, username, chat_id, model_name, key, layout):
+        """layout の先頭と一致する使えるキャッシュを返す。なければ None"""
+        entry = self.get(username, chat_id)
+        if entry is None or entry["model"] != model_name or entry["config_key"] != key:
+            return None
+        if entry["expire_time"] - CONTEXT_CACHE_MARGIN < time.time():
+            return None
+        cached = entry["layout"]
+        count = len(cached["turns"])
+        summary = list(layout["summary"]) if layout["summary"] else None
+        if cached["summary"] != summary or [list(t) for t in layout["turns"][:count]] != cached["turns"]:
+            return None
+        return entry
+
+    def register(self, username, chat_id, cache, model_name, key, layout, tokens):
+        """作成したキャッシュを記録し、置き換えた古いキャッシュの名前を返す"""
+        previous = self.get(username, chat_id)
+        history_end = max([end for _, end in layout["turns"]] + [layout["summary"][0] if layout["summary"] else 0])
+        expire_time = cache.expire_time.timestamp() if cache.expire_time else time.time() + CONTEXT_CACHE_TTL
+        with closing(self.connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO context_caches VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (username, chat_id, cache.name, model_name, key, json.dumps(layout), history_end,
+                 tokens, expire_time, time.time()),
+            )
+        return previous["name"] if previous and previous["name"] != cache.name else None
+
+    def extend(self, name, expire_time):
+        with closing(self.connect()) as conn, conn:
+            conn.execute("UPDATE context_caches SET expire_time = ? WHERE name = ?", (expire_time, name))
+
+    def invalidate(self, username, chat_id, length):
+        """Gemini 履歴の先頭 length 件より後ろが変わったとき、その範囲を含むキャッシュの記録を消して名前を返す"""
+        with closing(self.connect()) as conn, conn:
+            row = conn.execute(
+                "SELECT name FROM context_caches WHERE username = ? AND chat_id = ? AND history_end > ?",
+                (username, chat_id, length),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute("DELETE FROM context_caches WHERE username = ? AND chat_id = ?", (username, chat_id))
+            return row["name"]
+
+    def forget(self, name):
+        with closing(self.connect()) as conn, conn:
+            conn.execute("DELETE FROM context_caches WHERE name = ?", (name,))
+
+    def prune(self):
+        """期限を過ぎた記録をまとめて消す。消した件数を返す"""
+        with closing(self.connect()) as conn, conn:
+            return conn.execute("DELETE FROM context_caches WHERE expire_time < ?", (time.time(),)).rowcount
+
+    def needs_rebuild(self, entry, layout):
+        """キャッシュの後ろに送るターンが増えて、作り直す価値があるか"""
+        if entry is None:
+            return sum(layout["tokens"]) + layout["summary_tokens"] >= CONTEXT_CACHE_MIN_TOKENS
+        uncached = sum(layout["tokens"][len(entry["layout"]["turns"]):])
+        return uncached >= CONTEXT_CACHE_REBUILD_TOKENS
+
+    def can_create(self, model_name):
+        failed = self.failed.get(model_name)
+        return failed is None or time.time() - failed > CONTEXT_CACHE_RETRY
+
+    def create(self, client, model_name, config, contents):
+        """client.caches.create でキャッシュを作る。失敗したら None"""
+        try:
+            return client.caches.create(model=model_name, config=types.CreateCachedContentConfig(
+                contents=contents,
+                system_instruction=config.system_instruction if config else None,
+                tools=config.tools if config else None,
+                ttl=f"{CONTEXT_CACHE_TTL}s",
+            ))
+        except Exception as e:
+            print(f"[cache] キャッシュの作成に失敗しました model={model_name}: {e}")
+            self.failed[model_name] = time.time()
+            return None
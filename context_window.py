@@ -0,0 +1,243 @@
+# -----------------------------------------------------------
+# 長い会話で Gemini に送る履歴の絞り込み (コンテキストポリシー)
+# -----------------------------------------------------------
+# Gemini 履歴の各 Content のトークン数を応答完了時の usage_metadata から求めて保存しておき
+# (<chat_id>-gemini_tokens)、送信時はその値だけで送る範囲を決める (count_tokens は呼ばない)。
+# 絞り込みはターン (ユーザー発言とそれに続くモデルの応答) 単位で、最後のターンは必ず送る。
+#   full       : すべて送る
+#   budget     : 古いターンから外し、合計を予算 (budget) 以下にする
+#   first_last : 最初の first ターンと最後の last ターンだけを送る (budget があればさらに絞る)
+#   summary    : 要約済みのターンを要約 1 つに置き換え、残りを budget と同じ方法で絞る。
+#                予算を超えて外したターンがあれば、応答後にバックグラウンドで要約を作り直す
+# 予算を指定しなければモデルの入力上限 (input_token_limit) の CONTEXT_BUDGET_RATIO 倍を使う。
+#
+# ポリシーは CONTEXT_POLICY 系の環境変数を既定値とし、CONTEXT_POLICIES (JSON) でモデルごとに上書きする。
+#   CONTEXT_POLICIES={"models/gemini-2.0-flash-001": {"mode": "summary", "budget": 30000}}
+# トークン数が記録されていない Content (この機能より前の履歴など) は文字数などからの概算を使う。
+import os
+import json
+
+from google.genai import types
+
+from token_counter import estimate_tokens, estimate_text_tokens, IMAGE_TOKENS_PER_TILE
+
+POLICY_MODES = ("full", "budget", "first_last", "summary")
+CONTEXT_POLICY = os.environ.get("CONTEXT_POLICY", "budget")
+CONTEXT_BUDGET = int(os.environ["CONTEXT_BUDGET"]) if os.environ.get("CONTEXT_BUDGET") else None
+CONTEXT_BUDGET_RATIO = float(os.environ.get("CONTEXT_BUDGET_RATIO", 0.8))
+CONTEXT_FIRST_TURNS = int(os.environ.get("CONTEXT_FIRST_TURNS", 1))
+CONTEXT_LAST_TURNS = int(os.environ.get("CONTEXT_LAST_TURNS", 20))
+# 要約を作り直すとき、要約せずに残すターンの合計を予算のこの割合までにする (毎ターン要約し直さないため)
+CONTEXT_SUMMARY_KEEP_RATIO = float(os.environ.get("CONTEXT_SUMMARY_KEEP_RATIO", 0.5))
+# 要約に使うモデル (省略時は応答したモデル)
+CONTEXT_SUMMARY_MODEL = os.environ.get("CONTEXT_SUMMARY_MODEL")
+CONTEXT_POLICIES = json.loads(os.environ.get("CONTEXT_POLICIES") or "{}")
+
+SUMMARY_PROMPT = os.environ.get(
+    "CONTEXT_SUMMARY_PROMPT",
+    "ここまでの会話を、後で続きを話すときに必要な事実・決定事項・未解決の質問を落とさずに要約してください。"
+    "要約だけを出力してください。",
+)
+SUMMARY_HEADER = "[これまでの会話の要約]\n"
+SUMMARY_ACK = "承知しました。この要約を踏まえて会話を続けます。"
+# 概算できない添付ファイル (File API のファイルなど) の 1 つあたりのトークン数
+UNKNOWN_PART_TOKENS = IMAGE_TOKENS_PER_TILE
+
+
+def resolve_policy(model_name, input_token_limit=None):
+    """モデルに適用するポリシーを {"model", "mode", "budget", "first", "last", "summary_model"} で返す"""
+    policy = {
+        "model": model_name,
+        "mode": CONTEXT_POLICY,
+        "budget": CONTEXT_BUDGET,
+        "first": CONTEXT_FIRST_TURNS,
+        "last": CONTEXT_LAST_TURNS,
+        "summary_model": CONTEXT_SUMMARY_MODEL,
+    }
+    short_name = model_name[len("models/"):] if model_name.startswith("models/") else model_name
+    override = CONTEXT_POLICIES.get(model_name) or CONTEXT_POLICIES.get(short_name) or CONTEXT_POLICIES.get("*")
+    if override:
+        policy.update(override)
+    if policy["mode"] not in POLICY_MODES:
+        print(f"[context] 不明なポリシー {policy['mode']!r} のため full として扱います (model={model_name})")
+        policy["mode"] = "full"
+    if policy["budget"] is None and input_token_limit:
+        policy["budget"] = int(input_token_limit * CONTEXT_BUDGET_RATIO)
+    return policy
+
+
+def estimate_content_tokens(content):
+    """トークン数が記録されていない Content の概算"""
+    total = 0
+    for part in content.parts or []:
+        if part.text:
+            total += estimate_text_tokens(part.text.encode("utf-8"))
+        elif part.inline_data is not None:
+            data = part.inline_data.data
+            total += estimate_tokens(data, part.inline_data.mime_type) or UNKNOWN_PART_TOKENS
+        elif part.file_data is not None:
+            total += estimate_tokens(None, part.file_data.mime_type) or UNKNOWN_PART_TOKENS
+        else:
+            total += estimate_text_tokens(part.model_dump_json(exclude_none=True).encode("utf-8"))
+    return total
+
+
+def split_turns(history):
+    """ユーザー発言から次のユーザー発言の手前までを 1 ターンとし、(開始, 終了) の list を返す"""
+    turns = []
+    for i, content in enumerate(history):
+        if content.role == "user" or not turns:
+            turns.append([i, i + 1])
+        else:
+            turns[-1][1] = i + 1
+    return [tuple(turn) for turn in turns]
+
+
+def summary_contents(summary):
+    """保存した要約を、履歴の先頭に置く Content の組にする"""
+    return [
+        types.Content(role="user", parts=[types.Part(text=SUMMARY_HEADER + summary["text"])]),
+        types.Content(role="model", parts=[types.Part(text=SUMMARY_ACK)]),
+    ]
+
+
+def usable_summary(summary, history, turns):
+    # 要約の範囲がターンの境目で終わっていて、最後のターンにかかっていないものだけを使う
+    if not summary or not turns:
+        return None
+    covers = summary.get("covers", 0)
+    if covers <= 0 or covers > turns[-1][0] or covers not in {start for start, _ in turns}:
+        return None
+    return summary
+
+
+def build_window(history, counts, policy, reserve=0, summary=None):
+    """(送る履歴, その内訳 (応答のメタデータに載せる), 構成) を返す
+
+    counts は history と同じ長さのトークン数 (不明な位置は None)。reserve は新しく送る発言の分。
+    構成は {"turns": 送るターンの (開始, 終了) の list, "summary": 先頭に置いた要約の (covers, created) か None,
+    "tokens": 送るターンごとのトークン数} で、コンテキストキャッシュ (context_cache.py) が範囲の一致を調べるのに使う。
+    """
+    turns = split_turns(history)
+    tokens = [count if count is not None else estimate_content_tokens(content)
+              for content, count in zip(history, counts)]
+    estimated = any(count is None for count in counts)
+    turn_tokens = [sum(tokens[start:end]) for start, end in turns]
+    mode = policy["mode"]
+    budget = policy.get("budget") if mode != "full" else None
+
+    kept = list(range(len(turns)))
+    protected = 0  # 予算で外すときに最後まで残す先頭のターン数
+    prefix = []
+    prefix_tokens = 0
+    summarized = 0
+    if mode == "first_last":
+        first, last = max(0, int(policy["first"])), max(1, int(policy["last"]))
+        if len(turns) > first + last:
+            kept = kept[:first] + kept[-last:]
+        protected = min(first, len(kept) - 1)
+    elif mode == "summary":
+        summary = usable_summary(summary, history, turns)
+        if summary:
+            kept = [i for i in kept if turns[i][0] >= summary["covers"]]
+            prefix = summary_contents(summary)
+            prefix_tokens = summary.get("tokens") or estimate_content_tokens(prefix[0])
+            summarized = len(turns) - len(kept)
+
+    if budget:
+        total = prefix_tokens + reserve + sum(turn_tokens[i] for i in kept)
+        # 先頭の保護分の後ろから古い順に外し、それでも足りなければ保護分も外す (最後のターンは残す)
+        order = kept[protected:-1] + kept[:protected]
+        dropped = set()
+        for i in order:
+            if total <= budget:
+                break
+            total -= turn_tokens[i]
+            dropped.add(i)
+        kept = [i for i in kept if i not in dropped]
+
+    window = list(prefix)
+    for i in kept:
+        start, end = turns[i]
+        window.extend(history[start:end])
+    report = {
+        "policy": mode,
+        "budget": budget,
+        "turns_sent": len(kept),
+        "turns_total": len(turns),
+        "summarized_turns": summarized,
+        "tokens_sent": prefix_tokens + sum(turn_tokens[i] for i in kept),
+        "estimated": estimated,
+        # summary で、要約に含まれていないのに外したターンがある (要約を作り直す必要がある)
+        "needs_summary": mode == "summary" and len(kept) + summarized < len(turns),
+    }
+    layout = {
+        "turns": [turns[i] for i in kept],
+        "summary": (summary["covers"], summary.get("created")) if prefix else None,
+        "summary_tokens": prefix_tokens,
+        "tokens": [turn_tokens[i] for i in kept],
+    }
+    return window, report, layout
+
+
+def describe_window(report):
+    """応答の末尾に付ける表示用の 1 行"""
+    text = f"Context: {report['policy']} {report['turns_sent']}/{report['turns_total']} turns"
+    if report["summarized_turns"]:
+        text += f" (+summary of {report['summarized_turns']})"
+    if report["budget"]:
+        text += f", {'~' if report['estimated'] else ''}{report['tokens_sent']:,}/{report['budget']:,} tokens"
+    if report.get("cached_tokens"):
+        text += f", cached {report['cached_tokens']:,}"
+    return text
+
+
+def new_turn_counts(new_contents, usage_metadata, window_tokens, overhead=0, prefix_tokens=0):
+    """応答完了時に保存する Content ごとのトークン数
+
+    ユーザー発言は prompt_token_count から送った履歴 (window_tokens) とシステム指示など (overhead) を引いた値、
+    モデルの応答は candidates_token_count。1 つの応答がチャンクごとの複数の Content に分かれるが、
+    絞り込みはターン単位なので最初のモデルの Content に合計を載せ、残りは 0 とする。
+    続きの生成では最初のモデルの Content に途中までの応答の分 (prefix_tokens) を足す。
+    わからない値は None (送信時に概算する)。
+    """
+    prompt = getattr(usage_metadata, "prompt_token_count", None)
+    candidates = getattr(usage_metadata, "candidates_token_count", None)
+    counts = []
+    model_seen = False
+    for content in new_contents:
+        if content.role == "user":
+            counts.append(max(0, prompt - window_tokens - overhead) if prompt is not None else None)
+        elif not model_seen:
+            model_seen = True
+            counts.append(candidates + prefix_tokens if candidates is not None and prefix_tokens is not None else None)
+        else:
+            counts.append(0)
+    return counts
+
+
+def summary_cutoff(history, counts, budget):
+    """要約を作り直すときに要約に含める範囲の終わり (ターンの境目)。残りは予算の一定割合に収める"""
+    turns = split_turns(history)
+    if len(turns) < 2:
+        return 0
+    limit = budget * CONTEXT_SUMMARY_KEEP_RATIO
+    total = 0
+    cutoff = turns[-1][0]
+    for start, end in reversed(turns):
+        total += sum(count if count is not None else estimate_content_tokens(content)
+                     for content, count in zip(history[start:end], counts[start:end]))
+        if total > limit and start != turns[-1][0]:
+            break
+        cutoff = start
+    return cutoff
+
+
+def summary_request(history, summary, cutoff):
+    """要約を作るために送る contents (前回の要約があれば、それとその後のターンだけ)"""
+    if summary and 0 < summary.get("covers", 0) <= cutoff:
+        contents = summary_contents(summary) + list(history[summary["covers"]:cutoff])
+    else:
+        contents = list(history[:cutoff])
+    contents.append(types.Content(role="user", parts=[types.Part(text=SUMMARY_PROMPT)]))
+    return contents
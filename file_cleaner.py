@@ -2,9 +2,30 @@ import os
 import argparse
 from dotenv import load_dotenv
 from google import genai
+from file_registry import FileRegistry
 
 load_dotenv()
+# chat_store は読み込み時に環境変数を参照するので、.env を読み込んでから import する
+from file_sweeper import referenced_file_ids, select_files, delete_files as delete_files_parallel, sweep_local_files
+
 GOOGLE_API_KEY = os.environ.get('GOOGLE_API_KEY')
+DB_FILE = "data/database.db"
+DATA_DIR = "data/"
+
+def open_registry():
+    """アプリの重複排除レジストリ (アプリを起動したことがなければ None)"""
+    if not os.path.exists(DB_FILE):
+        return None
+    registry = FileRegistry(DB_FILE)
+    registry.init_db()
+    return registry
+
+def open_chat_store():
+    """CHAT_STORE=db で動かしている場合は集約ストア (参照の確認に使う)"""
+    if os.environ.get("CHAT_STORE", "files") != "db":
+        return None
+    from consolidated_store import ConsolidatedStore
+    return ConsolidatedStore()
 
 def list_files(client):
     """ファイル一覧を表示する関数"""
@@ -20,48 +41,75 @@ def list_files(client):
     
     return files
 
-def delete_files(client, files, dry_run=True):
-    """ファイルを削除する関数"""
+def delete_files(client, files, dry_run=True, registry=None, workers=8, rate=10):
+    """ファイルを削除する関数 (削除したファイルはレジストリからも外す)"""
     if not files:
         print("削除するファイルはありません。")
         return
     
     print(f"\n=== {'削除予定' if dry_run else '削除'} ファイル ===")
-    for i, file in enumerate(files, 1):
-        if dry_run:
+    if dry_run:
+        for i, file in enumerate(files, 1):
             print(f"{i}. {file.name} (削除予定)")
-        else:
-            try:
-                response = client.files.delete(name=file.name)
-                print(f"{i}. {file.name} → 削除成功")
-            except Exception as e:
-                print(f"{i}. {file.name} → 削除失敗: {e}")
+        return
+
+    def report(file, error):
+        print(f"{file.name} → {'削除失敗: ' + str(error) if error else '削除成功'}")
+
+    deleted, failed = delete_files_parallel(client, files, workers=workers, rate=rate, registry=registry, on_result=report)
+    print(f"削除 {deleted} 件 / 失敗 {failed} 件")
 
 def main():
     parser = argparse.ArgumentParser(description='GenAI File APIを使用してファイル一覧取得・削除を行うツール')
     parser.add_argument('--delete', action='store_true', help='ファイルを実際に削除します（指定しない場合は削除予定の表示のみ）')
     parser.add_argument('--api-key', help='GenAI API Keyを指定します（環境変数GOOGLE_API_KEYが設定されていない場合に必要）')
+    parser.add_argument('--older-than', type=float, metavar='HOURS', help='作成から指定した時間以上経ったファイルだけを対象にします')
+    parser.add_argument('--pattern', action='append', metavar='GLOB', help='名前 (files/...) か表示名が一致するファイルだけを対象にします（複数指定可）')
+    parser.add_argument('--keep-referenced', action='store_true', help='保存済みのチャット履歴から参照されているファイルを残します')
+    parser.add_argument('--data-dir', default=DATA_DIR, help='参照を確認するユーザーデータのディレクトリ（既定: data/）')
+    parser.add_argument('--workers', type=int, default=8, help='並列に削除する数（既定: 8）')
+    parser.add_argument('--rate', type=float, default=10, help='1秒あたりの削除リクエスト数の上限（0で無制限、既定: 10）')
+    parser.add_argument('--local-tmp', type=float, metavar='HOURS', help='data/<user>/tmp_* と書きかけのアップロードのうち、指定した時間以上前のものも削除します')
+    parser.add_argument('--yes', action='store_true', help='確認せずに削除します')
     args = parser.parse_args()
     
     try:
         # API Keyの設定
-        if args.api_key:
-            genai.configure(api_key=args.api_key)
-        elif 'GOOGLE_API_KEY' not in os.environ:
+        api_key = args.api_key or GOOGLE_API_KEY
+        if not api_key:
             print("エラー: API Keyが必要です。--api-keyオプションで指定するか、GOOGLE_API_KEY環境変数を設定してください。")
             return
         
         # クライアントの初期化
-        client = genai.Client()
+        client = genai.Client(api_key=api_key)
         
         # ファイル一覧取得
         files = list_files(client)
+
+        # 対象の絞り込み
+        keep = None
+        if args.keep_referenced:
+            keep = referenced_file_ids(args.data_dir, open_chat_store())
+            print(f"\nチャット履歴から参照されているファイル: {len(keep)} 件")
+        files = select_files(
+            files,
+            older_than=args.older_than * 3600 if args.older_than is not None else None,
+            patterns=args.pattern,
+            keep=keep,
+        )
         
         # ファイル削除
         if args.delete:
-            input_text = input("\n全てのファイルを削除します。よろしいですか？ [y/N]: ")
+            scope = "対象の" if (args.older_than is not None or args.pattern or keep is not None) else "全ての"
+            input_text = 'y' if args.yes or not files else input(f"\n{scope}ファイル {len(files)} 件を削除します。よろしいですか？ [y/N]: ")
             if input_text.lower() == 'y':
-                delete_files(client, files, dry_run=False)
+                registry = open_registry()
+                delete_files(client, files, dry_run=False, registry=registry, workers=args.workers, rate=args.rate)
+                if registry:
+                    print(f"期限切れのレジストリ記録を {registry.prune()} 件削除しました。")
+                if args.local_tmp is not None:
+                    removed = sweep_local_files(args.data_dir, args.local_tmp * 3600)
+                    print(f"ローカルの一時ファイルを {removed} 件削除しました。")
             else:
                 print("削除をキャンセルしました。")
         else:
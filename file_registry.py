@@ -0,0 +1,106 @@
+# -----------------------------------------------------------
+# File API アップロードの重複排除レジストリ
+# -----------------------------------------------------------
+# アップロードされたバイト列の SHA-256 をキーに、Gemini File API 上の file_id・MIME タイプ・
+# 有効期限を SQLite に記録しておく。同じユーザーが同じファイルを再び添付したときは
+# アップロードせずに記録済みの file_id を返す。
+# File API のファイルは保存期間 (48時間) を過ぎると消えるので、期限が近いものは使わない。
+# 期限内でもサーバー側で削除されている可能性があるため、送信時に files.get で確認し直す。
+import os
+import time
+import sqlite3
+from contextlib import closing
+
+from metrics import TimedConnection
+
+FILE_RETENTION = float(os.environ.get("FILE_RETENTION", 48 * 60 * 60))
+# 残り時間がこれより短いファイルは再利用しない (会話の途中で期限切れになるのを避ける)
+FILE_REGISTRY_MARGIN = float(os.environ.get("FILE_REGISTRY_MARGIN", 60 * 60))
+# files.get での存在確認をやり直すまでの間隔
+FILE_RECHECK_INTERVAL = float(os.environ.get("FILE_RECHECK_INTERVAL", 10 * 60))
+
+
+def file_expire_time(file):
+    """File API の File から有効期限 (UNIX 時間) を取り出す"""
+    if file.expiration_time is not None:
+        return file.expiration_time.timestamp()
+    if file.create_time is not None:
+        return file.create_time.timestamp() + FILE_RETENTION
+    return time.time() + FILE_RETENTION
+
+
+class FileRegistry:
+    def __init__(self, db_file):
+        self.db_file = db_file
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_file, timeout=30, factory=TimedConnection)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def init_db(self):
+        with closing(self.connect()) as conn, conn:
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS file_registry (
+                username TEXT,
+                sha256 TEXT,
+                size INTEGER,
+                file_id TEXT,
+                file_uri TEXT,
+                mime_type TEXT,
+                expire_time REAL,
+                checked REAL,
+                PRIMARY KEY (username, sha256)
+            )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_file_registry_file_id ON file_registry (file_id)")
+
+    def lookup(self, username, sha256, size):
+        """再利用できるアップロード済みファイルを返す。なければ None"""
+        with closing(self.connect()) as conn, conn:
+            row = conn.execute(
+                "SELECT * FROM file_registry WHERE username = ? AND sha256 = ? AND size = ?",
+                (username, sha256, size),
+            ).fetchone()
+            if row is None:
+                return None
+            if row["expire_time"] - FILE_REGISTRY_MARGIN < time.time():
+                conn.execute("DELETE FROM file_registry WHERE username = ? AND sha256 = ?", (username, sha256))
+                return None
+            return dict(row)
+
+    def get(self, file_id):
+        with closing(self.connect()) as conn:
+            row = conn.execute(
+                "SELECT * FROM file_registry WHERE file_id = ? ORDER BY checked DESC LIMIT 1", (file_id,)
+            ).fetchone()
+        return dict(row) if row else None
+
+    def register(self, username, sha256, size, file):
+        now = time.time()
+        with closing(self.connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO file_registry VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (username, sha256, size, file.name, file.uri, file.mime_type, file_expire_time(file), now),
+            )
+
+    def mark_checked(self, file):
+        """files.get で存在を確認できたファイルの確認時刻と有効期限を更新する"""
+        with closing(self.connect()) as conn, conn:
+            conn.execute(
+                "UPDATE file_registry SET checked = ?, expire_time = ?, file_uri = ? WHERE file_id = ?",
+                (time.time(), file_expire_time(file), file.uri, file.name),
+            )
+
+    def forget(self, file_id):
+        """削除済み・期限切れになったファイルの記録を消す"""
+        with closing(self.connect()) as conn, conn:
+            conn.execute("DELETE FROM file_registry WHERE file_id = ?", (file_id,))
+
+    def prune(self):
+        """期限を過ぎた記録をまとめて消す。消した件数を返す"""
+        with closing(self.connect()) as conn, conn:
+            return conn.execute("DELETE FROM file_registry WHERE expire_time < ?", (time.time(),)).rowcount
+
+    def needs_recheck(self, entry):
+        return time.time() - entry["checked"] > FILE_RECHECK_INTERVAL or entry["expire_time"] < time.time()
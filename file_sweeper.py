@@ -0,0 +1,161 @@
+# -----------------------------------------------------------
+# File API のファイルとローカルの一時ファイルの掃除
+# -----------------------------------------------------------
+# file_cleaner.py (手動) と app.py の定期掃除 (FILE_SWEEP_INTERVAL) の両方から使う。
+#   - 作成からの経過時間と名前のパターンで削除対象を絞る
+#   - 保存済みの Gemini 履歴から参照されている file_id を残す
+#   - 削除は上限付きのワーカーで並列に行い、1 秒あたりの呼び出し数を制限する (API のレート制限に当たらないように)
+# スレッドで並列にするので、monkey.patch_all 済みの app.py の中では greenlet として動く。
+import os
+import time
+import queue
+import fnmatch
+import threading
+
+from chat_store import ChatLog, list_chat_logs
+
+GEMINI_HISTORY_SUFFIX = "-gemini_messages"
+# 以前の upload_large_file が data/<user>/ に書き出していた一時ファイル
+TMP_PREFIX = "tmp_"
+
+
+def file_name_from_uri(uri):
+    """file_uri (https://.../v1beta/files/abc) を File API の名前 (files/abc) にする"""
+    index = uri.rfind("files/")
+    return uri[index:] if index >= 0 else uri
+
+
+def list_users(data_dir):
+    return sorted(
+        name for name in os.listdir(data_dir) if os.path.isdir(os.path.join(data_dir, name))
+    ) if os.path.isdir(data_dir) else []
+
+
+def referenced_file_ids(data_dir, store=None):
+    """保存済みの Gemini 履歴が参照しているファイル名の集合
+
+    store (ConsolidatedStore) を渡すと集約ストアのログも読む (未移行のログは従来のファイルから読む)。
+    """
+    referenced = set()
+    for username in list_users(data_dir):
+        user_dir = os.path.join(data_dir, username)
+        chat_ids = set(list_chat_logs(user_dir, GEMINI_HISTORY_SUFFIX))
+        if store is not None:
+            chat_ids.update(store.list_logs(username, GEMINI_HISTORY_SUFFIX))
+        for chat_id in chat_ids:
+            path = os.path.join(user_dir, chat_id + GEMINI_HISTORY_SUFFIX)
+            log = store.open_log(path) if store is not None else ChatLog(path)
+            try:
+                contents = log.read_all()
+            except Exception as e:
+                # 読めないログがあると参照を見落とすので、呼び出し側で削除を止められるよう投げ直す
+                raise RuntimeError(f"{path} を読めませんでした: {e}") from e
+            for content in contents:
+                for part in getattr(content, "parts", None) or []:
+                    file_data = getattr(part, "file_data", None)
+                    if file_data is not None and file_data.file_uri:
+                        referenced.add(file_name_from_uri(file_data.file_uri))
+    return referenced
+
+
+def select_files(files, older_than=None, patterns=None, keep=None, now=None):
+    """削除対象を絞る
+
+    older_than: 作成からの秒数がこれ以上のものだけ (作成日時が不明なものは対象にしない)
+    patterns: name か display_name がいずれかの glob に一致するものだけ
+    keep: 残すファイル名の集合 (referenced_file_ids の結果など)
+    """
+    now = now or time.time()
+    selected = []
+    for file in files:
+        if keep and file.name in keep:
+            continue
+        if older_than is not None:
+            if file.create_time is None or now - file.create_time.timestamp() < older_than:
+                continue
+        if patterns and not any(
+            fnmatch.fnmatch(file.name or "", pattern) or fnmatch.fnmatch(file.display_name or "", pattern)
+            for pattern in patterns
+        ):
+            continue
+        selected.append(file)
+    return selected
+
+
+class RateLimiter:
+    """rate 回/秒を超えないように呼び出しの間隔を空ける (0 なら制限しない)"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.next_time = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def delete_files(client, files, workers=8, rate=10, registry=None, on_result=None):
+    """files を並列に削除し、(削除した数, 失敗した数) を返す
+
+    削除したファイルは重複排除レジストリからも外す。on_result(file, error) を 1 件ごとに呼ぶ (成功なら error は None)。
+    """
+    pending = queue.Queue()
+    for file in files:
+        pending.put(file)
+    limiter = RateLimiter(rate)
+    results = {"deleted": 0, "failed": 0}
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            try:
+                file = pending.get_nowait()
+            except queue.Empty:
+                return
+            limiter.wait()
+            error = None
+            try:
+                client.files.delete(name=file.name)
+                if registry:
+                    registry.forget(file.name)
+            except Exception as e:
+                error = e
+            with lock:
+                results["failed" if error else "deleted"] += 1
+            if on_result:
+                on_result(file, error)
+
+    threads = [threading.Thread(target=work, daemon=True) for _ in range(max(1, min(workers, len(files))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results["deleted"], results["failed"]
+
+
+def sweep_local_files(data_dir, max_age, now=None):
+    """data/<user>/tmp_* と、放置された分割アップロードの書きかけ (uploads/*.part) のうち、
+    更新から max_age 秒以上経ったものを消す。消した数を返す"""
+    now = now or time.time()
+    removed = 0
+    for username in list_users(data_dir):
+        user_dir = os.path.join(data_dir, username)
+        candidates = [os.path.join(user_dir, name) for name in os.listdir(user_dir) if name.startswith(TMP_PREFIX)]
+        upload_dir = os.path.join(user_dir, "uploads")
+        if os.path.isdir(upload_dir):
+            candidates += [os.path.join(upload_dir, name) for name in os.listdir(upload_dir) if name.endswith(".part")]
+        for path in candidates:
+            try:
+                if os.path.isfile(path) and now - os.path.getmtime(path) >= max_age:
+                    os.remove(path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+    return removed
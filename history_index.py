@@ -0,0 +1,114 @@
+# -----------------------------------------------------------
+# チャット一覧 (past_chats) のリビジョン管理
+# -----------------------------------------------------------
+# 一覧全体を毎回送る代わりに、変更ごとにリビジョンを1つ進め、各チャットには最後に変わったときの
+# リビジョン (rev) を持たせる。削除したチャットは墓標 (removed) として残し、
+# 「リビジョン n より後の変更」を追加・更新 (upserts) と削除 (removed) の差分として返せるようにする。
+# 墓標は HISTORY_TOMBSTONES 件までで、それより古いリビジョンからの差分は出せない (一覧を取り直してもらう)。
+#
+# 保存形式: {"revision": int, "horizon": int, "chats": {chat_id: info}, "removed": {chat_id: rev}}
+# info は従来の {"title", "bookmarked"} に "updated" (最終更新時刻) と "rev" を加えたもの。
+import os
+import time
+
+HISTORY_TOMBSTONES = int(os.environ.get("HISTORY_TOMBSTONES", 1000))
+
+
+def empty_index():
+    return {"revision": 0, "horizon": 0, "chats": {}, "removed": {}}
+
+
+def upgrade_index(data):
+    """旧形式 (chat_id → info の dict) を読み込んだ場合は変換する"""
+    if isinstance(data, dict) and "revision" in data and isinstance(data.get("chats"), dict):
+        return data
+    index = empty_index()
+    if not data:
+        return index
+    index["revision"] = 1
+    for chat_id, info in data.items():
+        if not isinstance(info, dict):
+            info = {"title": info, "bookmarked": False}
+        index["chats"][chat_id] = dict(info, updated=info.get("updated", chat_created_time(chat_id)), rev=1)
+    return index
+
+
+def chat_created_time(chat_id):
+    # chat_id は作成時の time.time() の文字列
+    try:
+        return float(chat_id)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def apply_changes(index, past_chats):
+    """past_chats (chat_id → info) を新しい内容として index に反映する
+
+    変わったチャットがあればリビジョンを進めた新しい index と差分を返す。変化がなければ (index, None)。
+    """
+    revision = index["revision"] + 1
+    chats = {}
+    upserts = []
+    for chat_id, info in past_chats.items():
+        current = index["chats"].get(chat_id)
+        info = {key: value for key, value in info.items() if key != "rev"}
+        info.setdefault("updated", current["updated"] if current else time.time())
+        if current is not None and {k: v for k, v in current.items() if k != "rev"} == info:
+            chats[chat_id] = current
+            continue
+        chats[chat_id] = dict(info, rev=revision)
+        upserts.append(chat_id)
+    removed_now = [chat_id for chat_id in index["chats"] if chat_id not in past_chats]
+    if not upserts and not removed_now:
+        return index, None
+
+    removed = {chat_id: rev for chat_id, rev in index["removed"].items() if chat_id not in past_chats}
+    for chat_id in removed_now:
+        removed[chat_id] = revision
+    horizon = index["horizon"]
+    if len(removed) > HISTORY_TOMBSTONES:
+        # 古い墓標から捨て、その分だけ差分を出せる範囲 (horizon) を進める
+        dropped = sorted(removed.items(), key=lambda item: item[1])[:len(removed) - HISTORY_TOMBSTONES]
+        for chat_id, rev in dropped:
+            del removed[chat_id]
+            horizon = max(horizon, rev)
+    new_index = {"revision": revision, "horizon": horizon, "chats": chats, "removed": removed}
+    delta = {
+        "from_revision": index["revision"],
+        "revision": revision,
+        "upserts": [history_item(chat_id, chats[chat_id]) for chat_id in upserts],
+        "removed": removed_now,
+        "total": len(chats),
+    }
+    return new_index, delta
+
+
+def changes_since(index, revision):
+    """revision より後の差分を返す。墓標が残っていない古いリビジョンからは None"""
+    if revision < index["horizon"] or revision > index["revision"]:
+        return None
+    return {
+        "from_revision": revision,
+        "revision": index["revision"],
+        "upserts": [history_item(chat_id, info) for chat_id, info in index["chats"].items() if info["rev"] > revision],
+        "removed": [chat_id for chat_id, rev in index["removed"].items() if rev > revision],
+        "total": len(index["chats"]),
+    }
+
+
+def history_item(chat_id, info):
+    return {
+        "chat_id": chat_id,
+        "title": info.get("title", ""),
+        "bookmarked": bool(info.get("bookmarked")),
+        "updated": info.get("updated", 0.0),
+    }
+
+
+def history_page(index, offset, limit):
+    """ブックマークを先頭に、最終更新が新しい順に並べて offset から limit 件を返す"""
+    items = sorted(
+        (history_item(chat_id, info) for chat_id, info in index["chats"].items()),
+        key=lambda item: (not item["bookmarked"], -item["updated"]),
+    )
+    return items[offset:offset + limit]
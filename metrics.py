@@ -0,0 +1,342 @@
+# -----------------------------------------------------------
+# メトリクス (Prometheus のテキスト形式) とトレース
+# -----------------------------------------------------------
+# prometheus_client には依存せず、このプロセス専用のレジストリにカウンター・ゲージ・ヒストグラムを持つ。
+# /metrics (app.py) で REGISTRY.render() をそのまま返す。複数ワーカー構成ではワーカーごとに取得する。
+# 既存の統計 (auth_stats など) は値を読む関数を登録し、取得のたびに読む。
+#
+# TRACING を指定すると、span() で囲んだ区間を 1 行の JSON で出力する (log) か、
+# OpenTelemetry の span にする (otel、opentelemetry-api が必要)。
+# 同じ greenlet の中で入れ子になった span は同じ trace_id を持つ。
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+import contextvars
+from functools import wraps
+from contextlib import contextmanager
+
+import joblib
+
+TRACING = os.environ.get("TRACING", "")  # "" / log / otel
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+RATE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+BYTES_PER_SECOND_BUCKETS = tuple(2 ** n * 1024 for n in range(4, 18, 2))  # 16KiB/s 〜 128MiB/s
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(value)
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label_value(value)}"' for name, value in pairs) + "}"
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name}: ラベルは {self.labelnames} を指定してください")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        """[(サフィックス, ラベルの値, 追加のラベル, 値)]"""
+        with self.lock:
+            return [("", key, (), value) for key, value in self.values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, key, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{format_labels(self.labelnames, key, extra)} {format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class CallbackMetric(Metric):
+    """取得のたびに func() で値を読む。ラベルがあれば func はラベルの値の tuple → 値の dict を返す"""
+
+    def __init__(self, name, help, func, kind="gauge", labelnames=()):
+        super().__init__(name, help, labelnames)
+        self.kind = kind
+        self.func = func
+
+    def samples(self):
+        try:
+            value = self.func()
+        except Exception:
+            return []
+        if not self.labelnames:
+            return [("", (), (), value)]
+        return [("", tuple(str(v) for v in key), (), v) for key, v in value.items()]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, (counts, total, count) in self.values.items():
+                cumulative = 0
+                for bound, n in zip(self.buckets, counts):
+                    cumulative += n
+                    samples.append(("_bucket", key, (("le", format_value(float(bound))),), cumulative))
+                samples.append(("_sum", key, (), total))
+                samples.append(("_count", key, (), count))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError(f"{metric.name} は登録済みです")
+            self.metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help, labelnames=()):
+    return REGISTRY.register(Counter(name, help, labelnames))
+
+
+def gauge(name, help, labelnames=()):
+    return REGISTRY.register(Gauge(name, help, labelnames))
+
+
+def histogram(name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+    return REGISTRY.register(Histogram(name, help, labelnames, buckets))
+
+
+def callback(name, help, func, kind="gauge", labelnames=()):
+    return REGISTRY.register(CallbackMetric(name, help, func, kind, labelnames))
+
+
+def size_class(nbytes):
+    """ファイルサイズをラベル用の区分にする (値そのものをラベルにすると系列が増え続けるため)"""
+    for limit, label in ((64 * 1024, "<64KiB"), (1024 * 1024, "<1MiB"), (16 * 1024 * 1024, "<16MiB")):
+        if nbytes < limit:
+            return label
+    return ">=16MiB"
+
+
+# ------------------------
+# 複数のモジュールで使う計測
+# ------------------------
+file_lock_wait = histogram("file_lock_wait_seconds", "FileLock の取得を待った時間")
+joblib_seconds = histogram("joblib_seconds", "joblib の load / dump にかかった時間", ("op", "size"))
+sqlite_seconds = histogram("sqlite_query_seconds", "SQLite の execute にかかった時間", ("db", "op"))
+
+
+@contextmanager
+def timed_lock(lock):
+    """FileLock などを取得し、待った時間を記録する"""
+    started = time.perf_counter()
+    with lock:
+        file_lock_wait.observe(time.perf_counter() - started)
+        yield
+
+
+def timed_joblib_load(path):
+    started = time.perf_counter()
+    value = joblib.load(path)
+    joblib_seconds.observe(time.perf_counter() - started, op="load", size=size_class(os.path.getsize(path)))
+    return value
+
+
+def timed_joblib_dump(value, path):
+    started = time.perf_counter()
+    joblib.dump(value, path)
+    joblib_seconds.observe(time.perf_counter() - started, op="dump", size=size_class(os.path.getsize(path)))
+
+
+class TimedConnection(sqlite3.Connection):
+    """sqlite3.connect(..., factory=TimedConnection) で、execute ごとの時間を記録する
+
+    SELECT の行を読み出す時間 (fetchall など) は含まない。
+    """
+
+    def __init__(self, database, *args, **kwargs):
+        super().__init__(database, *args, **kwargs)
+        self.db_label = os.path.basename(str(database))
+
+    def _timed(self, method, sql, *args):
+        started = time.perf_counter()
+        try:
+            return method(sql, *args)
+        finally:
+            op = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else "?"
+            sqlite_seconds.observe(time.perf_counter() - started, db=self.db_label, op=op)
+
+    def execute(self, sql, *args):
+        return self._timed(super().execute, sql, *args)
+
+    def executemany(self, sql, *args):
+        return self._timed(super().executemany, sql, *args)
+
+    def executescript(self, sql):
+        return self._timed(super().executescript, sql)
+
+
+# ------------------------
+# トレース
+# ------------------------
+current_span = contextvars.ContextVar("current_span", default=None)
+_otel_tracer = None
+
+
+def otel_tracer():
+    global _otel_tracer
+    if _otel_tracer is None:
+        from opentelemetry import trace  # TRACING=otel のときだけ必要
+        _otel_tracer = trace.get_tracer("flask-gemini")
+    return _otel_tracer
+
+
+@contextmanager
+def span(name, **attributes):
+    """区間をトレースとして記録する。TRACING が空なら何もしない
+
+    yield した dict に値を入れると、終了時に属性として出力する。
+    """
+    if not TRACING:
+        yield attributes
+        return
+    if TRACING == "otel":
+        with otel_tracer().start_as_current_span(name) as otel_span:
+            yield attributes
+            for key, value in attributes.items():
+                otel_span.set_attribute(key, value if isinstance(value, (str, bool, int, float)) else str(value))
+        return
+    parent = current_span.get()
+    record = {
+        "trace_id": parent["trace_id"] if parent else uuid.uuid4().hex,
+        "span_id": uuid.uuid4().hex[:16],
+        "parent_id": parent["span_id"] if parent else None,
+        "name": name,
+    }
+    record["attributes"] = attributes
+    token = current_span.set(record)
+    started = time.time()
+    error = None
+    try:
+        yield attributes
+    except BaseException as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        current_span.reset(token)
+        record.update(start=started, duration_ms=round((time.time() - started) * 1000, 3))
+        if error:
+            record["error"] = error
+        print("[trace] " + json.dumps(record, ensure_ascii=False, default=str))
+
+
+def annotate(**attributes):
+    """実行中の span に属性を足す (span の外や TRACING が空なら何もしない)"""
+    if TRACING == "otel":
+        from opentelemetry import trace
+        otel_span = trace.get_current_span()
+        for key, value in attributes.items():
+            otel_span.set_attribute(key, value if isinstance(value, (str, bool, int, float)) else str(value))
+        return
+    record = current_span.get()
+    if record is not None:
+        record["attributes"].update(attributes)
+
+
+def traced(name):
+    """関数全体を span で囲むデコレーター"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
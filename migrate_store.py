@@ -0,0 +1,182 @@
+"""従来のファイル (data/<user>/ の joblib・追記型ログ) を集約ストア (consolidated_store.py) に移すツール
+
+    python migrate_store.py                  # すべてのユーザーを移行する
+    python migrate_store.py --workers 8      # 8 プロセスで並列に移行する
+    python migrate_store.py --remove-old     # 件数を確かめたうえで従来のファイル (.lock も) を消す
+    python migrate_store.py --verify-only    # 取り込まずに件数だけ確かめる
+
+ログ 1 つごとに取り込みをコミットするので、途中で止めてもう一度実行すれば続きから進む
+(取り込み済みのログは読み直して件数を確かめるだけ)。最後まで終わったユーザーは次回から飛ばす。
+移行中はアプリを止めておくか、CHAT_STORE=db で動かしておくこと。
+CHAT_STORE=files のまま動いているアプリが書き込んだ分は取り込まれない。
+元のファイルは読むだけで変換も移動もしない。読めないファイルや .corrupt が残っているユーザーは
+NG として移行済みにせず、そのファイルも消さない。
+"""
+import os
+import sys
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from chat_store import ChatLog, FileDocument, list_chat_logs
+from consolidated_store import ConsolidatedStore, CHAT_STORE_DB, encode_record
+from history_index import upgrade_index
+
+DATA_DIR = "data/"
+LOG_SUFFIXES = ("-st_messages", "-gemini_messages", "-gemini_tokens", "-context_summary", "-turn_index")
+PAST_CHATS = "past_chats_list"
+
+
+def list_users(data_dir):
+    return sorted(
+        name for name in os.listdir(data_dir) if os.path.isdir(os.path.join(data_dir, name))
+    )
+
+
+def migrate_user(data_dir, db_file, username, remove_old=False, verify_only=False):
+    """1 ユーザー分を取り込んで確かめる。結果を dict で返す (プロセスプールから呼ぶ)"""
+    store = ConsolidatedStore(db_file, pool_size=1)
+    user_dir = os.path.join(data_dir, username)
+    report = {"username": username, "imported": 0, "existing": 0, "records": 0, "removed": 0, "errors": []}
+
+    for suffix in LOG_SUFFIXES:
+        for chat_id in list_chat_logs(user_dir, suffix):
+            name = chat_id + suffix
+            path = os.path.join(user_dir, name)
+            try:
+                records = ChatLog(path).read_unchanged()  # --verify-only でも元のファイルを変えない
+                encoded = [encode_record(record) for record in records]  # 変換できないレコードはここで失敗させる
+                if not verify_only:
+                    with store.write() as conn:
+                        imported = store.import_log(conn, username, name, records)
+                    report["imported" if imported else "existing"] += 1
+                error = verify_log(store, username, name, encoded)
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+            if error:
+                report["errors"].append(f"{name}: {error}")
+                continue
+            report["records"] += len(records)
+            if remove_old and not verify_only:
+                ChatLog(path).delete()
+                report["removed"] += remove_files(path + ".lock")
+
+    # アプリが読めずに脇に移したログ。list_chat_logs には出てこないので、ここで失敗として数える
+    for name in sorted(os.listdir(user_dir)):
+        if name.endswith(".corrupt"):
+            report["errors"].append(f"{name}: 読めなかったため脇に移されたファイルです (中身を確かめて戻すか消してください)")
+
+    path = os.path.join(user_dir, PAST_CHATS)
+    if os.path.exists(path):
+        try:
+            value, _, _ = FileDocument(path, upgrade_index).read_state(strict=True)
+            if not verify_only:
+                with store.write() as conn:
+                    store.import_document(conn, username, PAST_CHATS, value)
+            with store.read() as conn:
+                stored = store.document_state(conn, username, PAST_CHATS)
+            if stored is None:
+                report["errors"].append(f"{PAST_CHATS}: ストアにありません")
+            elif remove_old and not verify_only:
+                report["removed"] += remove_files(path, path + ".lock")
+        except Exception as e:
+            report["errors"].append(f"{PAST_CHATS}: {type(e).__name__}: {e}")
+
+    if not report["errors"] and not verify_only:
+        with store.write() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO migrated_users (username, logs, records, finished) VALUES (?, ?, ?, ?)",
+                (username, report["imported"] + report["existing"], report["records"], time.time()),
+            )
+    return report
+
+
+def verify_log(store, username, name, encoded):
+    """ストア上のログが元のファイルと合っているか確かめる。問題があれば説明を返す"""
+    with store.read() as conn:
+        state = store.log_state(conn, username, name)
+        if state is None:
+            return "ストアにありません"
+        version, count, _ = state
+        stored = store.count_records(conn, username, name)
+        if stored != count:
+            return f"件数の記録 ({count}) と実際のレコード数 ({stored}) が合いません"
+        if version > 1:
+            # 取り込み後にアプリが書き込んだログは元のファイルと比べられない
+            return None
+        if stored != len(encoded):
+            return f"件数が合いません (ファイル {len(encoded)} 件 / ストア {stored} 件)"
+        if encoded:
+            last = conn.execute(
+                "SELECT data FROM records WHERE username = ? AND name = ? AND seq = ?",
+                (username, name, len(encoded) - 1),
+            ).fetchone()[0]
+            if last != encoded[-1]:
+                return "最後のレコードの内容が合いません"
+    return None
+
+
+def remove_files(*paths):
+    removed = 0
+    for path in paths:
+        try:
+            os.remove(path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="チャット履歴を集約ストアに移行するツール")
+    parser.add_argument("--data-dir", default=DATA_DIR, help="ユーザーデータのディレクトリ (既定: data/)")
+    parser.add_argument("--db", default=CHAT_STORE_DB, help="移行先の SQLite ファイル (既定: CHAT_STORE_DB)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="並列に動かすプロセス数")
+    parser.add_argument("--users", nargs="*", help="移行するユーザー (省略時はすべて)")
+    parser.add_argument("--remove-old", action="store_true", help="確認できたログの従来のファイルを消す")
+    parser.add_argument("--verify-only", action="store_true", help="取り込まずに件数だけ確かめる")
+    parser.add_argument("--force", action="store_true", help="移行済みのユーザーもやり直す")
+    args = parser.parse_args()
+
+    store = ConsolidatedStore(args.db)
+    store.init_db()
+    users = args.users or list_users(args.data_dir)
+    if not (args.force or args.remove_old or args.verify_only):
+        with store.read() as conn:
+            finished = {name for (name,) in conn.execute("SELECT username FROM migrated_users")}
+        skipped = [name for name in users if name in finished]
+        users = [name for name in users if name not in finished]
+        if skipped:
+            print(f"移行済みの {len(skipped)} ユーザーを飛ばします (--force でやり直し)")
+
+    started = time.time()
+    totals = {"imported": 0, "existing": 0, "records": 0, "removed": 0}
+    failed = []
+    with ProcessPoolExecutor(max_workers=max(1, args.workers)) as pool:
+        futures = [
+            pool.submit(migrate_user, args.data_dir, args.db, username, args.remove_old, args.verify_only)
+            for username in users
+        ]
+        for done, future in enumerate(as_completed(futures), 1):
+            report = future.result()
+            for key in totals:
+                totals[key] += report[key]
+            status = "NG" if report["errors"] else "OK"
+            print(f"[{done}/{len(users)}] {status} {report['username']}: "
+                  f"取り込み {report['imported']} / 取り込み済み {report['existing']} / "
+                  f"{report['records']} レコード / 削除 {report['removed']} ファイル")
+            for error in report["errors"]:
+                print(f"    {error}")
+            if report["errors"]:
+                failed.append(report["username"])
+
+    print(f"\n=== {len(users)} ユーザー ({time.time() - started:.1f} 秒) ===")
+    print(f"取り込んだログ: {totals['imported']} / 取り込み済みだったログ: {totals['existing']} / "
+          f"レコード: {totals['records']} / 削除したファイル: {totals['removed']}")
+    if failed:
+        print(f"確認できなかったユーザー: {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
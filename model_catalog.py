@@ -0,0 +1,96 @@
+# -----------------------------------------------------------
+# モデル一覧のキャッシュ
+# -----------------------------------------------------------
+# client.models.list() の結果をプロセス全体で1つだけ持ち、TTL ごとにバックグラウンドで取り直す。
+# 期限切れでも古い一覧をすぐに返し (stale-while-revalidate)、取り直しは同時に1つしか走らせない。
+# get_model_list には更新時に組み立て済みの応答をそのまま返す。
+import os
+import time
+import threading
+
+MODEL_LIST_TTL = float(os.environ.get("MODEL_LIST_TTL", 10 * 60))
+# 取得に失敗したときに再試行するまでの間隔
+MODEL_LIST_RETRY = float(os.environ.get("MODEL_LIST_RETRY", 30))
+
+# グラウンディングやコード実行を使える Gemini モデル (API からは取れないので名前で判定する目安)
+TOOL_MODEL_PREFIXES = ("models/gemini-1.5", "models/gemini-2", "models/gemini-exp")
+
+
+def model_capabilities(model):
+    actions = model.supported_actions or []
+    tools = []
+    if "generateContent" in actions and model.name.startswith(TOOL_MODEL_PREFIXES):
+        tools = ["google_search", "code_execution"]
+    return {
+        "display_name": model.display_name,
+        "input_token_limit": model.input_token_limit,
+        "output_token_limit": model.output_token_limit,
+        "supported_actions": actions,
+        "tools": tools,
+    }
+
+
+class ModelCatalog:
+    def __init__(self, client, extra_models=(), ttl=MODEL_LIST_TTL):
+        self.client = client
+        self.extra_models = [m.strip() for m in extra_models if m.strip()]
+        self.ttl = ttl
+        self.payload = None  # model_list イベントでそのまま返す dict
+        self.capabilities = {}
+        self.expires = 0.0
+        self.lock = threading.Lock()  # 取得中は保持する (取得を同時に1つに絞る)
+        self.refresh_count = 0
+
+    def get(self):
+        """一覧を返す。期限切れならバックグラウンドで取り直し、その間は古い一覧を返す"""
+        if self.payload is None:
+            # 起動直後の最初の1回だけは取得を待つ (同時に来た接続は同じ取得を待つ)
+            with self.lock:
+                if self.payload is None:
+                    self._refresh_locked()
+            return self.payload
+        if time.time() >= self.expires:
+            self.refresh_async()
+        return self.payload
+
+    def get_capabilities(self, model_name):
+        return self.capabilities.get(model_name)
+
+    def refresh_async(self):
+        # 取得中なら何もしない (待たずに古い一覧を返す)
+        if not self.lock.acquire(blocking=False):
+            return
+        threading.Thread(target=self._refresh_background, daemon=True).start()
+
+    def start(self, interval=None):
+        """期限切れを待たずに定期的に取り直すループを起動する"""
+        def loop():
+            while True:
+                self.refresh_async()
+                time.sleep(interval or self.ttl)
+        threading.Thread(target=loop, daemon=True).start()
+
+    def _refresh_background(self):
+        try:
+            self._refresh_locked()
+        finally:
+            self.lock.release()
+
+    def _refresh_locked(self):
+        try:
+            api_models = list(self.client.models.list())
+        except Exception as e:
+            print(f"[models] モデル一覧の取得に失敗しました: {e}")
+            self.expires = time.time() + MODEL_LIST_RETRY
+            if self.payload is None:
+                # API が使えなくても .env の MODELS だけで動けるようにする
+                self._publish({})
+            return
+        self._publish({m.name: model_capabilities(m) for m in api_models})
+        self.expires = time.time() + self.ttl
+        self.refresh_count += 1
+
+    def _publish(self, capabilities):
+        names = sorted(set(list(capabilities) + self.extra_models))
+        self.capabilities = capabilities
+        self.payload = {"models": names, "capabilities": {name: capabilities.get(name) for name in names}}
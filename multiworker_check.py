@@ -0,0 +1,219 @@
+"""複数ワーカー構成の動作確認スクリプト
+
+app.py を N 個のプロセスとして別々のポートで起動し、次のことを確認する。
+  1. あるワーカーでの変更 (チャット名の変更) が、別のワーカーに接続しているタブに届く
+  2. 別のワーカーから送ったキャンセルで生成が止まり、Gemini への接続も閉じられる
+  3. 分割アップロードのチャンクをワーカーごとに振り分けても完了できる
+
+Gemini API の代わりにこのスクリプト内の疑似サーバーを使う (GEMINI_BASE_URL で差し替える)。
+Redis 互換サーバーは --redis-url で指定する。省略すると fakeredis の TCP サーバーを代わりに起動する。
+
+    pip install "python-socketio[client]" fakeredis
+    python multiworker_check.py --workers 3
+"""
+import os
+import sys
+import json
+import time
+import socket
+import tempfile
+import argparse
+import threading
+import subprocess
+import http.server
+
+import requests
+import socketio
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+CHUNK_INTERVAL = 0.2
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class FakeGemini(http.server.BaseHTTPRequestHandler):
+    """streamGenerateContent の代わりに、ゆっくりチャンクを返し続ける"""
+
+    protocol_version = "HTTP/1.1"
+    disconnected = threading.Event()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for i in range(200):
+                data = {"candidates": [{"content": {"role": "model", "parts": [{"text": f"chunk{i} "}]}}]}
+                line = f"data: {json.dumps(data)}\r\n\r\n".encode()
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+                self.wfile.flush()
+                time.sleep(CHUNK_INTERVAL)
+            self.wfile.write(b"0\r\n\r\n")
+        except OSError:
+            FakeGemini.disconnected.set()
+
+    def do_GET(self):
+        # models.list 用 (モデル一覧は空でよい)
+        body = b'{"models": []}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_fake_redis():
+    from fakeredis import TcpFakeServer
+    port = free_port()
+    server = TcpFakeServer(("127.0.0.1", port), server_type="redis")
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"redis://127.0.0.1:{port}/0"
+
+
+def start_workers(count, redis_url, gemini_url, data_dir):
+    workers = []
+    for _ in range(count):
+        port = free_port()
+        env = dict(
+            os.environ,
+            GOOGLE_API_KEY="dummy", VERSION="check", GEMINI_BASE_URL=gemini_url,
+            SOCKETIO_MESSAGE_QUEUE=redis_url, PORT=str(port), HOST="127.0.0.1", DEBUG="0",
+            UPLOAD_BACKEND="local", UPLOAD_CHUNK_SIZE=str(256 * 1024), BCRYPT_ROUNDS="4",
+        )
+        process = subprocess.Popen(
+            [sys.executable, APP_PATH], cwd=data_dir, env=env,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        workers.append((process, f"http://127.0.0.1:{port}"))
+    for process, url in workers:
+        for _ in range(100):
+            if process.poll() is not None:
+                raise RuntimeError(f"ワーカーが起動できませんでした: {url}")
+            try:
+                requests.get(url, timeout=1)
+                break
+            except requests.ConnectionError:
+                time.sleep(0.2)
+        else:
+            raise RuntimeError(f"ワーカーが応答しません: {url}")
+    return workers
+
+
+class Tab:
+    """1つのワーカーに WebSocket で接続したクライアント"""
+
+    def __init__(self, url):
+        self.events = []
+        self.client = socketio.Client()
+        self.client.on("*", lambda event, data=None: self.events.append((event, data)))
+        self.client.connect(url, transports=["websocket"])
+
+    def call(self, event, data, reply, timeout=10):
+        start = len(self.events)
+        self.client.emit(event, data)
+        return self.wait(reply, timeout, start)
+
+    def wait(self, event, timeout=10, start=0, match=lambda data: True):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            for name, data in self.events[start:]:
+                if name == event and match(data):
+                    return data
+            time.sleep(0.05)
+        return None
+
+    def count(self, event):
+        return sum(1 for name, _ in self.events if name == event)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="複数ワーカー構成の動作確認")
+    parser.add_argument("--workers", type=int, default=3, help="起動するワーカー数 (2 以上)")
+    parser.add_argument("--redis-url", help="Redis 互換サーバーの URL (省略時は fakeredis を起動)")
+    args = parser.parse_args()
+    if args.workers < 2:
+        parser.error("--workers は 2 以上を指定してください")
+
+    gemini_port = free_port()
+    gemini = http.server.ThreadingHTTPServer(("127.0.0.1", gemini_port), FakeGemini)
+    threading.Thread(target=gemini.serve_forever, daemon=True).start()
+    redis_url = args.redis_url or start_fake_redis()
+
+    results = []
+    with tempfile.TemporaryDirectory() as data_dir:
+        workers = start_workers(args.workers, redis_url, f"http://127.0.0.1:{gemini_port}/", data_dir)
+        try:
+            tab_a = Tab(workers[0][1])
+            tab_b = Tab(workers[1][1])
+            tab_a.call("register", {"username": "check", "password": "pw"}, "register_response")
+            token = tab_a.call("login", {"username": "check", "password": "pw"}, "login_response")["auto_login_token"]
+            tab_b.call("auto_login", {"token": token}, "auto_login_response")
+
+            # タブ A (ワーカー 0) で生成を開始する
+            tab_a.client.emit("send_message", {
+                "token": token, "chat_id": "c1", "model_name": "models/fake", "message": "hello", "request_id": "r1",
+            })
+            ok = tab_a.wait("gemini_response_chunk", match=lambda d: d.get("request_id") == "r1") is not None
+            results.append(("生成の開始", ok))
+
+            # 1) タブ B (ワーカー 1) での名前変更がタブ A に届く
+            start = len(tab_a.events)
+            tab_b.client.emit("rename_chat", {"token": token, "chat_id": "c1", "new_title": "renamed"})
+            received = tab_a.wait(
+                "history_delta", start=start,
+                match=lambda d: any(item["chat_id"] == "c1" and item["title"] == "renamed" for item in d["upserts"]),
+            )
+            results.append(("別ワーカーからの送信", received is not None))
+
+            # 2) タブ B からのキャンセルでワーカー 0 の生成が止まる
+            tab_b.client.emit("cancel_stream", {"token": token, "chat_id": "c1", "request_id": "r1"})
+            time.sleep(1.0)
+            chunks = tab_a.count("gemini_response_chunk")
+            time.sleep(1.0)
+            stopped = tab_a.count("gemini_response_chunk") == chunks
+            results.append(("別ワーカーからのキャンセル", stopped))
+            results.append(("Gemini への接続の切断", FakeGemini.disconnected.wait(timeout=2)))
+            loaded = tab_b.call("load_chat", {"token": token, "chat_id": "c1"}, "chat_loaded")
+            # history_saved はキャンセル時の保存でだけ付く (定期的な途中保存では付かない)
+            saved = loaded and loaded["messages"][-1].get("history_saved")
+            results.append(("途中までの応答の保存", bool(saved)))
+
+            # 3) 分割アップロードのチャンクを別々のワーカーに送る
+            data = os.urandom(256 * 1024 * (len(workers) - 1) + 1000)
+            session = requests.post(f"{workers[0][1]}/upload_session", json={
+                "token": token, "file_name": "check.pdf", "file_size": len(data), "mime_type": "application/pdf",
+            }).json()
+            for i in range(len(workers)):
+                offset = session["offset"]
+                session = requests.put(
+                    f"{workers[i][1]}/upload_session/{session['upload_id']}",
+                    data=data[offset:offset + session["chunk_size"]],
+                    headers={"X-Auth-Token": token, "X-Upload-Offset": str(offset)},
+                ).json()
+            results.append(("ワーカーをまたいだ分割アップロード", session.get("status") == "success"))
+
+            tab_a.client.disconnect()
+            tab_b.client.disconnect()
+        finally:
+            for process, _ in workers:
+                process.terminate()
+            for process, _ in workers:
+                process.wait(timeout=10)
+            gemini.shutdown()
+
+    for name, ok in results:
+        print(f"[{'OK' if ok else 'NG'}] {name}")
+    sys.exit(0 if all(ok for _, ok in results) else 1)
+
+
+if __name__ == "__main__":
+    main()
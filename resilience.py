@@ -0,0 +1,205 @@
+# -----------------------------------------------------------
+# 応答ストリームの再試行・サーキットブレーカー・モデルの切り替え
+# -----------------------------------------------------------
+# 429 / 5xx や接続エラーの場合は、ジッター付きの指数バックオフを挟んで送り直す (最大 RETRY_ATTEMPTS 回)。
+# 送り直すのは最初のチャンクを受け取る前だけで、クライアントに何か送った後は送り直さない
+# (途中で切れた応答は従来どおり partial として保存する)。
+#
+# モデルごとに連続した失敗を数え、CIRCUIT_FAILURES 回続いたら CIRCUIT_COOLDOWN 秒そのモデルを使わない。
+# 期限が過ぎたら 1 件だけ試し、成功すれば元に戻す。
+# MODEL_FAILOVER に同等のモデルを指定しておくと、ブレーカーが開いているときにそちらで送る。
+# 切り替え先があるときだけ、最初のチャンクが FIRST_CHUNK_TIMEOUT 秒以内に届かなければ待つのをやめて切り替える
+# (長いプロンプトの思考モデルは最初のチャンクまでに時間がかかるので、同じモデルでは送り直さず、ブレーカーにも数えない)。
+#   MODEL_FAILOVER={"models/gemini-2.5-pro": ["models/gemini-2.5-flash"]}
+import os
+import json
+import time
+import random
+import threading
+
+import requests
+from google.genai import errors
+
+from metrics import counter, callback
+
+RETRY_ATTEMPTS = max(1, int(os.environ.get("RETRY_ATTEMPTS", 3)))  # 最初の 1 回を含む
+RETRY_BASE_DELAY = float(os.environ.get("RETRY_BASE_DELAY", 1.0))
+RETRY_MAX_DELAY = float(os.environ.get("RETRY_MAX_DELAY", 20.0))
+# 切り替え先のモデルがあるときの、最初のチャンクを待つ秒数 (0 なら待ち時間を制限しない)
+FIRST_CHUNK_TIMEOUT = float(os.environ.get("FIRST_CHUNK_TIMEOUT", 60))
+CIRCUIT_FAILURES = int(os.environ.get("CIRCUIT_FAILURES", 5))
+CIRCUIT_COOLDOWN = float(os.environ.get("CIRCUIT_COOLDOWN", 30))
+MODEL_FAILOVER = json.loads(os.environ.get("MODEL_FAILOVER") or "{}")
+
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+retries = counter("gemini_retries_total", "送り直した回数", ("model", "reason"))
+failovers = counter("gemini_failovers_total", "別のモデルに切り替えた回数", ("from_model", "to_model"))
+
+
+class FirstChunkTimeout(Exception):
+    """最初のチャンクが期限内に届かなかった"""
+
+
+class CircuitOpenError(Exception):
+    """使えるモデルがない (すべてのブレーカーが開いている)"""
+
+
+def error_reason(error):
+    """メトリクスのラベル用の失敗の種類"""
+    if isinstance(error, FirstChunkTimeout):
+        return "first_chunk_timeout"
+    if isinstance(error, errors.APIError):
+        return str(error.code)
+    return "connection"
+
+
+def is_retryable(error):
+    if isinstance(error, FirstChunkTimeout):
+        return True
+    if isinstance(error, errors.APIError):
+        return error.code in RETRYABLE_STATUS
+    return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                              ConnectionError, TimeoutError))
+
+
+def retry_delay_hint(error):
+    """429 の応答に RetryInfo があれば、指定された待ち時間 (秒) を返す"""
+    details = getattr(error, "details", None)
+    if not isinstance(details, dict):
+        return None
+    for detail in details.get("error", details).get("details") or []:
+        if isinstance(detail, dict) and detail.get("@type", "").endswith("RetryInfo"):
+            try:
+                return float(str(detail.get("retryDelay", "")).rstrip("s"))
+            except ValueError:
+                return None
+    return None
+
+
+def backoff_delay(attempt, error=None):
+    """attempt 回目 (0 始まり) の失敗の後に待つ秒数 (full jitter)"""
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+    hint = retry_delay_hint(error)
+    if hint:
+        delay = max(delay, hint)
+    return min(delay, RETRY_MAX_DELAY)
+
+
+def candidate_models(model_name):
+    short_name = model_name[len("models/"):] if model_name.startswith("models/") else model_name
+    fallbacks = MODEL_FAILOVER.get(model_name) or MODEL_FAILOVER.get(short_name) or []
+    return [model_name] + [name for name in fallbacks if name != model_name]
+
+
+class CircuitBreaker:
+    def __init__(self, failures=CIRCUIT_FAILURES, cooldown=CIRCUIT_COOLDOWN):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.models = {}  # モデル → {"failures", "opened", "trial"}
+        self.lock = threading.Lock()
+
+    def allow(self, model_name):
+        """このモデルに送ってよいか。期限が過ぎた開いたブレーカーは 1 件だけ通す"""
+        with self.lock:
+            state = self.models.get(model_name)
+            if state is None or state["opened"] is None:
+                return True
+            if state["trial"] or time.monotonic() - state["opened"] < self.cooldown:
+                return False
+            state["trial"] = True
+            return True
+
+    def is_open(self, model_name):
+        """ブレーカーが開いていて期限も過ぎていないか (allow と違い試行の枠を取らない)"""
+        with self.lock:
+            state = self.models.get(model_name)
+            return (state is not None and state["opened"] is not None
+                    and time.monotonic() - state["opened"] < self.cooldown)
+
+    def release_trial(self, model_name):
+        """成功とも失敗とも数えずに、取った試行の枠だけを返す"""
+        with self.lock:
+            state = self.models.get(model_name)
+            if state is not None:
+                state["trial"] = False
+
+    def success(self, model_name):
+        with self.lock:
+            self.models.pop(model_name, None)
+
+    def failure(self, model_name):
+        with self.lock:
+            state = self.models.setdefault(model_name, {"failures": 0, "opened": None, "trial": False})
+            state["failures"] += 1
+            if state["trial"] or (self.failures and state["failures"] >= self.failures):
+                if state["opened"] is None or state["trial"]:
+                    print(f"[resilience] {model_name} を {self.cooldown:.0f} 秒使いません (連続 {state['failures']} 回失敗)")
+                state["opened"] = time.monotonic()
+                state["trial"] = False
+
+    def states(self):
+        """モデル → 0 (閉じている) / 1 (開いている)"""
+        with self.lock:
+            return {(name,): int(state["opened"] is not None) for name, state in self.models.items()}
+
+
+circuit_breaker = CircuitBreaker()
+
+callback("gemini_circuit_open", "ブレーカーが開いているモデル (1) と失敗が続いているモデル (0)",
+         circuit_breaker.states, labelnames=("model",))
+
+
+def run_with_failover(model_name, start, sleep):
+    """start(モデル名, 最初のチャンクの期限) が成功するまで送り直し、(使ったモデル, start の戻り値) を返す
+
+    start は最初のチャンクを受け取るところまで進める関数。失敗したら例外を投げる。
+    期限 (秒) は切り替え先のモデルがあるときだけ渡し、それ以外は None (待ち続ける)。
+    sleep(秒) はバックオフの間待つ関数で、待っている間にキャンセルされたら True を返す (そのときは (None, None))。
+    start が None を返したとき (送る前にキャンセルされたとき) も (None, None)。
+    送り直せない失敗や、最後の試行の失敗はそのまま投げる。
+    """
+    candidates = candidate_models(model_name)
+    index = 0
+    previous = None
+    for attempt in range(RETRY_ATTEMPTS):
+        model = next((name for name in candidates[index:] if circuit_breaker.allow(name)), None)
+        if model is None:
+            raise CircuitOpenError(f"{model_name} は一時的に利用できません。しばらくしてから再度お試しください。")
+        index = candidates.index(model)
+        if previous is not None and model != previous:
+            failovers.inc(from_model=previous, to_model=model)
+            print(f"[resilience] {previous} から {model} に切り替えます")
+        previous = model
+        can_fail_over = attempt < RETRY_ATTEMPTS - 1 and any(
+            not circuit_breaker.is_open(name) for name in candidates[index + 1:]
+        )
+        try:
+            result = start(model, FIRST_CHUNK_TIMEOUT if FIRST_CHUNK_TIMEOUT and can_fail_over else None)
+        except FirstChunkTimeout as e:
+            # 遅いだけでモデルは動いていることが多いので、ブレーカーには数えず同じモデルでも送り直さない
+            circuit_breaker.release_trial(model)
+            print(f"[resilience] {model} の送信に失敗しました ({attempt + 1}/{RETRY_ATTEMPTS}): {e}")
+            retries.inc(model=model, reason=error_reason(e))
+            index += 1
+            continue
+        except Exception as e:
+            if not is_retryable(e):
+                if isinstance(e, errors.APIError):
+                    circuit_breaker.success(model)  # モデル自体は応答している (リクエストの誤りなど)
+                else:
+                    circuit_breaker.release_trial(model)  # 送る前の失敗 (混雑で断られたなど)
+                raise
+            circuit_breaker.failure(model)
+            print(f"[resilience] {model} の送信に失敗しました ({attempt + 1}/{RETRY_ATTEMPTS}): {e}")
+            if attempt == RETRY_ATTEMPTS - 1:
+                raise
+            retries.inc(model=model, reason=error_reason(e))
+            if sleep(backoff_delay(attempt, e)):
+                return None, None
+            continue
+        if result is None:
+            circuit_breaker.release_trial(model)
+            return None, None
+        circuit_breaker.success(model)
+        return model, result
@@ -0,0 +1,231 @@
+# -----------------------------------------------------------
+# Gemini への応答ストリームの受け付け制御
+# -----------------------------------------------------------
+# send_message_stream を始める前に acquire() で枠を取り、ストリームが終わったら release() で返す。
+#   - 同時に流すストリームの数をプロセス全体 (UPSTREAM_CONCURRENCY) とモデルごと (UPSTREAM_MODEL_CONCURRENCY) で制限する
+#   - ユーザーごとのトークンバケット (USER_TOKEN_RATE / USER_TOKEN_BURST) で、一定時間に使えるトークン数を制限する
+#   - 待っている要求はユーザー間で重み付き公平キュー (開始時刻公平キューイング) の順に通す。
+#     要求ごとの重さは送る履歴の推定トークン数なので、大きな添付を続けて送るユーザーが他のユーザーを待たせ続けない
+# 待っている間は notify(位置, 待ち数) を呼ぶ (app.py が queue_position イベントとして送る)。
+# 別のモデルに切り替えて送り直すときは switch() で付け替え、切り替え先のモデルの制限で数える。
+# 制限はワーカーごとに効く。複数ワーカー構成では、ワーカー数で割った値を指定する。
+import os
+import json
+import time
+import threading
+
+from metrics import counter, histogram, callback
+
+# 既定ではどの制限も掛けない (指定したものだけが効く)。0 は制限なし
+UPSTREAM_CONCURRENCY = int(os.environ.get("UPSTREAM_CONCURRENCY", 0))
+# モデル名 (または "*") → 同時に流せる数。例: {"models/gemini-2.5-pro": 4, "*": 16}
+UPSTREAM_MODEL_CONCURRENCY = json.loads(os.environ.get("UPSTREAM_MODEL_CONCURRENCY") or "{}")
+# ユーザーごとに 1 秒あたりに補充するトークン数 (0 ならトークンバケットを使わない) と、貯められる上限
+USER_TOKEN_RATE = float(os.environ.get("USER_TOKEN_RATE", 0))
+USER_TOKEN_BURST = float(os.environ.get("USER_TOKEN_BURST", 1_000_000))
+# ユーザー名 → 重み (省略時は 1)。重み 2 のユーザーは混雑時に 2 倍のトークン数を通せる
+USER_WEIGHTS = json.loads(os.environ.get("USER_WEIGHTS") or "{}")
+# これより長く待たせた要求は断る (0 なら断らない)
+UPSTREAM_QUEUE_TIMEOUT = float(os.environ.get("UPSTREAM_QUEUE_TIMEOUT", 0))
+# 待っている要求がキャンセル・トークンの補充・タイムアウトを確かめる間隔
+SCHEDULER_TICK = 0.5
+
+queue_wait_seconds = histogram(
+    "scheduler_queue_wait_seconds", "ストリームを始めるまでに待った時間", ("model",),
+    (0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0),
+)
+queue_rejected = counter("scheduler_rejected_total", "待ち時間の上限を超えて断った要求の数", ("model",))
+
+
+class SchedulerTimeout(Exception):
+    """待ち時間が UPSTREAM_QUEUE_TIMEOUT を超えた"""
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready(self, cost, now):
+        """cost を使えるか。上限より大きい要求は満タンになれば通す (残りは借りにする)"""
+        self.refill(now)
+        return self.tokens >= min(cost, self.capacity)
+
+
+class Ticket:
+    """1 つの要求。acquire() が返し、release() に渡す"""
+
+    def __init__(self, username, model_name, cost):
+        self.username = username
+        self.model_name = model_name
+        self.cost = cost
+        self.start = 0.0  # 仮想時刻での開始・終了 (小さい順に通す)
+        self.finish = 0.0
+        self.position = None  # 待ち行列での位置 (1 始まり)
+        self.enqueued = time.monotonic()
+        self.admitted = None
+        self.released = False
+        self.charged = False  # トークンバケットから引いたか (モデルを切り替えて並び直すときは引かない)
+        self.event = threading.Event()
+
+
+class UpstreamScheduler:
+    def __init__(self, concurrency=UPSTREAM_CONCURRENCY, model_limits=UPSTREAM_MODEL_CONCURRENCY,
+                 token_rate=USER_TOKEN_RATE, token_burst=USER_TOKEN_BURST, weights=USER_WEIGHTS,
+                 queue_timeout=UPSTREAM_QUEUE_TIMEOUT):
+        self.concurrency = concurrency
+        self.model_limits = model_limits
+        self.token_rate = token_rate
+        self.token_burst = token_burst
+        self.weights = weights
+        self.queue_timeout = queue_timeout
+        self.waiting = []
+        self.active = {}  # モデル → 流しているストリームの数
+        self.buckets = {}
+        self.last_finish = {}  # ユーザー → 最後に並んだ要求の仮想終了時刻
+        self.virtual_time = 0.0
+        self.lock = threading.Lock()
+
+    def model_limit(self, model_name):
+        short_name = model_name[len("models/"):] if model_name.startswith("models/") else model_name
+        for key in (model_name, short_name, "*"):
+            if key in self.model_limits:
+                return int(self.model_limits[key])
+        return 0
+
+    def acquire(self, username, model_name, cost, notify=None, cancelled=None):
+        """枠が取れるまで待って Ticket を返す。待っている間に cancelled() が真になったら None を返す
+
+        cost は送るトークン数の見積もり。待ち時間が上限を超えたら SchedulerTimeout。
+        """
+        weight = max(float(self.weights.get(username, 1)), 0.01)
+        ticket = Ticket(username, model_name, max(int(cost), 1))
+        with self.lock:
+            ticket.start = max(self.virtual_time, self.last_finish.get(username, 0.0))
+            ticket.finish = ticket.start + ticket.cost / weight
+            self.last_finish[username] = ticket.finish
+            self.waiting.append(ticket)
+            self._dispatch_locked()
+        return ticket if self._wait(ticket, notify, cancelled) else None
+
+    def switch(self, ticket, model_name, notify=None, cancelled=None):
+        """通った要求を別のモデルに付け替える (切り替え先のモデルで送り直すとき)
+
+        元のモデルの枠を返し、切り替え先のモデルの枠が空くまで待つ。並び順は元の要求のままで、
+        トークンバケットからは引き直さない。キャンセルされたら False、待ち時間が上限を超えたら SchedulerTimeout。
+        """
+        with self.lock:
+            if ticket.model_name == model_name:
+                return True
+            self.active[ticket.model_name] -= 1
+            ticket.model_name = model_name
+            ticket.admitted = None
+            ticket.position = None
+            ticket.enqueued = time.monotonic()
+            ticket.event.clear()
+            self.waiting.append(ticket)
+            self._dispatch_locked()
+        return self._wait(ticket, notify, cancelled)
+
+    def _wait(self, ticket, notify, cancelled):
+        """ticket が通るまで待つ。キャンセルされたら False"""
+        model_name = ticket.model_name
+        notified = None
+        try:
+            while not ticket.event.is_set():
+                if notify is not None and ticket.position != notified:
+                    notified = ticket.position
+                    notify(ticket.position, len(self.waiting))
+                if ticket.event.wait(SCHEDULER_TICK):
+                    break
+                if cancelled is not None and cancelled():
+                    self._withdraw(ticket)
+                    return False
+                if self.queue_timeout and time.monotonic() - ticket.enqueued > self.queue_timeout:
+                    queue_rejected.inc(model=model_name)
+                    raise SchedulerTimeout("混雑しています。しばらくしてから再度お試しください。")
+                with self.lock:
+                    # トークンの補充を待っている要求があるので、時間が経つたびに見直す
+                    self._dispatch_locked()
+        except BaseException:
+            self._withdraw(ticket)
+            raise
+        queue_wait_seconds.observe(ticket.admitted - ticket.enqueued, model=model_name)
+        return True
+
+    def release(self, ticket, used_tokens=None):
+        """ストリームが終わったら呼ぶ。used_tokens (実際のトークン数) がわかれば見積もりとの差をバケットで精算する"""
+        with self.lock:
+            if ticket.released or ticket.admitted is None:
+                return
+            ticket.released = True
+            self.active[ticket.model_name] -= 1
+            if used_tokens is not None and self.token_rate > 0:
+                self._bucket(ticket.username).tokens -= used_tokens - ticket.cost
+            self._dispatch_locked()
+
+    def _withdraw(self, ticket):
+        with self.lock:
+            if ticket in self.waiting:
+                self.waiting.remove(ticket)
+                if self.last_finish.get(ticket.username) == ticket.finish:
+                    # 最後に並んだ要求なら、このユーザーの仮想時刻を並ぶ前に戻す
+                    self.last_finish[ticket.username] = ticket.start
+                self._update_positions_locked()
+                return
+        # 外す直前に通っていた場合は枠を返す
+        self.release(ticket)
+
+    def _bucket(self, username):
+        bucket = self.buckets.get(username)
+        if bucket is None:
+            bucket = self.buckets[username] = TokenBucket(self.token_rate, self.token_burst)
+        return bucket
+
+    def _dispatch_locked(self):
+        now = time.monotonic()
+        blocked = set()  # バケットが足りないユーザー (後ろの要求も追い越させない)
+        total = sum(self.active.values())
+        for ticket in sorted(self.waiting, key=lambda t: t.finish):
+            if self.concurrency and total >= self.concurrency:
+                break
+            limit = self.model_limit(ticket.model_name)
+            if limit and self.active.get(ticket.model_name, 0) >= limit:
+                continue
+            if ticket.username in blocked:
+                continue
+            if self.token_rate > 0 and not ticket.charged:
+                bucket = self._bucket(ticket.username)
+                if not bucket.ready(ticket.cost, now):
+                    blocked.add(ticket.username)
+                    continue
+                bucket.tokens -= ticket.cost
+                ticket.charged = True
+            self.waiting.remove(ticket)
+            self.active[ticket.model_name] = self.active.get(ticket.model_name, 0) + 1
+            total += 1
+            self.virtual_time = max(self.virtual_time, ticket.start)
+            ticket.admitted = now
+            ticket.event.set()
+        self._update_positions_locked()
+
+    def _update_positions_locked(self):
+        for position, ticket in enumerate(sorted(self.waiting, key=lambda t: t.finish), 1):
+            ticket.position = position
+
+    def stats(self):
+        with self.lock:
+            return {"active": dict(self.active), "waiting": len(self.waiting)}
+
+
+upstream_scheduler = UpstreamScheduler()
+
+callback("upstream_active_streams", "モデルごとに Gemini へ流しているストリームの数",
+         lambda: {(model,): n for model, n in upstream_scheduler.stats()["active"].items()}, labelnames=("model",))
+callback("scheduler_waiting", "ストリームの開始を待っている要求の数", lambda: upstream_scheduler.stats()["waiting"])
@@ -0,0 +1,247 @@
+# -----------------------------------------------------------
+# チャット履歴の全文検索インデックス
+# -----------------------------------------------------------
+# ユーザーごとに <user_dir>/search_index.db (SQLite FTS5) を持ち、st_messages の追記・切り詰め・
+# 差し替え・削除のたびに該当するメッセージだけを書き換える。検索時に pickle を読むことはない。
+#   messages       : (chat_id, message_index) ごとの本文 (FTS の外部コンテンツ)
+#   messages_fts   : 本文の trigram 索引 (3 文字以上の語の部分一致)
+#   messages_short : かな・漢字などを 2 文字ずつ区切った索引 (「東京」のような 2 文字の語用)
+#   meta           : 既存チャットの取り込みが済んでいるかなど
+# 2 つの索引はトリガーで messages と同期する。どちらでも引けない語 (1 文字や英数字 2 文字) は LIKE で絞り込む。
+#
+# 応答時間を一定に抑えるため、一致したメッセージのうち新しい方から SEARCH_CANDIDATES 件だけを取り出し、
+# その中で BM25 と同じ考え方 (出現回数の飽和と本文の長さによる正規化) で採点して並べる。
+# FTS5 の bm25() はありふれた語だと索引全体を読むため使わない。
+import os
+import re
+import time
+import sqlite3
+from contextlib import closing
+
+from metrics import TimedConnection
+
+SEARCH_INDEX_NAME = "search_index.db"
+SEARCH_RESULT_LIMIT = int(os.environ.get("SEARCH_RESULT_LIMIT", 20))
+# 採点するのは一致したうち新しい方からこの件数まで
+SEARCH_CANDIDATES = int(os.environ.get("SEARCH_CANDIDATES", 2000))
+# 索引で引けない語だけで検索するときに LIKE で走査する件数 (新しいメッセージから)
+SEARCH_SHORT_SCAN = int(os.environ.get("SEARCH_SHORT_SCAN", 30000))
+SEARCH_SNIPPET_CHARS = 48
+# スニペット中の一致箇所を囲む文字 (クライアント側で HTML をエスケープしてから <mark> に置き換える)
+MATCH_START = "\x02"
+MATCH_END = "\x03"
+TRIGRAM = 3
+# BM25 のパラメータ
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# 単語の区切りがない文字 (かな・漢字・半角カナ・ハングル)
+CJK_RUN = re.compile("[぀-ヿ㐀-䶿一-鿿豈-﫿ｦ-ﾟ가-힯]+")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    chat_id TEXT,
+    message_index INTEGER,
+    role TEXT,
+    content TEXT
+);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_chat ON messages (chat_id, message_index);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    content, content='messages', content_rowid='id', tokenize='trigram'
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_short USING fts5(bigrams, content='');
+CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+    INSERT INTO messages_short (rowid, bigrams) VALUES (new.id, cjk_bigrams(new.content));
+END;
+CREATE TRIGGER IF NOT EXISTS messages_ad AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    INSERT INTO messages_short (messages_short, rowid, bigrams) VALUES ('delete', old.id, cjk_bigrams(old.content));
+END;
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+# このプロセスでスキーマを作成済みの DB ファイル
+_initialized = set()
+
+
+class SearchIndex:
+    def __init__(self, user_dir):
+        self.user_dir = user_dir
+        self.db_file = os.path.join(user_dir, SEARCH_INDEX_NAME)
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_file, timeout=30, factory=TimedConnection)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        # トリガーから呼ぶので、書き込む接続では必ず登録しておく
+        conn.create_function("cjk_bigrams", 1, cjk_bigrams, deterministic=True)
+        if self.db_file not in _initialized:
+            conn.executescript(SCHEMA)
+            _initialized.add(self.db_file)
+        return conn
+
+    def replace_tail(self, chat_id, keep, messages):
+        """keep 番目以降を messages に置き換える (末尾への追記は keep = 追記前の件数)"""
+        with closing(self.connect()) as conn, conn:
+            conn.execute("DELETE FROM messages WHERE chat_id = ? AND message_index >= ?", (chat_id, keep))
+            conn.executemany(
+                "INSERT INTO messages (chat_id, message_index, role, content) VALUES (?, ?, ?, ?)",
+                [
+                    (chat_id, keep + i, message.get("role"), message.get("content") or "")
+                    for i, message in enumerate(messages) if indexable(message)
+                ],
+            )
+
+    def truncate(self, chat_id, length):
+        """length 番目以降のメッセージを索引から消す"""
+        self.replace_tail(chat_id, length, [])
+
+    def delete_chat(self, chat_id):
+        self.truncate(chat_id, 0)
+
+    def invalidate(self):
+        """索引が st_messages とずれた可能性があるとき、次の検索で取り込み直させる"""
+        with closing(self.connect()) as conn, conn:
+            conn.execute("DELETE FROM meta WHERE key = 'built'")
+
+    def is_built(self):
+        with closing(self.connect()) as conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'built'").fetchone()
+        return row is not None
+
+    def build(self, chat_ids, read_messages):
+        """インデックス導入前からあるチャットを取り込む。read_messages(chat_id) でメッセージを読む"""
+        for chat_id in chat_ids:
+            self.replace_tail(chat_id, 0, read_messages(chat_id))
+        with closing(self.connect()) as conn, conn:
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('built', ?)", (str(time.time()),))
+
+    def search(self, query, limit=SEARCH_RESULT_LIMIT, chat_id=None):
+        """一致したメッセージを関連度順に [{chat_id, message_index, role, snippet}] で返す
+
+        空白で区切った語をすべて含むメッセージが対象 (大文字・小文字は区別しない)。
+        """
+        terms = list(dict.fromkeys(query.lower().split()))
+        if not terms:
+            return []
+        long_terms = [term for term in terms if len(term) >= TRIGRAM]
+        bigram_terms = [term for term in terms if len(term) == 2 and is_cjk(term)]
+        like_terms = [term for term in terms if term not in long_terms and term not in bigram_terms]
+
+        # 索引があればそれを rowid の降順にたどる (採点しないので一致件数が多くても途中で止まる)
+        where = []
+        params = []
+        if long_terms:
+            source = "messages_fts f JOIN messages m ON m.id = f.rowid"
+            where.append("messages_fts MATCH ?")
+            params.append(fts_query(long_terms))
+            if bigram_terms:
+                where.append("m.id IN (SELECT rowid FROM messages_short WHERE messages_short MATCH ?)")
+                params.append(fts_query(bigram_terms))
+            order = "f.rowid"
+        elif bigram_terms:
+            source = "messages_short s JOIN messages m ON m.id = s.rowid"
+            where.append("messages_short MATCH ?")
+            params.append(fts_query(bigram_terms))
+            order = "s.rowid"
+        else:
+            # 索引で引けない語だけの場合は、新しい方から SEARCH_SHORT_SCAN 件だけを走査する
+            source = "messages m"
+            where.append("m.id > (SELECT IFNULL(MAX(id), 0) FROM messages) - ?")
+            params.append(SEARCH_SHORT_SCAN)
+            order = "m.id"
+        for term in like_terms:
+            where.append("m.content LIKE ? ESCAPE '\\'")
+            params.append("%" + escape_like(term) + "%")
+        if chat_id is not None:
+            where.append("m.chat_id = ?")
+            params.append(chat_id)
+        sql = f"""
+        SELECT m.chat_id, m.message_index, m.role, m.content
+        FROM {source} WHERE {" AND ".join(where)}
+        ORDER BY {order} DESC LIMIT ?
+        """
+        with closing(self.connect()) as conn:
+            candidates = conn.execute(sql, params + [SEARCH_CANDIDATES]).fetchall()
+        if not candidates:
+            return []
+
+        average = sum(len(row["content"]) for row in candidates) / len(candidates)
+        scored = []
+        for order, row in enumerate(candidates):
+            text = row["content"].lower()
+            # 点数が同じなら新しいメッセージを先にする
+            scored.append((score(text, terms, average), -order, row, text))
+        scored.sort(key=lambda item: item[:2], reverse=True)
+        return [
+            {
+                "chat_id": row["chat_id"],
+                "message_index": row["message_index"],
+                "role": row["role"],
+                "snippet": make_snippet(row["content"], text, terms),
+            }
+            for _, _, row, text in scored[:limit]
+        ]
+
+
+def indexable(message):
+    # 生成途中の定期保存 (partial だが history_saved でないもの) は、完了・中断時の保存で索引に入れる
+    return not (message.get("partial") and not message.get("history_saved"))
+
+
+def is_cjk(text):
+    return CJK_RUN.fullmatch(text) is not None
+
+
+def cjk_bigrams(content):
+    """かな・漢字などの連続部分を 2 文字ずつずらして区切った文字列 (messages_short 用)"""
+    bigrams = []
+    for run in CJK_RUN.findall((content or "").lower()):
+        bigrams.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return " ".join(bigrams)
+
+
+def fts_query(terms):
+    # 入力をそのまま FTS5 の構文として解釈させず、各語をフレーズとして AND でつなぐ
+    return " AND ".join('"' + term.replace('"', '""') + '"' for term in terms)
+
+
+def escape_like(term):
+    return term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def score(text, terms, average_length):
+    """候補どうしで比べるための BM25 風の点数 (語の重み (IDF) はすべて同じとみなす)"""
+    norm = BM25_K1 * (1 - BM25_B + BM25_B * len(text) / (average_length or 1))
+    total = 0.0
+    for term in terms:
+        tf = text.count(term)
+        total += tf * (BM25_K1 + 1) / (tf + norm)
+    return total
+
+
+def make_snippet(content, text, terms, width=SEARCH_SNIPPET_CHARS):
+    """最初に見つかった語の前後を切り出し、範囲内の一致箇所を MATCH_START / MATCH_END で囲む"""
+    positions = [pos for pos in (text.find(term) for term in terms) if pos >= 0]
+    first = min(positions) if positions else 0
+    start = max(0, first - width // 2)
+    end = min(len(content), start + width * 2)
+    spans = []
+    for term in terms:
+        pos = text.find(term, start)
+        while 0 <= pos and pos + len(term) <= end:
+            spans.append((pos, pos + len(term)))
+            pos = text.find(term, pos + len(term))
+    parts = ["…"] if start > 0 else []
+    cursor = start
+    for span_start, span_end in sorted(spans):
+        if span_start < cursor:
+            continue
+        parts += [content[cursor:span_start], MATCH_START, content[span_start:span_end], MATCH_END]
+        cursor = span_end
+    parts.append(content[cursor:end])
+    if end < len(content):
+        parts.append("…")
+    return "".join(parts)
@@ -0,0 +1,127 @@
+# -----------------------------------------------------------
+# ワーカー間で共有する状態と通知
+# -----------------------------------------------------------
+# 複数の app.py プロセスを並べて動かすとき、キャンセル要求やトークンの無効化、
+# アップロードセッションのようにプロセスをまたぐ必要があるものをここで受け渡す。
+# SHARED_STATE_URL (省略時は SOCKETIO_MESSAGE_QUEUE) に Redis 互換サーバーを指定すると有効になり、
+# 指定しなければ 1 プロセス用の LocalState (通知は何もせず、値はメモリに置く) を使う。
+import os
+import json
+import time
+import uuid
+import threading
+
+SHARED_STATE_URL = os.environ.get("SHARED_STATE_URL") or os.environ.get("SOCKETIO_MESSAGE_QUEUE")
+SHARED_STATE_CHANNEL = os.environ.get("SHARED_STATE_CHANNEL", "flask-gemini")
+# 通知の送り主を区別するための ID (自分が送った通知は処理しない)
+WORKER_ID = uuid.uuid4().hex[:12]
+
+
+class LocalState:
+    """1 プロセスで動かす場合の実装"""
+
+    shared = False
+
+    def __init__(self):
+        self.handlers = {}
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def on(self, kind, handler):
+        """他のワーカーから kind の通知が届いたときに handler(**payload) を呼ぶ"""
+        self.handlers[kind] = handler
+
+    def publish(self, kind, **payload):
+        # 他にワーカーはいないので何もしない (自プロセス分は呼び出し側が直接処理する)
+        pass
+
+    def start(self):
+        pass
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            self.values[key] = (value, time.time() + ttl if ttl else None)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires < time.time():
+                del self.values[key]
+                return None
+            return value
+
+    def delete(self, key):
+        with self.lock:
+            self.values.pop(key, None)
+
+
+class RedisState(LocalState):
+    """Redis 互換サーバーの pub/sub とキーで状態を共有する実装"""
+
+    shared = True
+
+    def __init__(self, url, channel=SHARED_STATE_CHANNEL):
+        import redis  # 複数ワーカー構成のときだけ必要
+        super().__init__()
+        self.redis = redis.Redis.from_url(url)
+        self.channel = channel
+        self.listener = None
+
+    def publish(self, kind, **payload):
+        message = json.dumps({"kind": kind, "origin": WORKER_ID, "payload": payload})
+        try:
+            self.redis.publish(self.channel, message)
+        except Exception as e:
+            print(f"[shared] 通知の送信に失敗しました ({kind}): {e}")
+
+    def start(self):
+        if self.listener is None:
+            self.listener = threading.Thread(target=self._listen, daemon=True)
+            self.listener.start()
+
+    def set(self, key, value, ttl=None):
+        self.redis.set(self._key(key), json.dumps(value), ex=int(ttl) if ttl else None)
+
+    def get(self, key):
+        value = self.redis.get(self._key(key))
+        return json.loads(value) if value is not None else None
+
+    def delete(self, key):
+        self.redis.delete(self._key(key))
+
+    def _key(self, key):
+        return f"{self.channel}:{key}"
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    self._dispatch(message)
+            except Exception as e:
+                # 接続が切れたら少し待って購読し直す
+                print(f"[shared] 購読が切れました。再接続します: {e}")
+                time.sleep(1)
+
+    def _dispatch(self, message):
+        try:
+            data = json.loads(message["data"])
+        except (TypeError, ValueError):
+            return
+        if data.get("origin") == WORKER_ID:
+            return
+        handler = self.handlers.get(data.get("kind"))
+        if handler is None:
+            return
+        try:
+            handler(**data.get("payload", {}))
+        except Exception as e:
+            print(f"[shared] 通知の処理に失敗しました ({data.get('kind')}): {e}")
+
+
+def create_shared_state(url=SHARED_STATE_URL):
+    return RedisState(url) if url else LocalState()
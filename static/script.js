@@ -1,4 +1,5 @@
-const socket = io();
+// 複数ワーカー構成ではサーバーが WebSocket のみを受け付ける
+const socket = io({ transports: SOCKETIO_TRANSPORTS });
 
 // UI要素の取得（省略せずそのまま）
 const loginWrapper = document.getElementById("loginWrapper");
@@ -15,6 +16,8 @@ const mainContent = document.getElementById("mainContent");
 const rightSidebar = document.getElementById("rightSidebar");
 const chatHistoryList = document.getElementById("chatHistoryList");
 const newChatButton = document.getElementById("newChatButton");
+const chatSearchInput = document.getElementById("chatSearchInput");
+const chatSearchResults = document.getElementById("chatSearchResults");
 const chatsContainer = document.getElementById("chats");
 const chatsWrapper = document.getElementById("chatsWrapper");
 const promptForm = document.querySelector(".prompt__form");
@@ -41,12 +44,25 @@ let fileData = null;
 let fileName = null;
 let fileMimeType = null;
 let isSameChat = false;
+// 表示中のチャットはページ単位で読み込む (chatStart: 先頭に表示しているメッセージの番号)
+const CHAT_PAGE_SIZE = 30;
+let chatStart = 0;
+let chatCursor = null; // より前のページがあるときの before の値
+let loadingOlderPage = false;
 let resendMessage = "";
 let currentChatTitle = null;
 let fileId = null;
+// 生成中の応答の ID (停止ボタンはこの生成だけをキャンセルする)
+let currentRequestId = null;
 
 
+// これ以下のファイルは base64 で send_message に埋め込み、それより大きい動画・音声は分割アップロードする
 const FILE_SIZE_THRESHOLD = 10 * 1024 * 1024;
+// 分割アップロードで接続が切れたときの再試行回数
+const UPLOAD_MAX_RETRIES = 5;
+// これ以下のファイルはハッシュを計算し、アップロード済みなら転送を省く
+// (crypto.subtle.digest はファイル全体を一度に渡す必要があるので、メモリに読める大きさに抑える)
+const UPLOAD_HASH_LIMIT = 64 * 1024 * 1024;
 
 const md = window.markdownit({
   html: false,
@@ -222,7 +238,12 @@ function initializeApp() {
 
   initializeChatTitle();
   fetchModelList();
+  // ユーザーが変わることがあるので、チャット一覧は取り直す
+  historyEntries = {};
+  historyRevision = null;
   fetchHistoryList();
+  chatSearchInput.value = "";
+  runChatSearch();
   startNewChat();
 	setupEditor();
 	promptForm.addEventListener("submit", handleSendMessage);
@@ -249,6 +270,10 @@ socket.on("model_list", (data) => {
     const option = document.createElement("option");
     option.value = modelName;
     option.textContent = modelName.split("/").pop();
+    const capabilities = data.capabilities && data.capabilities[modelName];
+    if (capabilities) {
+      option.title = `入力 ${capabilities.input_token_limit?.toLocaleString()} / 出力 ${capabilities.output_token_limit?.toLocaleString()} tokens`;
+    }
     modelSelect.appendChild(option);
   });
   if (data.models.length > 0) {
@@ -382,8 +407,8 @@ function toggleBookmark() {
   }
 }
 
-// 履歴リストを表示
-function displayHistoryList(history) {
+// 履歴リストを表示 (historyEntries の内容を描画する)
+function displayHistoryList() {
   chatHistoryList.innerHTML = "";
 
   // ブックマークと履歴用のセクション作成
@@ -407,19 +432,18 @@ function displayHistoryList(history) {
   const bookmarkedItems = document.getElementById("bookmarkedItems");
   const historyItems = document.getElementById("historyItems");
 
-  // chat_idでソートした履歴アイテム
-  const sortedItems = Object.entries(history).sort(
-    (a, b) => Number(b[0]) - Number(a[0])
+  // サーバーと同じく、ブックマークを先頭に最終更新が新しい順
+  const sortedItems = Object.values(historyEntries).sort(
+    (a, b) => (b.bookmarked - a.bookmarked) || (b.updated - a.updated)
   );
 
   let hasBookmarks = false;
 
   // 各チャット履歴アイテムの生成
-  sortedItems.forEach(([chatId, chatData]) => {
-    // 新形式・旧形式の両方に対応
-    const isObject = typeof chatData === "object";
-    const chatTitle = isObject ? chatData.title : chatData;
-    const isBookmarked = isObject && chatData.bookmarked;
+  sortedItems.forEach((chatData) => {
+    const chatId = chatData.chat_id;
+    const chatTitle = chatData.title;
+    const isBookmarked = chatData.bookmarked;
 
     // チャット履歴アイテムを作成
     const itemHTML = `
@@ -451,6 +475,22 @@ function displayHistoryList(history) {
       "none";
   }
 
+  // まだ読み込んでいないチャットがあれば続きを読むボタンを出す
+  if (sortedItems.length < historyTotal) {
+    chatHistoryList.insertAdjacentHTML(
+      "beforeend",
+      '<button id="historyMoreButton" class="chat-history-more-btn">さらに表示</button>'
+    );
+    document
+      .getElementById("historyMoreButton")
+      .addEventListener("click", fetchMoreHistory);
+  }
+
+  // 表示中のチャットの名前やブックマークが別のタブで変わった場合に追従する
+  if (chat_id && historyEntries[chat_id]) {
+    applyChatTitle(historyEntries[chat_id]);
+  }
+
   // 履歴アイテムにイベントリスナーを追加
   document.querySelectorAll(".chat-history-item").forEach((item) => {
     const chatId = item.getAttribute("data-chat-id");
@@ -502,7 +542,7 @@ function loadChat(selectedChatId) {
 
   // 応答中ならキャンセル処理
   if (isGeneratingResponse) {
-    socket.emit("cancel_stream", { token: token, chat_id: chat_id });
+    cancelCurrentStream();
     isGeneratingResponse = false;
     setPromptEnabled(true);
     toggleResponseButtons(false);
@@ -511,8 +551,8 @@ function loadChat(selectedChatId) {
   isSameChat = chat_id === selectedChatId;
   chat_id = selectedChatId;
 
-  // チャットメッセージと履歴情報をロード
-  socket.emit("load_chat", { token: token, chat_id: selectedChatId });
+  // チャットメッセージの最新ページをロード (古いメッセージはスクロールしたときに読む)
+  socket.emit("load_chat_page", { token: token, chat_id: selectedChatId, limit: CHAT_PAGE_SIZE });
 
   // ファイル添付情報をリセット
   fileData = null;
@@ -527,31 +567,29 @@ function loadChat(selectedChatId) {
 
 // チャットタイトルを更新する簡易関数
 function updateChatTitle(chatId) {
-  // サーバーに履歴情報をリクエスト
-  socket.emit("get_history_list", { token: token });
-
-  // 履歴情報のコールバックでタイトルを設定（既存イベント利用）
-  socket.once("history_list", (data) => {
-    const chatData = data.history[chatId];
-    if (chatData) {
-      const title = typeof chatData === "object" ? chatData.title : chatData;
-      const isBookmarked = typeof chatData === "object" && chatData.bookmarked;
-
-      // タイトル更新
-      document.getElementById("chatTitle").textContent = title;
-      currentChatTitle = title;
-
-      // ブックマーク状態更新
-      const bookmarkOption = document.getElementById("bookmarkOption");
-      if (isBookmarked) {
-        bookmarkOption.innerHTML =
-          '<i class="bx bxs-bookmark"></i> ブックマーク解除';
-      } else {
-        bookmarkOption.innerHTML =
-          '<i class="bx bx-bookmark"></i> ブックマーク';
-      }
-    }
-  });
+  const chatData = historyEntries[chatId];
+  if (chatData) {
+    applyChatTitle(chatData);
+  } else {
+    // 一覧にまだ無い (読み込んでいないページにある) 場合は差分を取り直す。届いたら描画時に反映される
+    fetchHistoryList();
+  }
+}
+
+function applyChatTitle(chatData) {
+  // タイトル更新
+  document.getElementById("chatTitle").textContent = chatData.title;
+  currentChatTitle = chatData.title;
+
+  // ブックマーク状態更新
+  const bookmarkOption = document.getElementById("bookmarkOption");
+  if (chatData.bookmarked) {
+    bookmarkOption.innerHTML =
+      '<i class="bx bxs-bookmark"></i> ブックマーク解除';
+  } else {
+    bookmarkOption.innerHTML =
+      '<i class="bx bx-bookmark"></i> ブックマーク';
+  }
 }
 
 // 新規チャット作成時の処理修正
@@ -574,16 +612,139 @@ function startNewChat() {
     '<i class="bx bx-bookmark"></i> ブックマーク';
 }
 
+// ----------------------------------------
+// チャット一覧
+// ----------------------------------------
+// 一覧はページ単位で読み込み、以降はサーバーから届く差分 (history_delta) をリビジョン順に当てていく
+const HISTORY_PAGE_SIZE = 50;
+let historyEntries = {}; // chat_id → {chat_id, title, bookmarked, updated}
+let historyRevision = null; // 手元の一覧がどのリビジョンまで反映済みか
+let historyTotal = 0;
+
 function fetchHistoryList() {
   if (!username) return;
-  socket.emit("get_history_list", { token: token });
+  if (historyRevision === null) {
+    socket.emit("get_history_list", { token: token, offset: 0, limit: HISTORY_PAGE_SIZE });
+  } else {
+    // 読み込み済みなら差分だけを頼む (古すぎる場合は先頭ページが返ってくる)
+    socket.emit("get_history_list", { token: token, if_newer_than: historyRevision });
+  }
+}
+
+function fetchMoreHistory() {
+  if (!username) return;
+  socket.emit("get_history_list", {
+    token: token,
+    offset: Object.keys(historyEntries).length,
+    limit: HISTORY_PAGE_SIZE,
+  });
 }
 
-// サーバー側からの最新履歴受信時にも自動で再描画
 socket.on("history_list", (data) => {
-  displayHistoryList(data.history);
+  if (data.offset === 0) {
+    historyEntries = {};
+    historyRevision = data.revision;
+  } else {
+    historyRevision = Math.max(historyRevision ?? 0, data.revision);
+  }
+  data.items.forEach((item) => {
+    historyEntries[item.chat_id] = item;
+  });
+  historyTotal = data.total;
+  displayHistoryList();
+});
+
+// 他のタブやワーカーでの変更も含め、一覧の変更は差分で届く
+socket.on("history_delta", (data) => {
+  if (historyRevision === null || data.revision <= historyRevision) return;
+  if (data.from_revision > historyRevision) {
+    // 取りこぼした差分があるので、手元のリビジョンからの差分を取り直す
+    fetchHistoryList();
+    return;
+  }
+  data.upserts.forEach((item) => {
+    historyEntries[item.chat_id] = item;
+  });
+  data.removed.forEach((chatId) => {
+    delete historyEntries[chatId];
+  });
+  historyRevision = data.revision;
+  historyTotal = data.total;
+  displayHistoryList();
+});
+
+// ----------------------------------------
+// チャット検索
+// ----------------------------------------
+// 入力が止まってから検索し、結果が出ている間は履歴一覧の代わりに表示する
+const SEARCH_DELAY = 250;
+let searchTimer = null;
+let searchQuery = "";
+
+chatSearchInput.addEventListener("input", () => {
+  clearTimeout(searchTimer);
+  searchTimer = setTimeout(runChatSearch, SEARCH_DELAY);
+});
+
+chatSearchInput.addEventListener("keydown", (e) => {
+  if (e.key === "Escape") {
+    chatSearchInput.value = "";
+    runChatSearch();
+  }
 });
 
+function runChatSearch() {
+  searchQuery = chatSearchInput.value.trim();
+  if (!searchQuery || !username) {
+    chatSearchResults.style.display = "none";
+    chatHistoryList.style.display = "";
+    return;
+  }
+  socket.emit("search_chats", { token: token, query: searchQuery });
+}
+
+socket.on("search_results", (data) => {
+  // 入力が変わった後に届いた古い結果は捨てる
+  if (data.query !== searchQuery) return;
+  chatHistoryList.style.display = "none";
+  chatSearchResults.style.display = "";
+  chatSearchResults.innerHTML = "";
+  if (!data.results.length) {
+    const empty = document.createElement("div");
+    empty.className = "chat-search-empty";
+    empty.textContent = data.error ? `検索に失敗しました: ${data.error}` : "見つかりませんでした";
+    chatSearchResults.appendChild(empty);
+    return;
+  }
+  data.results.forEach((result) => {
+    const item = document.createElement("div");
+    item.className = "chat-search-item";
+    const title = document.createElement("div");
+    title.className = "chat-search-title";
+    title.textContent = result.title || "(無題)";
+    const snippet = document.createElement("div");
+    snippet.className = "chat-search-snippet";
+    appendSnippet(snippet, result.snippet);
+    item.append(title, snippet);
+    item.addEventListener("click", () => loadChat(result.chat_id));
+    chatSearchResults.appendChild(item);
+  });
+});
+
+// 一致箇所は \x02 〜 \x03 で囲まれて届くので、本文はテキストノードにして <mark> だけを要素にする
+function appendSnippet(container, snippet) {
+  snippet.split("\x02").forEach((part, i) => {
+    if (i === 0) {
+      container.appendChild(document.createTextNode(part));
+      return;
+    }
+    const [matched, rest = ""] = part.split("\x03");
+    const mark = document.createElement("mark");
+    mark.textContent = matched;
+    container.append(mark, document.createTextNode(rest));
+  });
+}
+
 newChatButton.addEventListener("click", () => {
   startNewChat();
   document
@@ -597,12 +758,17 @@ socket.on("chat_created", (data) => {
   loadChat(chat_id);
 });
 
-socket.on("chat_loaded", (data) => {
+socket.on("chat_page", (data) => {
+  if (chat_id !== data.chat_id) return;
+  if (data.before !== null && data.before !== undefined) {
+    prependMessages(data);
+    return;
+  }
   if (isSameChat) {
-    updateChatDisplay(data.messages);
+    updateChatDisplay(data.messages, data.start);
   } else {
     resendMessage = "";
-    displayMessages(data.messages);
+    displayMessages(data.messages, data.start);
     scrollToBottom();
   }
   // チャット全体再描画後にコードブロックを処理する
@@ -612,39 +778,73 @@ socket.on("chat_loaded", (data) => {
     sendMessage(resendMessage);
     resendMessage = "";
   }
+  // 1ページで画面が埋まらない場合はスクロールできないので続けて読む
+  setTimeout(() => {
+    if (chatsWrapper.scrollHeight <= chatsWrapper.clientHeight) loadOlderMessages();
+  }, 0);
 });
 
-function displayMessages(messages) {
+// start はメッセージ番号 (削除・再送信のボタンはこの番号でサーバーに伝える)
+function displayMessages(messages, start = 0) {
   chatsContainer.innerHTML = "";
-  messages.forEach((message, index) => {
-    const resendButton =
-      message.role === "user"
-        ? `<button onClick="resendPrompt((this), ${index})" class="resend__prompt-button"><i class='bx bx-refresh'></i></button>`
-        : "";
-    const messageElement = createChatMessageElement(
-      `<div class="message__content">
-         <p class="message__text"></p>
-       </div>
-			 <div class="button__icons">
-				 <button class="message__delete-button" onclick="deleteChatMessage(${index})"><i class='bx bx-trash'></i></button>
-				 <button onClick="copyMessageToClipboard(this)" class="message__copy-button"><i class='bx bx-copy-alt'></i></button>
-				 ${resendButton}
-			 </div>`,
-      message.role,
-      message.role === "user" ? "message--outgoing" : "message--incoming"
+  chatStart = start;
+  chatCursor = start > 0 ? start : null;
+  messages.forEach((message, i) => {
+    chatsContainer.appendChild(
+      renderMessageNode(message, start + i, i === messages.length - 1)
     );
-    const textElement = messageElement.querySelector(".message__text");
-    if (message.role === "user") {
-      textElement.innerText = message.content;
-    } else {
-      textElement.innerHTML = md.render(message.content);
-    }
-    chatsContainer.appendChild(messageElement);
   });
 }
 
+// 上端までスクロールしたら、表示中より前のページを読む
+function loadOlderMessages() {
+  if (loadingOlderPage || chatCursor === null || !chat_id) return;
+  loadingOlderPage = true;
+  socket.emit("load_chat_page", {
+    token: token,
+    chat_id: chat_id,
+    before: chatCursor,
+    limit: CHAT_PAGE_SIZE,
+  });
+}
+
+function prependMessages(data) {
+  loadingOlderPage = false;
+  // 読み込み中に表示が変わった場合 (チャット切り替え・削除など) は捨てる
+  if (data.start + data.messages.length !== chatStart) return;
+  const fragment = document.createDocumentFragment();
+  data.messages.forEach((message, i) => {
+    fragment.appendChild(renderMessageNode(message, data.start + i, false));
+  });
+  // 追加した分だけスクロール位置をずらして、見ていた位置を保つ
+  const previousHeight = chatsWrapper.scrollHeight;
+  chatsContainer.insertBefore(fragment, chatsContainer.firstChild);
+  chatsWrapper.scrollTop += chatsWrapper.scrollHeight - previousHeight;
+  chatStart = data.start;
+  chatCursor = data.cursor;
+  safeHighlightAll();
+  addCopyButtonToCodeBlocks();
+}
+
+chatsWrapper.addEventListener("scroll", () => {
+  if (chatsWrapper.scrollTop < 200) loadOlderMessages();
+});
+
+// 途中で止まった応答 (partial) の末尾にだけ「続きを生成」ボタンを出す
+function continueButton(message, isLast) {
+  if (!isLast || message.role !== "model" || !message.partial) return "";
+  return `<button onClick="continueResponse()" class="continue__response-button" title="続きを生成"><i class='bx bx-play'></i></button>`;
+}
+
+// 続きのチャンクが既存の内容の後ろに付くよう、途中までの内容をバッファに入れておく
+function markPartialMessage(textElement, message) {
+  if (message.role === "model" && message.partial) {
+    textElement.dataset.chunkBuffer = message.content;
+  }
+}
+
 // ヘルパー関数：新規メッセージDOM要素を生成する
-function createMessageNode(msg, index) {
+function createMessageNode(msg, index, isLast) {
   const messageClass =
     msg.role === "user" ? "message--outgoing" : "message--incoming";
   const resendButton =
@@ -659,17 +859,37 @@ function createMessageNode(msg, index) {
 			<button class="message__delete-button" onclick="deleteChatMessage(${index})"><i class='bx bx-trash'></i></button>
 			<button onClick="copyMessageToClipboard(this)" class="message__copy-button"><i class='bx bx-copy-alt'></i></button>
 			${resendButton}
+			${continueButton(msg, isLast)}
 		</div>
   `;
   const node = createChatMessageElement(htmlContent, msg.role, messageClass);
+  markPartialMessage(node.querySelector(".message__text"), msg);
   // 現在のメッセージ内容をデータ属性として保持
   node.dataset.msgContent = msg.content;
   return node;
 }
 
-// 差分更新用の関数
-function updateChatDisplay(newHistory) {
-  const newCount = newHistory.length;
+// メッセージ要素を作って本文も描画する
+function renderMessageNode(msg, index, isLast) {
+  const node = createMessageNode(msg, index, isLast);
+  const textElement = node.querySelector(".message__text");
+  if (msg.role === "user") {
+    textElement.innerText = msg.content;
+  } else {
+    textElement.innerHTML = md.render(msg.content);
+  }
+  return node;
+}
+
+// 差分更新用の関数 (newHistory は start 番以降の最新ページ。それより前に表示中の要素はそのまま残す)
+function updateChatDisplay(newHistory, start = 0) {
+  if (start < chatStart) {
+    // 削除などで表示範囲より前まで変わった場合は描画し直す
+    displayMessages(newHistory, start);
+    return;
+  }
+  const offset = start - chatStart;
+  const newCount = offset + newHistory.length;
 
   // DOMにあるメッセージ数が新しい履歴より多い場合、末尾から削除
   if (chatsContainer.children.length > 0) {
@@ -681,13 +901,13 @@ function updateChatDisplay(newHistory) {
   // DOMに足りない場合は新規要素を追加
   let currentCount = chatsContainer.children.length;
   for (let i = currentCount; i < newCount; i++) {
-    const newNode = createMessageNode(newHistory[i], i);
+    const newNode = createMessageNode(newHistory[i - offset], chatStart + i, i === newCount - 1);
     chatsContainer.appendChild(newNode);
   }
 
-  // すべての要素について、内容が変更されている場合に更新
-  for (let i = 0; i < newCount; i++) {
-    const newMsg = newHistory[i];
+  // ページ内の要素について、内容が変更されている場合に更新
+  for (let i = offset; i < newCount; i++) {
+    const newMsg = newHistory[i - offset];
     const domNode = chatsContainer.children[i];
     const textElement = domNode.querySelector(".message__text");
 
@@ -733,6 +953,25 @@ socket.on("message_deleted", (data) => {
   }
 });
 
+function continueResponse() {
+  if (isGeneratingResponse || !username || !chat_id) return;
+
+  isGeneratingResponse = true;
+  setPromptEnabled(false);
+  toggleResponseButtons(true);
+  const button = chatsContainer.querySelector(".continue__response-button");
+  if (button) button.remove();
+
+  socket.emit("continue_message", {
+    token: token,
+    chat_id: chat_id,
+    request_id: newRequestId(),
+    model_name: currentModel,
+    grounding_enabled: groundingEnabled,
+    code_execution_enabled: codeExecutionEnabled,
+  });
+}
+
 function resendPrompt(resendButton, index) {
   if (isGeneratingResponse) return;
   resendMessage =
@@ -745,6 +984,23 @@ function resendPrompt(resendButton, index) {
 // ----------------------------------------
 // メッセージ送受信
 // ----------------------------------------
+function newRequestId() {
+  currentRequestId = window.crypto && crypto.randomUUID
+    ? crypto.randomUUID()
+    : `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+  return currentRequestId;
+}
+
+function cancelCurrentStream() {
+  socket.emit("cancel_stream", { token: token, chat_id: chat_id, request_id: currentRequestId });
+  currentRequestId = null;
+}
+
+// 同じチャットで前に出してキャンセルした生成からのイベントは無視する
+function isCurrentStream(data) {
+  return chat_id === data.chat_id && (!data.request_id || data.request_id === currentRequestId);
+}
+
 function setPromptEnabled(enabled) {
   sendButton.disabled = !enabled;
   // 送信ボタンのスタイルも変更するなどの工夫があれば追加
@@ -790,6 +1046,7 @@ function sendMessage(message) {
   const messageData = {
     token: token,
     chat_id: chat_id,
+    request_id: newRequestId(),
     model_name: currentModel,
     message: message,
     grounding_enabled: groundingEnabled,
@@ -857,7 +1114,7 @@ function displayIncomingMessage(message, index) {
 }
 
 socket.on("gemini_response_chunk", (data) => {
-  if (chat_id !== data.chat_id) return;
+  if (!isCurrentStream(data)) return;
   const chunk = data.chunk;
   let messageElement = document.querySelector(
     ".message--incoming:last-child .message__text"
@@ -879,8 +1136,26 @@ socket.on("gemini_response_chunk", (data) => {
   removeLoadingIndicator();
 });
 
+// 混雑していてストリームの開始を待っている間は、ローディング表示に順番を出す
+socket.on("queue_position", (data) => {
+  if (!isCurrentStream(data)) return;
+  const text = document.querySelector(".message--loading .message__text");
+  if (text) {
+    text.textContent = `順番待ち: ${data.position} / ${data.waiting}`;
+  }
+});
+
+// 応答が始まらず、同等の別のモデルに切り替えたとき
+socket.on("response_model", (data) => {
+  if (!isCurrentStream(data)) return;
+  const text = document.querySelector(".message--loading .message__text");
+  if (text) {
+    text.textContent = `${data.model} で応答しています`;
+  }
+});
+
 socket.on("gemini_response_error", (data) => {
-  if (chat_id !== data.chat_id) return;
+  if (!isCurrentStream(data)) return;
   // 既存のローディング・受信中の要素があれば削除する
   const loadingElement = document.querySelector(".message--loading");
   if (loadingElement) {
@@ -913,7 +1188,7 @@ function displayErrorMessage(error) {
 }
 
 socket.on("gemini_response_complete", (data) => {
-  if (chat_id !== data.chat_id) return;
+  if (!isCurrentStream(data)) return;
   isGeneratingResponse = false;
   // 応答完了時に最新のチャット履歴を再描画する
   loadChat(chat_id);
@@ -970,7 +1245,7 @@ function removeLoadingIndicator() {
 stopButton.addEventListener("click", () => {
   // 現在応答中ならキャンセルイベントを送信
   if (isGeneratingResponse) {
-    socket.emit("cancel_stream", { token: token, chat_id: chat_id });
+    cancelCurrentStream();
     // 応答中フラグをリセットして、入力欄を再有効化
     isGeneratingResponse = false;
     setPromptEnabled(true);
@@ -1007,13 +1282,51 @@ const copyMessageToClipboard = (copyButton) => {
   );
 };
 
+// 大きなライブラリを <script> で読み込む (同じ URL は 1 回だけ)
+const loadedScripts = {};
+function loadScript(url) {
+  if (!loadedScripts[url]) {
+    loadedScripts[url] = new Promise((resolve, reject) => {
+      const script = document.createElement("script");
+      script.src = url;
+      script.onload = resolve;
+      script.onerror = () => {
+        delete loadedScripts[url]; // 次に必要になったときに読み直す
+        reject(new Error(`${url} を読み込めませんでした`));
+      };
+      document.head.appendChild(script);
+    });
+  }
+  return loadedScripts[url];
+}
+
+// highlight.min.js に含まれない言語の定義 (languages.js) を読み込んだか
+let extraLanguagesLoaded = false;
+
 // 既存の hljs.highlightAll() の呼び出しを置き換える関数
 function safeHighlightAll() {
   // 未ハイライトのコードブロックのみを選択
   const notHighlightedBlocks = document.querySelectorAll("pre code:not(.hljs)");
+  let waiting = false;
   notHighlightedBlocks.forEach((block) => {
+    const language = [...block.classList]
+      .find((cls) => cls.startsWith("language-"))
+      ?.replace("language-", "");
+    // 未知の言語のブロックは languages.js を読み込んでからハイライトする
+    if (language && !extraLanguagesLoaded && !hljs.getLanguage(language)) {
+      waiting = true;
+      return;
+    }
     hljs.highlightElement(block);
   });
+  if (waiting) {
+    loadScript(LAZY_SCRIPTS.languages)
+      .then(() => {
+        extraLanguagesLoaded = true;
+        safeHighlightAll();
+      })
+      .catch((error) => console.error(error));
+  }
 }
 
 // コードブロックのコピーボタン追加処理も修正
@@ -1248,20 +1561,46 @@ dragOverlay.addEventListener("transitionend", () => {
   }
 });
 
-function countToken() {
+// 添付ファイルのトークン数を問い合わせる
+// 添付時は概算値 (サーバーに正確な値のキャッシュがあればその値) だけを受け取り、
+// count_tokens の API 呼び出しは表示をクリックしたとき (exact) だけにする
+function countToken(fileSize, exact = false) {
+  const tokenCountDisplay = document.getElementById("tokenCountDisplay");
+  if (tokenCountDisplay) tokenCountDisplay.dataset.fileSize = fileSize;
   const data = {
     model_name: currentModel,
     file_data: fileData,
+    file_id: fileId,
+    file_size: fileSize,
     file_name: fileName,
     file_mime_type: fileMimeType,
+    exact: exact,
   };
   socket.emit("count_token", data);
   return;
 }
 
+attachmentPreview.addEventListener("click", (event) => {
+  const tokenCountDisplay = event.target.closest("#tokenCountDisplay");
+  if (!tokenCountDisplay || tokenCountDisplay.dataset.exact !== "false") return;
+  tokenCountDisplay.textContent += " (計算中...)";
+  tokenCountDisplay.dataset.exact = "pending";
+  countToken(Number(tokenCountDisplay.dataset.fileSize), true);
+});
+
 socket.on("total_tokens", (total_tokens) => {
+  // 別のファイルに差し替えたあとに届いた古い応答は捨てる
+  if (total_tokens.file_name !== fileName) return;
   const tokenCountDisplay = document.getElementById("tokenCountDisplay");
+  if (!tokenCountDisplay) return;
+  // 概算値 (provisional) は正確な値が届くまでの仮表示
+  if (total_tokens.provisional && tokenCountDisplay.dataset.exact === "true") return;
+  // 正確な値を問い合わせている間は、問い合わせの失敗 (failed) 以外の概算値で上書きしない
+  if (total_tokens.provisional && !total_tokens.failed && tokenCountDisplay.dataset.exact === "pending") return;
+  tokenCountDisplay.dataset.exact = String(!total_tokens.provisional);
   tokenCountDisplay.textContent = `token: ${total_tokens.total_tokens}`;
+  tokenCountDisplay.title = total_tokens.provisional ? "クリックすると正確なトークン数を問い合わせます" : "";
+  tokenCountDisplay.style.cursor = total_tokens.provisional ? "pointer" : "";
 });
 
 function handleFile(file) {
@@ -1278,6 +1617,7 @@ function handleFile(file) {
     attachmentPreview.innerHTML = ""; // 添付プレビューもクリア
     return;
   }
+  fileId = null; // 前に添付した大容量ファイルの参照を残さない
   // 10MB 超えるかどうかのチェック
   if (file.size > FILE_SIZE_THRESHOLD) {
     if (
@@ -1301,8 +1641,16 @@ function handleFile(file) {
   if (/\.(xlsx|xlsm)$/i.test(file.name)) {
     // SheetJS を使った変換用の読み込み (ArrayBuffer で読み込み)
     const reader = new FileReader();
-    reader.onload = (e) => {
+    reader.onload = async (e) => {
       const data = new Uint8Array(e.target.result);
+      // SheetJS は Excel ファイルを初めて添付したときに読み込む
+      try {
+        await loadScript(LAZY_SCRIPTS.xlsx);
+      } catch (error) {
+        alert("Excel ファイルの変換に必要なライブラリを読み込めませんでした");
+        fileInput.value = "";
+        return;
+      }
       // SheetJS で Workbook を読み込む
       const workbook = XLSX.read(data, { type: "array" });
 
@@ -1339,6 +1687,7 @@ function handleFile(file) {
                   </div>
                 `;
         attachmentPreview.innerHTML = previewHTML;
+        countToken(blob.size);
 
         // 削除ボタンのイベント追加
         const deleteBtn = attachmentPreview.querySelector(
@@ -1386,6 +1735,7 @@ function handleFile(file) {
                 `;
       }
       attachmentPreview.innerHTML = previewHTML;
+      countToken(file.size);
 
       // 削除ボタンのイベント追加
       const deleteBtn = attachmentPreview.querySelector(
@@ -1419,8 +1769,8 @@ fileInput.addEventListener("change", () => {
   }
 });
 
-// 大容量ファイル用のアップロード関数を追加
-function uploadLargeFile(file) {
+// 大容量ファイル用の分割・再開可能アップロード
+async function uploadLargeFile(file) {
   // アップロード中の表示
   attachmentPreview.innerHTML = `
         <div class="attachment-item">
@@ -1433,81 +1783,134 @@ function uploadLargeFile(file) {
         </div>
     `;
 
-  const formData = new FormData();
-  formData.append("file", file);
-  formData.append("token", token);
-
-  // FormDataでファイルをアップロード
-  const xhr = new XMLHttpRequest();
-  xhr.open("POST", "/upload_large_file", true);
-
-  // 進捗表示
-  xhr.upload.onprogress = (event) => {
-    if (event.lengthComputable) {
-      const percentComplete = Math.round((event.loaded / event.total) * 50);
-      const progressFill = attachmentPreview.querySelector(".progress-fill");
-      const progressText =
-        attachmentPreview.querySelector(".upload-progress p");
-
-      if (progressFill) progressFill.style.width = percentComplete + "%";
-      if (progressText)
-        progressText.textContent = `アップロード中... ${percentComplete}%`;
-    }
-  };
+  try {
+    const sha256 = await fileSha256(file, () => {
+      const progressText = attachmentPreview.querySelector(".upload-progress p");
+      if (progressText) progressText.textContent = "確認中...";
+    });
+    const response = await fetch("/upload_session", {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({
+        token: token,
+        file_name: file.name,
+        file_size: file.size,
+        mime_type: file.type,
+        sha256: sha256,
+      }),
+    });
+    let session = await response.json();
+    if (session.status === "error") throw new Error(session.message);
 
-  xhr.onload = function () {
-    if (xhr.status === 200) {
+    let retries = 0;
+    while (session.status !== "success") {
+      const offset = session.offset;
+      const chunk = file.slice(offset, offset + session.chunk_size);
       try {
-        const response = JSON.parse(xhr.responseText);
-
-        if (response.status === "success") {
-          // アップロード成功 - ファイルIDを保存
-          fileId = response.file_id;
-          fileName = response.file_name;
-          fileMimeType = response.file_mime_type;
-          fileData = null; // base64データは使わない
-
-          // プレビュー表示を更新
-          attachmentPreview.innerHTML = `
-                        <div id="tokenCountDisplay"></div>
-                        <div class="attachment-item">
-                            <button class="attachment-delete-btn">×</button>
-                            <img src="${FILE_IMG_URL}" alt="${fileName}" style="max-width:100%; height:auto;">
-                            <p>${fileName} (アップロード済み)</p>
-                        </div>
-                    `;
-
-          // 削除ボタンのイベント追加
-          const deleteBtn = attachmentPreview.querySelector(
-            ".attachment-delete-btn"
-          );
-          deleteBtn.addEventListener("click", () => {
-            fileData = null;
-            fileName = null;
-            fileMimeType = null;
-            fileId = null;
-            attachmentPreview.innerHTML = "";
-            fileInput.value = "";
-          });
-        } else {
-          // エラー処理
-          attachmentPreview.innerHTML = "";
-          alert(`アップロードエラー: ${response.message}`);
-        }
+        session = await putUploadChunk(session.upload_id, offset, chunk, (loaded) =>
+          updateUploadProgress(offset + loaded, file.size)
+        );
+        retries = 0;
       } catch (e) {
-        attachmentPreview.innerHTML = "";
-        alert("応答解析エラー: " + e.message);
+        // 接続が切れたら、サーバーが受け取った位置を確認してそこから再開する
+        if (e.fatal || ++retries > UPLOAD_MAX_RETRIES) throw e;
+        await new Promise((resolve) => setTimeout(resolve, 1000 * retries));
+        session = await fetchUploadSession(session.upload_id);
       }
-    } else {
-      attachmentPreview.innerHTML = "";
-      alert("アップロードエラー: " + xhr.status);
+      updateUploadProgress(session.offset, file.size);
     }
-  };
 
-  xhr.onerror = function () {
+    // アップロード成功 - ファイルIDを保存
+    fileId = session.file_id;
+    fileName = file.name;
+    fileMimeType = session.file_mime_type;
+    fileData = null; // base64データは使わない
+
+    // プレビュー表示を更新
+    attachmentPreview.innerHTML = `
+                  <div id="tokenCountDisplay"></div>
+                  <div class="attachment-item">
+                      <button class="attachment-delete-btn">×</button>
+                      <img src="${FILE_IMG_URL}" alt="${fileName}" style="max-width:100%; height:auto;">
+                      <p>${fileName} (アップロード済み)</p>
+                  </div>
+              `;
+    countToken(file.size);
+
+    // 削除ボタンのイベント追加
+    const deleteBtn = attachmentPreview.querySelector(".attachment-delete-btn");
+    deleteBtn.addEventListener("click", () => {
+      fileData = null;
+      fileName = null;
+      fileMimeType = null;
+      fileId = null;
+      attachmentPreview.innerHTML = "";
+      fileInput.value = "";
+    });
+  } catch (e) {
     attachmentPreview.innerHTML = "";
-    alert("ネットワークエラー");
-  };
+    alert(`アップロードエラー: ${e.message}`);
+  }
+}
 
-  xhr.send(formData);
+// crypto.subtle は https か localhost でしか使えないので、使えなければハッシュなしで送る
+// (計算はブラウザがメインスレッドの外で行うので、待っている間も画面は固まらない)
+async function fileSha256(file, onStart) {
+  if (file.size > UPLOAD_HASH_LIMIT || !window.crypto || !crypto.subtle) return null;
+  try {
+    if (onStart) onStart();
+    const digest = await crypto.subtle.digest("SHA-256", await file.arrayBuffer());
+    return Array.from(new Uint8Array(digest), (b) => b.toString(16).padStart(2, "0")).join("");
+  } catch (e) {
+    return null;
+  }
+}
+
+function updateUploadProgress(loaded, total) {
+  const percentComplete = Math.round((loaded / total) * 100);
+  const progressFill = attachmentPreview.querySelector(".progress-fill");
+  const progressText = attachmentPreview.querySelector(".upload-progress p");
+  if (progressFill) progressFill.style.width = percentComplete + "%";
+  if (progressText) progressText.textContent = `アップロード中... ${percentComplete}%`;
+}
+
+// 1チャンクを送信する。オフセットずれ (409) の場合はサーバー側の状態をそのまま返す
+function putUploadChunk(uploadId, offset, chunk, onProgress) {
+  return new Promise((resolve, reject) => {
+    const xhr = new XMLHttpRequest();
+    xhr.open("PUT", `/upload_session/${uploadId}`, true);
+    xhr.setRequestHeader("X-Auth-Token", token);
+    xhr.setRequestHeader("X-Upload-Offset", String(offset));
+    xhr.upload.onprogress = (event) => {
+      if (event.lengthComputable) onProgress(event.loaded);
+    };
+    xhr.onload = () => {
+      let response;
+      try {
+        response = JSON.parse(xhr.responseText);
+      } catch (e) {
+        reject(new Error("応答解析エラー: " + e.message));
+        return;
+      }
+      if (xhr.status === 200 || xhr.status === 409) {
+        resolve(response);
+      } else if (xhr.status >= 500) {
+        reject(new Error(response.message || String(xhr.status)));
+      } else {
+        // 認証エラーなど再試行しても直らないもの
+        reject(Object.assign(new Error(response.message || String(xhr.status)), { fatal: true }));
+      }
+    };
+    xhr.onerror = () => reject(new Error("ネットワークエラー"));
+    xhr.send(chunk);
+  });
+}
+
+async function fetchUploadSession(uploadId) {
+  const response = await fetch(`/upload_session/${uploadId}`, {
+    headers: { "X-Auth-Token": token },
+  });
+  const session = await response.json();
+  if (session.status === "error") throw new Error(session.message);
+  return session;
 }
@@ -0,0 +1,167 @@
+# -----------------------------------------------------------
+# 静的ファイルの配信 (内容のハッシュ付きのファイル名 + 事前圧縮)
+# -----------------------------------------------------------
+# 起動時に static/ 以下を STATIC_BUILD_DIR にコピーし、ファイル名に内容のハッシュを付ける
+# (lib/katex.min.js → lib/katex.min.<hash>.js)。テキスト系のファイルは gzip 版 (.gz) と、
+# brotli パッケージがあれば brotli 版 (.br) も作っておく。
+#   - /assets/<ハッシュ付きの名前> で配信し、Accept-Encoding に合わせて圧縮済みのものを返す
+#   - 名前が内容で決まるので Cache-Control: immutable を付けて 1 年キャッシュさせる
+#   - テンプレートでは asset_url("lib/katex.min.js") でハッシュ付きの URL を得る
+#   - CSS の url(...) で参照しているフォントなども、ハッシュ付きの名前に書き換える
+# 同じ内容のファイルはビルド済みなら作り直さないので、再起動や複数ワーカーの起動は速い。
+# python static_assets.py でデプロイ前にビルドしておくこともできる。
+import os
+import re
+import gzip
+import json
+import hashlib
+import mimetypes
+import posixpath
+
+from filelock import FileLock
+
+try:
+    import brotli  # 任意。無ければ gzip 版だけを作る
+except ImportError:
+    brotli = None
+
+ASSET_PIPELINE = os.environ.get("ASSET_PIPELINE", "1") != "0"
+STATIC_BUILD_DIR = os.environ.get("STATIC_BUILD_DIR", "static_build")
+ASSET_URL_PREFIX = "/assets/"
+ASSET_MAX_AGE = 365 * 24 * 60 * 60
+# 圧縮する拡張子 (woff2 や png などは圧縮済み)
+COMPRESSIBLE = {".js", ".css", ".svg", ".html", ".json", ".txt", ".ttf", ".eot"}
+# これより小さいファイルは圧縮しない
+COMPRESS_MIN_SIZE = 1024
+
+CSS_URL = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+
+
+def hashed_name(name, content):
+    """lib/katex.min.js → lib/katex.min.<内容のハッシュ 12 桁>.js"""
+    root, ext = posixpath.splitext(name)
+    return f"{root}.{hashlib.sha256(content).hexdigest()[:12]}{ext}"
+
+
+def rewrite_css(name, content, manifest):
+    """CSS の url(...) のうちビルド対象のファイルを、ハッシュ付きの名前 (CSS からの相対パス) に置き換える"""
+    base = posixpath.dirname(name)
+
+    def replace(match):
+        quote, ref = match.group(1), match.group(2).strip()
+        if ref.startswith(("data:", "/", "#")) or "://" in ref:
+            return match.group(0)
+        path, suffix = re.match(r"([^?#]*)(.*)", ref).groups()  # ?v=... や #id は残す
+        target = manifest.get(posixpath.normpath(posixpath.join(base, path)))
+        if target is None:
+            return match.group(0)
+        return f"url({quote}{posixpath.relpath(target, base or '.')}{suffix}{quote})"
+
+    return CSS_URL.sub(replace, content.decode("utf-8")).encode("utf-8")
+
+
+def write_atomic(path, data):
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class AssetPipeline:
+    def __init__(self, source_dir, build_dir=STATIC_BUILD_DIR):
+        self.source_dir = source_dir
+        self.build_dir = os.path.abspath(build_dir)
+        self.manifest = {}  # 元の名前 → ハッシュ付きの名前
+        self.files = {}  # ハッシュ付きの名前 → {"etag", "mimetype", "encodings": {エンコーディング: パス}}
+        self.signature = None
+
+    def sources(self):
+        """(static/ からの相対パス, フルパス) の list。CSS は参照先より後にする"""
+        found = []
+        for root, _, names in os.walk(self.source_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                found.append((os.path.relpath(path, self.source_dir).replace(os.sep, "/"), path))
+        return sorted(found, key=lambda item: (item[0].endswith(".css"), item[0]))
+
+    def source_signature(self, sources=None):
+        """元のファイルの (名前, 更新時刻, サイズ)。変わっていなければ作り直さない"""
+        signature = []
+        for name, path in sources or self.sources():
+            stat = os.stat(path)
+            signature.append((name, stat.st_mtime_ns, stat.st_size))
+        return signature
+
+    def build(self):
+        sources = self.sources()
+        signature = self.source_signature(sources)
+        os.makedirs(self.build_dir, exist_ok=True)
+        manifest = {}
+        files = {}
+        # 複数ワーカーが同時に起動しても同じファイルを並行して書かない
+        with FileLock(os.path.join(self.build_dir, ".lock")):
+            for name, path in sources:
+                with open(path, "rb") as f:
+                    content = f.read()
+                if name.endswith(".css"):
+                    content = rewrite_css(name, content, manifest)
+                target = hashed_name(name, content)
+                manifest[name] = target
+                files[target] = self._write(target, content)
+            write_atomic(os.path.join(self.build_dir, "manifest.json"),
+                         json.dumps(manifest, indent=1, sort_keys=True).encode("utf-8"))
+        self.manifest, self.files, self.signature = manifest, files, signature
+        return manifest
+
+    def _write(self, target, content):
+        path = os.path.join(self.build_dir, *target.split("/"))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if not os.path.exists(path):
+            write_atomic(path, content)
+        encodings = {"identity": path}
+        if posixpath.splitext(target)[1] in COMPRESSIBLE and len(content) >= COMPRESS_MIN_SIZE:
+            variants = [("gzip", ".gz", lambda: gzip.compress(content, 9, mtime=0))]
+            if brotli is not None:
+                variants.insert(0, ("br", ".br", lambda: brotli.compress(content, quality=11)))
+            for encoding, suffix, compress in variants:
+                if not os.path.exists(path + suffix):
+                    compressed = compress()
+                    if len(compressed) >= len(content):
+                        continue
+                    write_atomic(path + suffix, compressed)
+                encodings[encoding] = path + suffix
+        return {
+            "etag": posixpath.basename(target),
+            "mimetype": mimetypes.guess_type(target)[0] or "application/octet-stream",
+            "encodings": encodings,
+        }
+
+    def refresh(self):
+        """元のファイルが変わっていたら作り直す (開発中に script.js などを編集したとき)"""
+        if self.source_signature() != self.signature:
+            self.build()
+
+    def url(self, filename):
+        """ハッシュ付きの URL。ビルド対象でなければ None"""
+        target = self.manifest.get(filename)
+        return ASSET_URL_PREFIX + target if target else None
+
+    def lookup(self, target, accept_encodings):
+        """(ファイルのパス, Content-Encoding (無圧縮なら None), 情報) を返す。無ければ None
+
+        accept_encodings は werkzeug の request.accept_encodings。br → gzip の順に選ぶ。
+        """
+        info = self.files.get(target)
+        if info is None:
+            return None
+        for encoding in ("br", "gzip"):
+            if encoding in info["encodings"] and accept_encodings[encoding] > 0:
+                return info["encodings"][encoding], encoding, info
+        return info["encodings"]["identity"], None, info
+
+
+if __name__ == "__main__":
+    pipeline = AssetPipeline(os.path.join(os.path.dirname(os.path.abspath(__file__)), "static"))
+    built = pipeline.build()
+    compressed = sum(len(info["encodings"]) > 1 for info in pipeline.files.values())
+    print(f"{len(built)} 件を {STATIC_BUILD_DIR} にビルドしました (圧縮版あり: {compressed} 件, brotli: {'あり' if brotli else 'なし'})")
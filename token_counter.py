@@ -0,0 +1,166 @@
+# -----------------------------------------------------------
+# 添付ファイルのトークン数の見積もりとキャッシュ
+# -----------------------------------------------------------
+# count_tokens は API 呼び出しなので、同じファイル・モデルの結果は LRU にためて使い回す。
+# API の結果が返るまでの間は、MIME タイプごとの簡易計算で求めた概算値を先に表示する。
+# 概算に使う係数は Gemini のドキュメントにある目安 (画像は 768px タイルごと 258 トークン、
+# 動画は 1 秒 263 トークン、音声は 1 秒 32 トークン、PDF は 1 ページ 258 トークン)。
+import os
+import re
+import math
+import struct
+import threading
+from collections import OrderedDict
+
+TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_COUNT_CACHE_SIZE", 512))
+
+IMAGE_TOKENS_PER_TILE = 258
+IMAGE_TILE_SIZE = 768
+IMAGE_SMALL_SIZE = 384
+VIDEO_TOKENS_PER_SECOND = 263
+AUDIO_TOKENS_PER_SECOND = 32
+PDF_TOKENS_PER_PAGE = 258
+# 長さを読み取れないメディアはビットレートを仮定してサイズから再生時間を推定する
+ASSUMED_AUDIO_BYTES_PER_SECOND = 128 * 1000 // 8
+ASSUMED_VIDEO_BYTES_PER_SECOND = 2 * 1000 * 1000 // 8
+
+
+class TokenCountCache:
+    """(モデル, 内容のハッシュ, MIME タイプ) → トークン数 の LRU"""
+
+    def __init__(self, max_entries=TOKEN_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+
+    def put(self, key, total_tokens):
+        with self.lock:
+            self.entries[key] = total_tokens
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+token_count_cache = TokenCountCache()
+
+
+def estimate_tokens(data, mime_type, size=None):
+    """MIME タイプに応じた概算トークン数。見積もれない場合は None
+
+    data が None の場合 (File API にアップロード済みのファイルなど) は size だけから推定する。
+    """
+    size = len(data) if data is not None else size
+    mime_type = mime_type or ""
+    try:
+        if mime_type.startswith("text/") or mime_type in ("application/x-javascript", "application/x-python"):
+            return estimate_text_tokens(data) if data is not None else None
+        if mime_type.startswith("image/"):
+            dimensions = image_dimensions(data) if data is not None else None
+            return estimate_image_tokens(*dimensions) if dimensions else IMAGE_TOKENS_PER_TILE
+        if mime_type.startswith("audio/"):
+            seconds = media_duration(data, mime_type) if data is not None else None
+            if seconds is None and size:
+                seconds = size / ASSUMED_AUDIO_BYTES_PER_SECOND
+            return math.ceil(seconds * AUDIO_TOKENS_PER_SECOND) if seconds is not None else None
+        if mime_type.startswith("video/"):
+            seconds = media_duration(data, mime_type) if data is not None else None
+            if seconds is None and size:
+                seconds = size / ASSUMED_VIDEO_BYTES_PER_SECOND
+            return math.ceil(seconds * VIDEO_TOKENS_PER_SECOND) if seconds is not None else None
+        if mime_type == "application/pdf" and data is not None:
+            return pdf_page_count(data) * PDF_TOKENS_PER_PAGE
+    except (ValueError, struct.error, IndexError):
+        return None
+    return None
+
+
+def estimate_text_tokens(data):
+    # 英数字はおよそ 4 文字で 1 トークン、日本語などはおよそ 1 文字 1 トークン
+    text = data.decode("utf-8", errors="ignore")
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return math.ceil(ascii_chars / 4) + (len(text) - ascii_chars)
+
+
+def estimate_image_tokens(width, height):
+    if width <= IMAGE_SMALL_SIZE and height <= IMAGE_SMALL_SIZE:
+        return IMAGE_TOKENS_PER_TILE
+    tiles = math.ceil(width / IMAGE_TILE_SIZE) * math.ceil(height / IMAGE_TILE_SIZE)
+    return tiles * IMAGE_TOKENS_PER_TILE
+
+
+def image_dimensions(data):
+    """PNG / JPEG / GIF / WebP のヘッダから (幅, 高さ) を読む"""
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return struct.unpack(">II", data[16:24])
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return struct.unpack("<HH", data[6:10])
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        chunk = data[12:16]
+        if chunk == b"VP8X":
+            return (int.from_bytes(data[24:27], "little") + 1, int.from_bytes(data[27:30], "little") + 1)
+        if chunk == b"VP8 ":
+            width, height = struct.unpack("<HH", data[26:30])
+            return width & 0x3FFF, height & 0x3FFF
+        if chunk == b"VP8L":
+            bits = int.from_bytes(data[21:25], "little")
+            return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        return None
+    if data[:2] == b"\xff\xd8":
+        pos = 2
+        while pos + 9 < len(data):
+            if data[pos] != 0xFF:
+                pos += 1
+                continue
+            marker = data[pos + 1]
+            if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7 or marker == 0xFF:
+                pos += 1 if marker == 0xFF else 2
+                continue
+            # SOF マーカー (DHT / JPG / DAC 以外の C0〜CF) に画像サイズが入っている
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                height, width = struct.unpack(">HH", data[pos + 5:pos + 9])
+                return width, height
+            pos += 2 + struct.unpack(">H", data[pos + 2:pos + 4])[0]
+    return None
+
+
+def media_duration(data, mime_type):
+    """WAV と MP4 / MOV のヘッダから再生時間 (秒) を読む。読めなければ None"""
+    if data[:4] == b"RIFF" and data[8:12] == b"WAVE":
+        pos = 12
+        byte_rate = None
+        while pos + 8 <= len(data):
+            chunk_id = data[pos:pos + 4]
+            chunk_size = struct.unpack("<I", data[pos + 4:pos + 8])[0]
+            if chunk_id == b"fmt ":
+                byte_rate = struct.unpack("<I", data[pos + 16:pos + 20])[0]
+            elif chunk_id == b"data" and byte_rate:
+                return min(chunk_size, len(data) - pos - 8) / byte_rate
+            pos += 8 + chunk_size + (chunk_size & 1)
+        return None
+    pos = data.find(b"mvhd")
+    if pos >= 4:
+        version = data[pos + 4]
+        if version == 1:
+            timescale, duration = struct.unpack(">IQ", data[pos + 24:pos + 36])
+        else:
+            timescale, duration = struct.unpack(">II", data[pos + 16:pos + 24])
+        if timescale:
+            return duration / timescale
+    return None
+
+
+def pdf_page_count(data):
+    pages = len(re.findall(rb"/Type\s*/Page(?![a-zA-Z])", data))
+    counts = [int(n) for n in re.findall(rb"/Count\s+(\d+)", data)]
+    return max([pages] + counts) or 1
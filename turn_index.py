@@ -0,0 +1,98 @@
+# -----------------------------------------------------------
+# 表示用メッセージ (st_messages) と Gemini 履歴の対応 (ターンインデックス)
+# -----------------------------------------------------------
+# st_messages の i 番目のメッセージが Gemini 履歴のどこから始まるか (offset) を
+# <chat_id>-turn_index に st_messages と同じ並びで保存する。
+# delete_message などで i 番目以降を消すときは、Gemini 履歴を offset[i] で切り詰めればよい。
+#
+# 1 つのモデル応答は Gemini 履歴ではチャンクごとの複数の Content になり、エラーや生成前の異常終了では
+# ユーザー発言が st_messages にだけ残ることもあるので、ユーザー発言を数えるだけでは位置がずれる。
+# offset は書き込みのたびに追加・変更された分だけ求める。
+#   ユーザー発言: 追加した時点の Gemini 履歴の長さ (発言の Content は応答と一緒に後から書かれる)
+#   モデル応答  : 直前のユーザー発言の offset + 1 (Gemini 履歴に入っていない partial は直前と同じ offset)
+# 読み込むときは件数と、引く位置の前後の offset の並びと参照先の role を確かめ、合わなければ両方のリストから作り直す。
+
+
+def next_offsets(previous, new_messages, history_length):
+    """追加するメッセージの offset の list
+
+    previous は直前のメッセージの (role, offset) (先頭なら None)、history_length は現在の Gemini 履歴の長さ。
+    """
+    offsets = []
+    for message in new_messages:
+        if message["role"] == "user" or previous is None:
+            offset = history_length
+        elif previous[0] == "user" and model_in_history(message):
+            offset = previous[1] + 1
+        else:
+            offset = previous[1]
+        offsets.append(offset)
+        previous = (message["role"], offset)
+    return offsets
+
+
+def model_in_history(message):
+    """モデル応答が Gemini 履歴に入っているか (生成中・異常終了した partial は入っていない)"""
+    return not message.get("partial") or message.get("history_saved", False)
+
+
+def in_history(messages, i):
+    """i 番目のユーザー発言が Gemini 履歴に入っているか
+
+    応答 (または Gemini 履歴に保存済みの途中までの応答) が続くときだけ入っている。
+    """
+    if i + 1 >= len(messages) or messages[i + 1]["role"] != "model":
+        return False
+    return model_in_history(messages[i + 1])
+
+
+def build_turn_index(messages, history):
+    """両方のリストを先頭から突き合わせて offset を求める (インデックスが無い・壊れている場合)"""
+    offsets = []
+    position = 0
+    for i, message in enumerate(messages):
+        if message["role"] == "user":
+            if not in_history(messages, i):
+                offsets.append(position)
+                continue
+            while position < len(history) and history[position].role != "user":
+                position += 1
+            offsets.append(position)
+            position = min(position + 1, len(history))
+        else:
+            offsets.append(position)
+            while position < len(history) and history[position].role == "model":
+                position += 1
+    return offsets
+
+
+def is_consistent(offsets, messages, history, i=None):
+    """件数と、i 番目 (省略時は末尾) とその前後の offset だけを確かめる (全体は走査しない)
+
+    前後の offset が減っていないこと、Gemini 履歴の範囲内であること、参照先の role が合うこと、
+    Gemini 履歴に入っているターンではモデル応答がユーザー発言の直後を指すことを確かめる。
+    """
+    if len(offsets) != len(messages):
+        return False
+    if not offsets:
+        return True
+    i = len(offsets) - 1 if i is None else i
+    window = range(max(i - 1, 0), min(i + 2, len(offsets)))
+    for j in window:
+        offset = offsets[j]
+        message = messages[j]
+        if j > window.start and offset < offsets[j - 1]:
+            return False
+        if message["role"] == "user":
+            # 応答待ちのユーザー発言はまだ Gemini 履歴に無いので末尾を指す
+            if offset > len(history) or (offset < len(history) and history[offset].role != "user"):
+                return False
+        elif model_in_history(message):
+            # 書き込みの途中 (st_messages を先に書く) は Gemini 履歴の末尾の 1 つ先を指すことがある
+            if offset > len(history) + 1 or (offset < len(history) and history[offset].role != "model"):
+                return False
+            if j > 0 and messages[j - 1]["role"] == "user" and offset != offsets[j - 1] + 1:
+                return False
+        elif offset > len(history):
+            return False
+    return True
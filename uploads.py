@@ -0,0 +1,349 @@
+# -----------------------------------------------------------
+# 分割・再開可能なファイルアップロード
+# -----------------------------------------------------------
+# クライアントはファイルを chunk_size ごとに PUT し、届いたバイト列はそのまま
+# Gemini File API の resumable upload (または開発用のローカル保存) に流す。
+# 一時ファイルにファイル全体を書き出すことはせず、メモリに載るのは1チャンク分だけ。
+# 接続が切れた場合は GET で受信済みの位置を確認し、そこから送り直せばよい。
+# 受け取ったバイト列の SHA-256 は転送しながら計算し、完了したら重複排除レジストリに登録する。
+# 複数ワーカー構成では、どのワーカーにチャンクが届いても続けられるようセッションを共有ストアにも置く。
+import os
+import hashlib
+import time
+import uuid
+import threading
+
+import requests
+
+from metrics import counter, histogram, BYTES_PER_SECOND_BUCKETS
+
+# Google の resumable upload は最後以外のチャンクを 256KiB の倍数にする必要がある
+UPLOAD_GRANULARITY = 256 * 1024
+UPLOAD_CHUNK_SIZE = int(os.environ.get("UPLOAD_CHUNK_SIZE", 8 * 1024 * 1024)) // UPLOAD_GRANULARITY * UPLOAD_GRANULARITY
+UPLOAD_SESSION_TTL = float(os.environ.get("UPLOAD_SESSION_TTL", 24 * 60 * 60))
+UPLOAD_BACKEND = os.environ.get("UPLOAD_BACKEND", "gemini")  # gemini / local
+# 動画・音声以外のファイルの上限 (クライアントの FILE_SIZE_THRESHOLD と同じ。local では送信時にインラインで送る)
+UPLOAD_NON_MEDIA_LIMIT = 10 * 1024 * 1024
+
+COPY_BLOCK_SIZE = 64 * 1024
+GEMINI_UPLOAD_BASE_URL = "https://generativelanguage.googleapis.com/"
+# resumable upload への HTTP リクエストの (接続, 読み込み) タイムアウト秒数
+UPLOAD_HTTP_TIMEOUT = (30, float(os.environ.get("UPLOAD_HTTP_TIMEOUT", 300)))
+
+upload_bytes = counter("upload_bytes_total", "保存先に書き込んだアップロードのバイト数", ("backend",))
+upload_speed = histogram(
+    "upload_chunk_bytes_per_second", "チャンク 1 つを保存先に書き込んだ速度", ("backend",), BYTES_PER_SECOND_BUCKETS
+)
+
+
+class UploadError(Exception):
+    """クライアントに返す HTTP ステータス付きのエラー"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class UploadSession:
+    def __init__(self, username, file_name, mime_type, size):
+        self.upload_id = uuid.uuid4().hex
+        self.username = username
+        self.file_name = file_name
+        self.mime_type = mime_type
+        self.size = size
+        self.offset = 0  # 受け付け済みのバイト数
+        self.upload_url = None  # Gemini の resumable upload 先
+        self.result = None  # 完了後のファイル情報
+        self.remote_file = None  # File API 上のファイル (レジストリ登録用)
+        self.hasher = hashlib.sha256()  # 受け付け済みバイト列のハッシュ (不明になったら None)
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def to_dict(self):
+        return {
+            "upload_id": self.upload_id, "username": self.username, "file_name": self.file_name,
+            "mime_type": self.mime_type, "size": self.size, "offset": self.offset,
+            "upload_url": self.upload_url, "result": self.result,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """共有ストアから復元する。途中までのハッシュは引き継げないのでレジストリには登録しない"""
+        session = cls(data["username"], data["file_name"], data["mime_type"], data["size"])
+        session.upload_id = data["upload_id"]
+        session.upload_url = data["upload_url"]
+        session.adopt(data)
+        return session
+
+    def adopt(self, data):
+        """他のワーカーが進めた状態に合わせる"""
+        if data["offset"] != self.offset or data["result"] != self.result:
+            self.offset = data["offset"]
+            self.result = data["result"]
+            self.hasher = None
+
+    def status(self):
+        status = {
+            "status": "success" if self.result else "progress",
+            "upload_id": self.upload_id,
+            "offset": self.offset,
+            "size": self.size,
+            "chunk_size": UPLOAD_CHUNK_SIZE,
+        }
+        if self.result:
+            status.update(self.result)
+        return status
+
+
+class GeminiUploadBackend:
+    """Gemini File API の resumable upload にチャンクをそのまま転送する
+
+    SDK の files.upload() はファイル全体を受け取るので、resumable upload のプロトコルは API キーを付けた
+    HTTP リクエストで直接扱う (SDK の内部 API に依存しない)。完了したファイルの情報は files.get で取り直す。
+    """
+
+    def __init__(self, client, api_key, base_url=None):
+        self.client = client
+        self.api_key = api_key
+        self.base_url = (base_url or GEMINI_UPLOAD_BASE_URL).rstrip("/") + "/"
+
+    def start(self, session):
+        response = self._request(self.base_url + "upload/v1beta/files", {
+            "Content-Type": "application/json",
+            "X-Goog-Api-Key": self.api_key,
+            "X-Goog-Upload-Protocol": "resumable",
+            "X-Goog-Upload-Command": "start",
+            "X-Goog-Upload-Header-Content-Length": str(session.size),
+            "X-Goog-Upload-Header-Content-Type": session.mime_type,
+        }, json={"file": {"display_name": session.file_name}})
+        upload_url = response.headers.get("X-Goog-Upload-URL")
+        if not upload_url:
+            raise UploadError("アップロードURLを取得できませんでした", 502)
+        session.upload_url = upload_url
+
+    def write(self, session, stream, length, final):
+        data = read_exact(stream, length)
+        command = "upload, finalize" if final else "upload"
+        response = self._post(session, command, data, offset=session.offset)
+        status = response.headers.get("X-Goog-Upload-Status")
+        if not final:
+            if status != "active":
+                raise UploadError(f"アップロードが中断されました (status={status})", 502)
+            return None
+        if status != "final":
+            raise UploadError(f"アップロードを完了できませんでした (status={status})", 502)
+        uploaded = self.client.files.get(name=response.json()["file"]["name"])
+        session.remote_file = uploaded
+        return {"file_id": uploaded.name, "file_mime_type": uploaded.mime_type or session.mime_type}
+
+    def received(self, session):
+        """Google 側が受け取ったバイト数 (途中で切れた場合の再開位置)"""
+        response = self._post(session, "query", b"")
+        return int(response.headers.get("X-Goog-Upload-Size-Received", session.offset))
+
+    def _post(self, session, command, data, offset=None):
+        headers = {"X-Goog-Upload-Command": command}
+        if offset is not None:
+            headers["X-Goog-Upload-Offset"] = str(offset)
+        return self._request(session.upload_url, headers, data=data)
+
+    def _request(self, url, headers, **kwargs):
+        try:
+            response = requests.post(url, headers=headers, timeout=UPLOAD_HTTP_TIMEOUT, **kwargs)
+        except requests.exceptions.RequestException as e:
+            raise UploadError(f"File API に接続できませんでした: {e}", 502) from e
+        if response.status_code >= 400:
+            raise UploadError(f"File API がエラーを返しました ({response.status_code}): {response.text[:200]}", 502)
+        return response
+
+
+class LocalUploadBackend:
+    """API を使わずにローカルへ保存する代替 (開発・検証用)
+
+    完了したファイルは file_id "local/<upload_id>" として扱い、送信時にインラインデータとして添付する。
+    """
+
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+
+    def start(self, session):
+        open(self._part_path(session), "wb").close()
+
+    def write(self, session, stream, length, final):
+        with open(self._part_path(session), "r+b") as f:
+            f.seek(session.offset)
+            remaining = length
+            while remaining:
+                block = stream.read(min(COPY_BLOCK_SIZE, remaining))
+                if not block:
+                    raise UploadError("チャンクの途中で接続が切れました")
+                f.write(block)
+                remaining -= len(block)
+            f.truncate()
+        if not final:
+            return None
+        os.replace(self._part_path(session), local_file_path(self.base_dir, session.username, session.upload_id))
+        return {"file_id": f"local/{session.upload_id}", "file_mime_type": session.mime_type}
+
+    def received(self, session):
+        try:
+            size = os.path.getsize(self._part_path(session))
+        except FileNotFoundError:
+            return session.offset
+        # 書きかけのチャンクは捨てて境界から送り直してもらう
+        return size // UPLOAD_GRANULARITY * UPLOAD_GRANULARITY
+
+    def _part_path(self, session):
+        return local_file_path(self.base_dir, session.username, session.upload_id) + ".part"
+
+
+def local_file_path(base_dir, username, upload_id):
+    upload_dir = os.path.join(base_dir, username, "uploads")
+    os.makedirs(upload_dir, exist_ok=True)
+    return os.path.join(upload_dir, os.path.basename(upload_id))
+
+
+class HashingReader:
+    """読み出したバイト列をハッシュに通しながら元のストリームを読む"""
+
+    def __init__(self, stream, hasher):
+        self.stream = stream
+        self.hasher = hasher
+
+    def read(self, size=-1):
+        block = self.stream.read(size)
+        self.hasher.update(block)
+        return block
+
+
+def read_exact(stream, length):
+    chunks = []
+    remaining = length
+    while remaining:
+        block = stream.read(min(COPY_BLOCK_SIZE, remaining))
+        if not block:
+            raise UploadError("チャンクの途中で接続が切れました")
+        chunks.append(block)
+        remaining -= len(block)
+    return b"".join(chunks)
+
+
+class UploadManager:
+    """アップロードセッションを管理する"""
+
+    def __init__(self, backend, registry=None, store=None):
+        self.backend = backend
+        self.registry = registry
+        self.store = store  # 複数ワーカー構成のときの共有ストア (shared_state)
+        self.sessions = {}
+
+    def create(self, username, file_name, mime_type, size, sha256=None):
+        """sha256 が登録済みのファイルと一致すれば、アップロードせずに完了済みのセッションを返す"""
+        self.cleanup()
+        if size <= 0:
+            raise UploadError("ファイルサイズが不正です")
+        if size > UPLOAD_NON_MEDIA_LIMIT and not mime_type.startswith(("video/", "audio/")):
+            raise UploadError("動画・音声以外のファイルサイズ上限は10MBです", 413)
+        session = UploadSession(username, file_name, mime_type, size)
+        entry = self.lookup(username, sha256, size)
+        if entry:
+            print(f"[upload] 重複ファイルを再利用: {file_name} -> {entry['file_id']}")
+            session.offset = size
+            session.result = {
+                "file_id": entry["file_id"],
+                "file_mime_type": entry["mime_type"] or mime_type,
+                "deduplicated": True,
+            }
+            self.sessions[session.upload_id] = session
+            self.save(session)
+            return session
+        self.backend.start(session)
+        self.sessions[session.upload_id] = session
+        self.save(session)
+        return session
+
+    def get(self, username, upload_id):
+        session = self.sessions.get(upload_id)
+        if self.store is not None:
+            data = self.store.get(f"upload:{upload_id}")
+            if data is not None:
+                if session is None:
+                    session = self.sessions[upload_id] = UploadSession.from_dict(data)
+                else:
+                    session.adopt(data)
+        if session is None or session.username != username:
+            raise UploadError("アップロードセッションが見つかりません", 404)
+        return session
+
+    def write(self, session, stream, offset, length):
+        """offset から length バイトを受け取る。完了したらファイル情報を返す"""
+        if not session.lock.acquire(blocking=False):
+            raise UploadError("同じセッションに同時に書き込むことはできません", 409)
+        try:
+            if session.result:
+                return session.result
+            if offset != session.offset:
+                raise UploadError("オフセットが一致しません", 409)
+            if length <= 0 or length > UPLOAD_CHUNK_SIZE or offset + length > session.size:
+                raise UploadError("チャンクサイズが不正です")
+            final = offset + length == session.size
+            if not final and length % UPLOAD_GRANULARITY:
+                raise UploadError(f"最後以外のチャンクは {UPLOAD_GRANULARITY} バイトの倍数にしてください")
+            hasher = session.hasher.copy() if session.hasher else None
+            started = time.perf_counter()
+            try:
+                result = self.backend.write(session, HashingReader(stream, hasher) if hasher else stream, length, final)
+            except Exception:
+                # どこまで届いたかは保存先に問い合わせ、次の再開位置にする
+                self.resync(session)
+                if session.offset != offset:
+                    # チャンクの一部だけ届いた場合はハッシュを追えなくなるので登録を諦める
+                    session.hasher = None
+                raise
+            backend = type(self.backend).__name__
+            upload_bytes.inc(length, backend=backend)
+            upload_speed.observe(length / max(time.perf_counter() - started, 1e-6), backend=backend)
+            session.hasher = hasher
+            session.offset += length
+            session.updated = time.time()
+            if final:
+                session.result = result
+                self.register(session)
+            self.save(session)
+            return result
+        finally:
+            session.lock.release()
+
+    def save(self, session):
+        if self.store is not None:
+            self.store.set(f"upload:{session.upload_id}", session.to_dict(), ttl=UPLOAD_SESSION_TTL)
+
+    def lookup(self, username, sha256, size):
+        if self.registry is None or not sha256:
+            return None
+        try:
+            return self.registry.lookup(username, sha256.lower(), size)
+        except Exception as e:
+            print(f"[upload] レジストリ検索エラー: {e}")
+            return None
+
+    def register(self, session):
+        if self.registry is None or session.hasher is None or session.remote_file is None:
+            return
+        try:
+            self.registry.register(session.username, session.hasher.hexdigest(), session.size, session.remote_file)
+        except Exception as e:
+            print(f"[upload] レジストリ登録エラー: {e}")
+
+    def resync(self, session):
+        try:
+            session.offset = self.backend.received(session)
+        except Exception:
+            return
+        self.save(session)
+
+    def cleanup(self):
+        now = time.time()
+        for upload_id, session in list(self.sessions.items()):
+            if now - session.updated > UPLOAD_SESSION_TTL:
+                self.sessions.pop(upload_id, None)